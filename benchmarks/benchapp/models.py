@@ -0,0 +1,37 @@
+""" Partitioned models for the benchmarks, with 0, 1 and 10
+PartitionForeignKey children.
+"""
+from django.db import models
+from parting import PartitionForeignKey, PartitionManager
+from parting.strategies import IntegerRangePartitionManager
+
+
+def _parent(name):
+    return type(name, (models.Model,), {
+        '__module__': __name__,
+        'value': models.IntegerField(),
+        'created': models.DateTimeField(auto_now_add=True),
+        'partitions': IntegerRangePartitionManager(size=1),
+        'Meta': type('Meta', (), {'abstract': True}),
+    })
+
+
+def _child(name, parent):
+    return type(name, (models.Model,), {
+        '__module__': __name__,
+        'note': models.TextField(),
+        'parent': PartitionForeignKey(parent),
+        'partitions': PartitionManager(),
+        'Meta': type('Meta', (), {'abstract': True}),
+    })
+
+
+Parent0 = _parent('Parent0')
+
+Parent1 = _parent('Parent1')
+Child1 = _child('Child1', Parent1)
+
+Parent10 = _parent('Parent10')
+for _i in range(10):
+    globals()['Child10_{}'.format(_i)] = _child(
+        'Child10_{}'.format(_i), Parent10)
@@ -0,0 +1,233 @@
+""" Benchmark partition lookup, generation and DDL.
+
+Run from the repository root:
+
+    python benchmarks/partition_lookup.py > results.json
+
+or, against PostgreSQL (connection details are taken from the usual PGHOST,
+PGUSER and PGPASSWORD environment variables; the benchmark creates and then
+drops its own tables, so use a scratch database):
+
+    python benchmarks/partition_lookup.py --postgresql parting_bench
+
+Prints a JSON report with a result per benchmark, along with the versions
+and database used, so that runs can be compared. Times are in seconds.
+
+- hit: get_partition() for a partition which is already generated
+- miss_N_children: generating a partition and its N PartitionForeignKey
+  children
+- generate_many: generating --generate partitions, each with one child, one
+  after another
+- concurrent_misses: --threads threads asking for the same new partitions at
+  once
+- ensure_partition: running the ensure_partition command for one new
+  partition, when each of --ensure-sizes partitions already exist
+"""
+import json
+import optparse
+import os
+import platform
+import sys
+import threading
+from timeit import default_timer as timer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.dirname(os.path.abspath(__file__))]
+
+
+def configure(options):
+    from django.conf import settings
+    if options.postgresql:
+        database = {
+            'ENGINE': 'django.db.backends.postgresql_psycopg2',
+            'NAME': options.postgresql,
+        }
+    else:
+        database = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': ':memory:',
+        }
+    settings.configure(
+        DATABASES={'default': database},
+        INSTALLED_APPS=['parting', 'benchapp'],
+        USE_TZ=True,
+    )
+
+
+def summarise(times):
+    """ Summarise a list of timings """
+    times = sorted(times)
+    count = len(times)
+    return {
+        'count': count,
+        'total': sum(times),
+        'mean': sum(times) / count,
+        'min': times[0],
+        'p50': times[count // 2],
+        'p95': times[min(count - 1, int(count * 0.95))],
+        'max': times[-1],
+    }
+
+
+class Keys(object):
+    # Hands out partition keys which haven't been used yet
+
+    def __init__(self):
+        self.next = 0
+
+    def take(self, count=1):
+        start, self.next = self.next, self.next + count
+        return ['{:010d}'.format(i) for i in range(start, self.next)]
+
+
+def bench_hit(manager, keys, iterations):
+    # Time batches of lookups, as a single lookup is too quick to time
+    key = keys.take()[0]
+    manager.get_partition(key)
+    batch = 1000
+    times = []
+    for _ in range(max(iterations // batch, 1)):
+        start = timer()
+        for _ in range(batch):
+            manager.get_partition(key)
+        times.append((timer() - start) / batch)
+    return summarise(times)
+
+
+def bench_miss(manager, keys, count):
+    # Generate each partition along with its children, as ensure_partition
+    # does. In normal use, children are only generated when needed.
+    times = []
+    for key in keys.take(count):
+        start = timer()
+        manager._partition_family(key)
+        times.append(timer() - start)
+    return summarise(times)
+
+
+def bench_generate_many(manager, keys, count):
+    start = timer()
+    for key in keys.take(count):
+        manager._partition_family(key)
+    seconds = timer() - start
+    return {
+        'partitions': count,
+        'total': seconds,
+        'per_partition': seconds / count,
+    }
+
+
+def bench_concurrent_misses(manager, keys, threads, count):
+    from parting import metrics
+    partition_keys = keys.take(count)
+    ready = threading.Event()
+    errors = []
+
+    def work():
+        ready.wait()
+        try:
+            for key in partition_keys:
+                manager.get_partition(key)
+        except Exception as e:
+            errors.append(e)
+
+    collector = metrics.MemoryMetrics()
+    previous = metrics.set_collector(collector)
+    try:
+        workers = [threading.Thread(target=work) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        start = timer()
+        ready.set()
+        for worker in workers:
+            worker.join()
+        seconds = timer() - start
+    finally:
+        metrics.set_collector(previous)
+    if errors:
+        raise errors[0]
+    label = manager._label
+    return {
+        'threads': threads,
+        'partitions': count,
+        'total': seconds,
+        'generated': len(collector.times(
+            'parting.partition.generate', model=label)),
+        'lock_wait': summarise(collector.times(
+            'parting.partition.lock_wait', model=label)),
+    }
+
+
+def bench_ensure_partition(manager, keys, sizes, repeat):
+    from django.core.management import call_command
+    model = 'benchapp.models.{}'.format(manager.model.__name__)
+    results = []
+    existing = 0
+    for size in sorted(sizes):
+        if size > existing:
+            new = keys.take(size - existing)
+            call_command(
+                'ensure_partition', model, first=new[0], last=new[-1],
+                verbosity=0)
+            existing = size
+        times = []
+        for key in keys.take(repeat):
+            start = timer()
+            call_command('ensure_partition', model, key, verbosity=0)
+            times.append(timer() - start)
+            existing += 1
+        result = summarise(times)
+        result['existing'] = size
+        results.append(result)
+    return results
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--postgresql', metavar='NAME',
+                      help='Benchmark against this PostgreSQL database')
+    parser.add_option('--hits', type='int', default=100000)
+    parser.add_option('--misses', type='int', default=200)
+    parser.add_option('--generate', type='int', default=1000)
+    parser.add_option('--threads', type='int', default=16)
+    parser.add_option('--concurrent', type='int', default=50,
+                      help='Partitions for the threads to generate')
+    parser.add_option('--ensure-sizes', default='0,100,1000',
+                      help='Comma separated numbers of existing partitions')
+    parser.add_option('--repeat', type='int', default=5)
+    options, _ = parser.parse_args()
+    configure(options)
+
+    import django
+    from django.db import connection
+    from benchapp.models import Parent0, Parent1, Parent10
+    keys = Keys()
+    report = {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'results': {},
+    }
+    results = report['results']
+    results['hit'] = bench_hit(Parent1.partitions, keys, options.hits)
+    for children, model in [(0, Parent0), (1, Parent1), (10, Parent10)]:
+        results['miss_{}_children'.format(children)] = bench_miss(
+            model.partitions, keys, options.misses)
+    results['generate_many'] = bench_generate_many(
+        Parent1.partitions, keys, options.generate)
+    results['concurrent_misses'] = bench_concurrent_misses(
+        Parent1.partitions, keys, options.threads, options.concurrent)
+
+    sizes = [int(s) for s in options.ensure_sizes.split(',') if s]
+    try:
+        results['ensure_partition'] = bench_ensure_partition(
+            Parent0.partitions, keys, sizes, options.repeat)
+    finally:
+        # Clean up the tables we created
+        Parent0.partitions.expire(keep=0)
+
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
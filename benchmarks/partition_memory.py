@@ -0,0 +1,81 @@
+""" Measure the memory retained by generated partition models, with and
+without a max_partitions cap.
+
+Run from the repository root:
+
+    python benchmarks/partition_memory.py --partitions 2000 --cap 100
+
+Prints a JSON report of the objects and approximate bytes retained per
+generated partition. Byte counts are the sum of sys.getsizeof() over the new
+objects tracked by the garbage collector, so they undercount (eg. strings
+aren't tracked), but they're good for comparisons.
+"""
+import gc
+import json
+import optparse
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'testproject')]
+
+from django.conf import settings
+
+settings.configure(
+    DATABASES={'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    }},
+    INSTALLED_APPS=['parting', 'testapp'],
+    USE_TZ=True,
+)
+
+
+def retained(func):
+    """ Call func, and return the number and approximate size of the objects
+    it left behind.
+    """
+    gc.collect()
+    before = set(id(o) for o in gc.get_objects())
+    func()
+    gc.collect()
+    objects = gc.get_objects()
+    new = [o for o in objects if id(o) not in before and o is not before]
+    return len(new), sum(sys.getsizeof(o) for o in new)
+
+
+def generate(manager, count, prefix):
+    def func():
+        for i in range(count):
+            manager.get_partition('{}{:06d}'.format(prefix, i))
+    return func
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--partitions', type='int', default=1000)
+    parser.add_option('--cap', type='int', default=100)
+    options, _ = parser.parse_args()
+
+    from testapp.models import Tweet
+    manager = Tweet.partitions
+    # Generate one partition first, so that one-off costs aren't counted
+    manager.get_partition('warmup')
+
+    report = {'partitions': options.partitions, 'cap': options.cap}
+    for label, cap, prefix in [('uncapped', None, 'u'),
+                               ('capped', options.cap, 'c')]:
+        manager.max_partitions = cap
+        objects, size = retained(generate(
+            manager, options.partitions, prefix))
+        report[label] = {
+            'retained_partitions': len(manager._partitions),
+            'objects': objects,
+            'bytes': size,
+            'bytes_per_partition': size // options.partitions,
+        }
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -1 +1,2 @@
-from .models import PartitionForeignKey, PartitionManager
+from .models import (
+    PartitionForeignKey, PartitionManager, dependency_graph, warm_partitions)
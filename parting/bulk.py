@@ -0,0 +1,630 @@
+import csv
+import gzip
+import itertools
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict, namedtuple
+from contextlib import closing
+from cStringIO import StringIO
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.color import no_style
+from django.db import connections, router, transaction
+from django.db.models import AutoField, Q
+from django.db.models.sql.datastructures import EmptyResultSet
+from . import ddl
+from .query import _filtered, fan_out, invalidate_aggregates
+
+logger = logging.getLogger(__file__)
+
+# Rows are streamed in chunks of this many, so that memory use doesn't depend
+# on the size of the table.
+DEFAULT_CHUNK_SIZE = 10000
+
+# Bulk updates and deletes change at most this many rows of a table per
+# statement, committing after each batch, so that no statement holds its
+# locks for long. This also keeps statements within SQLite's limit of 999
+# parameters.
+DEFAULT_BATCH_SIZE = 500
+
+# How NULL is written in archives. This matches PostgreSQL's text format, so
+# that archives are the same whichever backend wrote them. Note that when
+# loading on other backends, a string consisting of just \N is read as NULL.
+NULL = '\\N'
+
+TransferResult = namedtuple(
+    'TransferResult',
+    ['table', 'rows', 'bytes', 'seconds'])
+
+
+class _CountingFile(object):
+    # Wraps a file, counting the bytes read from or written to it
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.bytes = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.bytes += len(data)
+        return data
+
+    def readline(self, size=-1):
+        data = self.fileobj.readline(size)
+        self.bytes += len(data)
+        return data
+
+    def write(self, data):
+        self.bytes += len(data)
+        self.fileobj.write(data)
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _encode(value):
+    if value is None:
+        return NULL
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _columns(model):
+    return [f.column for f in model._meta.local_fields]
+
+
+def dump_table(model, using, fileobj, chunk_size=DEFAULT_CHUNK_SIZE):
+    """ Write the rows of model's table to fileobj as CSV, with a header row
+    of column names. On PostgreSQL this uses COPY TO STDOUT; elsewhere rows
+    are fetched chunk_size at a time. Returns a TransferResult.
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    table = model._meta.db_table
+    columns = _columns(model)
+    out = _CountingFile(fileobj)
+    start = time.time()
+    cursor = connection.cursor()
+    if connection.vendor == 'postgresql':
+        cursor.copy_expert(
+            "COPY {} ({}) TO STDOUT WITH CSV HEADER NULL '{}'".format(
+                qn(table),
+                ', '.join(qn(c) for c in columns),
+                NULL),
+            out)
+        rows = cursor.rowcount
+    else:
+        writer = csv.writer(out)
+        writer.writerow(columns)
+        cursor.execute('SELECT {} FROM {}'.format(
+            ', '.join(qn(c) for c in columns), qn(table)))
+        rows = 0
+        while True:
+            chunk = cursor.fetchmany(chunk_size)
+            if not chunk:
+                break
+            writer.writerows([_encode(v) for v in row] for row in chunk)
+            rows += len(chunk)
+    return TransferResult(table, rows, out.bytes, time.time() - start)
+
+
+def load_table(model, using, fileobj, chunk_size=DEFAULT_CHUNK_SIZE):
+    """ Load CSV written by dump_table() from fileobj into model's table. On
+    PostgreSQL this uses COPY FROM STDIN; elsewhere rows are inserted
+    chunk_size at a time. The rows are committed unless a transaction is
+    being managed. Returns a TransferResult.
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    table = model._meta.db_table
+    source = _CountingFile(fileobj)
+    start = time.time()
+    columns = next(csv.reader([source.readline()]))
+    cursor = connection.cursor()
+    if connection.vendor == 'postgresql':
+        cursor.copy_expert(
+            "COPY {} ({}) FROM STDIN WITH CSV NULL '{}'".format(
+                qn(table),
+                ', '.join(qn(c) for c in columns),
+                NULL),
+            source)
+        rows = cursor.rowcount
+        # Make sure new rows don't collide with the ids we just loaded
+        for statement in connection.ops.sequence_reset_sql(
+                no_style(), [model]):
+            cursor.execute(statement)
+    else:
+        rows = insert_rows(
+            model, using, columns, _decode_rows(model, columns, source),
+            chunk_size)
+    transaction.commit_unless_managed(using=using)
+    return TransferResult(table, rows, source.bytes, time.time() - start)
+
+
+def _fields(model, names):
+    # Look up model's fields by name, attname or column
+    fields = {}
+    for field in model._meta.local_fields:
+        fields[field.column] = fields[field.attname] = field
+        fields[field.name] = field
+    return [fields[name] for name in names]
+
+
+def _decode(field, value):
+    # Turn a value read from CSV back into a Python value for field
+    if value == NULL:
+        return None
+    return field.to_python(value.decode('utf-8'))
+
+
+def _decode_rows(model, columns, fileobj):
+    # Turn CSV rows from fileobj back into Python values
+    fields = _fields(model, columns)
+    for row in csv.reader(fileobj):
+        yield [_decode(field, value) for field, value in zip(fields, row)]
+
+
+def insert_rows(model, using, columns, rows, chunk_size=DEFAULT_CHUNK_SIZE):
+    """ Insert rows, an iterable of sequences of Python values for columns
+    (which may be field names or columns), into model's table, chunk_size
+    rows at a time. Each chunk is written with multi-row INSERT statements,
+    as large as the backend allows, if it supports them, and with one
+    executemany() otherwise. Returns the number of rows inserted.
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    fields = _fields(model, columns)
+    sql = 'INSERT INTO {} ({}) '.format(
+        qn(model._meta.db_table),
+        ', '.join(qn(f.column) for f in fields))
+    cursor = connection.cursor()
+    count = 0
+    for chunk in _chunks(rows, chunk_size):
+        params = [
+            [field.get_db_prep_save(value, connection=connection)
+             for field, value in zip(fields, row)]
+            for row in chunk]
+        if connection.features.has_bulk_insert:
+            # Backends limit the number of parameters in a statement
+            batch_size = max(connection.ops.bulk_batch_size(fields, params), 1)
+            for batch in _chunks(params, batch_size):
+                cursor.execute(
+                    sql + connection.ops.bulk_insert_sql(fields, len(batch)),
+                    [value for row in batch for value in row])
+        else:
+            cursor.executemany(
+                sql + 'VALUES ({})'.format(', '.join(['%s'] * len(fields))),
+                params)
+        count += len(chunk)
+    return count
+
+
+def copy_rows(model, using, columns, rows):
+    """ Insert rows, a list of sequences of Python values for columns
+    (which may be field names or columns), into model's table with a single
+    COPY FROM STDIN. This is only supported on PostgreSQL. Returns the number
+    of rows inserted.
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    fields = _fields(model, columns)
+    data = StringIO()
+    writer = csv.writer(data)
+    for row in rows:
+        writer.writerow([
+            _encode(field.get_db_prep_save(value, connection=connection))
+            for field, value in zip(fields, row)])
+    data.seek(0)
+    cursor = connection.cursor()
+    cursor.copy_expert(
+        "COPY {} ({}) FROM STDIN WITH CSV NULL '{}'".format(
+            qn(model._meta.db_table),
+            ', '.join(qn(f.column) for f in fields),
+            NULL),
+        data)
+    if any(isinstance(f, AutoField) for f in fields):
+        # Make sure new rows don't collide with the ids we just loaded
+        for statement in connection.ops.sequence_reset_sql(
+                no_style(), [model]):
+            cursor.execute(statement)
+    return len(rows)
+
+
+def load_rows(manager, rows, columns=None, using=None,
+              buffer_size=DEFAULT_CHUNK_SIZE):
+    """ Load rows into the partitions of manager's model, as determined by
+    its key_field, creating partitions and their tables as necessary. rows
+    may be an iterable of dicts, or of sequences of values for columns (a
+    list of field names), or a file of CSV whose first row is the column
+    names unless columns is given.
+
+    Rows are buffered per partition, and each buffer is written with COPY
+    on PostgreSQL, or a multi-row INSERT elsewhere, when it reaches
+    buffer_size rows, and committed unless a transaction is being managed.
+    Memory use therefore doesn't depend on the number of rows loaded.
+    Returns a dict of partition key -> number of rows loaded.
+    """
+    if manager.key_field is None:
+        raise ImproperlyConfigured(
+            '{} must declare a key_field to route rows to '
+            'partitions'.format(manager.__class__.__name__))
+    decode = hasattr(rows, 'read')
+    if decode:
+        rows = csv.reader(rows)
+        if columns is None:
+            columns = next(rows, [])
+    else:
+        rows = iter(rows)
+        first = next(rows, None)
+        if first is None:
+            return OrderedDict()
+        if isinstance(first, dict):
+            columns = columns or list(first)
+            rows = ([row[c] for c in columns] for row in itertools.chain(
+                [first], rows))
+        else:
+            rows = itertools.chain([first], rows)
+    if columns is None:
+        raise ValueError('columns must be given for rows of sequences')
+    columns = list(columns)
+    try:
+        key_index = columns.index(manager.key_field)
+    except ValueError:
+        raise ValueError('Rows must include {}'.format(manager.key_field))
+    key_field = manager.model._meta.get_field(manager.key_field)
+
+    buffers = OrderedDict()
+    loaded = OrderedDict()
+
+    def flush(partition_key):
+        model = manager.get_partition(partition_key)
+        alias = using or router.db_for_write(model)
+        manager.ensure_tables(partition_key, using=alias)
+        fields = _fields(model, columns)
+        # Fill in any fields with defaults which weren't given
+        defaults = [
+            f for f in model._meta.local_fields
+            if f not in fields and f.has_default()]
+        batch = []
+        for row in buffers.pop(partition_key):
+            if decode:
+                row = [_decode(f, value) for f, value in zip(fields, row)]
+            batch.append(list(row) + [f.get_default() for f in defaults])
+        names = columns + [f.name for f in defaults]
+        if connections[alias].vendor == 'postgresql':
+            count = copy_rows(model, alias, names, batch)
+        else:
+            count = insert_rows(model, alias, names, batch, len(batch))
+        transaction.commit_unless_managed(using=alias)
+        invalidate_aggregates(model, alias)
+        loaded[partition_key] = loaded.get(partition_key, 0) + count
+
+    # Work out partition keys a chunk of rows at a time, as the manager may
+    # be able to do so more cheaply than for each row
+    for chunk in _chunks(rows, buffer_size):
+        values = [row[key_index] for row in chunk]
+        if decode:
+            values = [_decode(key_field, value) for value in values]
+        for partition_key, row in zip(manager.keys_for_values(values), chunk):
+            buffer = buffers.setdefault(partition_key, [])
+            buffer.append(row)
+            if len(buffer) >= buffer_size:
+                flush(partition_key)
+    for partition_key in list(buffers):
+        flush(partition_key)
+    return loaded
+
+
+def _batches(queryset, batch_size):
+    # Yield the primary keys of queryset's rows in order, batch_size at a
+    # time. Each batch starts after the last key of the one before, which
+    # the caller has dealt with by then, so changed rows are never fetched
+    # again.
+    last = None
+    while True:
+        batch = queryset.order_by('pk')
+        if last is not None:
+            batch = batch.filter(pk__gt=last)
+        pks = list(batch.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return
+        yield pks
+        last = pks[-1]
+
+
+def _delete_pks(model, using, pks):
+    # Delete the rows of model's table with primary keys pks, without
+    # fetching them first. Returns the number of rows deleted.
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    cursor.execute('DELETE FROM {} WHERE {} IN ({})'.format(
+        qn(model._meta.db_table),
+        qn(model._meta.pk.column),
+        ', '.join(['%s'] * len(pks))), pks)
+    return cursor.rowcount
+
+
+def _reference_lookups(manager, target):
+    # The lookups which follow PartitionForeignKeys from the partitions of
+    # manager's model to those of target's model, eg. ['tweet']
+    lookups = []
+    for pfk in manager._partition_foreign_keys():
+        parent = pfk.to._partition_manager
+        if parent is target:
+            lookups.append(pfk.name)
+        else:
+            lookups.extend(
+                '{}__{}'.format(pfk.name, lookup)
+                for lookup in _reference_lookups(parent, target))
+    return lookups
+
+
+def _per_partition(manager, partition_keys, func, using, parallel,
+                   max_workers):
+    # Call func(partition_key, model, alias) for the partition for each of
+    # partition_keys whose table exists, in parallel if asked, and return
+    # an OrderedDict of partition key -> result.
+    partitions = []
+    recheck = set()
+    for partition_key in partition_keys:
+        model = manager.get_partition(partition_key)
+        alias = using or router.db_for_write(model)
+        if ddl.catalog.has_table(alias, model._meta.db_table, recheck):
+            partitions.append((partition_key, model, alias))
+
+    def run(partition):
+        return func(*partition)
+
+    if parallel:
+        results = fan_out(
+            run,
+            partitions,
+            max_workers=max_workers,
+            databases=set(alias for _, _, alias in partitions))
+    else:
+        results = [run(partition) for partition in partitions]
+    return OrderedDict(
+        (partition_key, result)
+        for (partition_key, _, _), result in zip(partitions, results))
+
+
+def update_rows(manager, partition_keys, filters, values, using=None,
+                batch_size=DEFAULT_BATCH_SIZE, parallel=False,
+                max_workers=None):
+    """ Set values on the rows matching filters (a dict of lookups or a Q
+    object) in the partitions of manager's model for each of partition_keys.
+    Partitions whose tables don't exist are skipped.
+
+    Each partition's rows are updated batch_size at a time, in primary key
+    order, and committed after each batch unless a transaction is being
+    managed. Pass parallel=True to update partitions at the same time, on up
+    to max_workers threads. Returns a dict of partition key -> number of
+    rows updated.
+    """
+    def update(partition_key, model, alias):
+        queryset = _filtered(model._default_manager.using(alias), filters)
+        count = 0
+        for pks in _batches(queryset, batch_size):
+            # Filter again, in case a row changed since we fetched its key
+            count += queryset.filter(pk__in=pks).update(**values)
+        if count:
+            invalidate_aggregates(model, alias)
+        return count
+
+    return _per_partition(
+        manager, partition_keys, update, using, parallel, max_workers)
+
+
+def delete_rows(manager, partition_keys, filters, using=None,
+                batch_size=DEFAULT_BATCH_SIZE, parallel=False,
+                max_workers=None):
+    """ Delete the rows matching filters (a dict of lookups or a Q object)
+    from the partitions of manager's model for each of partition_keys, along
+    with the rows of PartitionForeignKey children which refer to them,
+    directly or indirectly. Partitions whose tables don't exist are skipped.
+
+    Rows are deleted batch_size at a time, children before their parents,
+    and committed after each batch unless a transaction is being managed.
+    Rows are deleted with plain DELETE statements, so no signals are sent.
+    Pass parallel=True to delete from partitions at the same time, on up to
+    max_workers threads. Returns a dict of partition key -> number of rows
+    deleted from manager's model's partition.
+    """
+    children = [
+        (child, _reference_lookups(child, manager))
+        for child in reversed(manager._family_managers()[1:])]
+    recheck = set()
+
+    def delete(partition_key, model, alias):
+        # Only generate children which have tables, as Django would cascade
+        # its own deletes to them
+        family = []
+        for child, lookups in children:
+            table = child._table_for_partition(partition_key)
+            if ddl.catalog.has_table(alias, table, recheck):
+                family.append((child.get_partition(partition_key), lookups))
+        queryset = _filtered(model._default_manager.using(alias), filters)
+        count = 0
+        deleted = OrderedDict()
+        for pks in _batches(queryset, batch_size):
+            for partition, lookups in family:
+                references = Q()
+                for lookup in lookups:
+                    references |= Q(**{'{}__in'.format(lookup): pks})
+                child_pks = list(
+                    partition._default_manager.using(alias).filter(
+                        references).values_list('pk', flat=True))
+                for chunk in _chunks(child_pks, batch_size):
+                    deleted[partition] = deleted.get(
+                        partition, 0) + _delete_pks(partition, alias, chunk)
+            count += _delete_pks(model, alias, pks)
+            transaction.commit_unless_managed(using=alias)
+        for partition, rows in deleted.items():
+            if rows:
+                invalidate_aggregates(partition, alias)
+            logger.info('Deleted {} rows of {}'.format(
+                rows, partition._meta.db_table))
+        if count:
+            invalidate_aggregates(model, alias)
+        logger.info('Deleted {} rows of {}'.format(
+            count, model._meta.db_table))
+        return count
+
+    return _per_partition(
+        manager, partition_keys, delete, using, parallel, max_workers)
+
+
+def _stream_keyset(queryset, fields, chunk_size):
+    # Fetch queryset's rows chunk_size at a time, in primary key order, each
+    # chunk starting after the last key of the one before. Unlike slicing
+    # with OFFSET, each chunk costs the same however far in we are.
+    last = None
+    while True:
+        chunk = queryset.order_by('pk')
+        if last is not None:
+            chunk = chunk.filter(pk__gt=last)
+        if fields is None:
+            rows = list(chunk[:chunk_size])
+            if rows:
+                last = rows[-1].pk
+        else:
+            rows = list(chunk.values_list(*fields + ('pk',))[:chunk_size])
+            if rows:
+                last = rows[-1][-1]
+                rows = [row[:-1] for row in rows]
+        for row in rows:
+            yield row
+        if len(rows) < chunk_size:
+            return
+
+
+def _stream_named_cursor(queryset, fields, chunk_size):
+    # Fetch queryset's rows through a PostgreSQL named cursor, which keeps
+    # the results on the server and sends them chunk_size rows at a time.
+    # Without autocommit, the cursor only lasts as long as the transaction.
+    model = queryset.model
+    using = queryset.db
+    queryset = queryset.order_by('pk')
+    if fields is not None:
+        queryset = queryset.values_list(*fields)
+    try:
+        sql, params = queryset.query.get_compiler(using).as_sql()
+    except EmptyResultSet:
+        return
+    connection = connections[using]
+    # Make sure we're connected
+    connection.cursor()
+    cursor = connection.connection.cursor(
+        name='parting_stream_{}'.format(uuid.uuid4().hex),
+        withhold=connection.features.uses_autocommit)
+    cursor.itersize = chunk_size
+    try:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                return
+            for row in rows:
+                if fields is None:
+                    row = model(*row)
+                    row._state.db = using
+                    row._state.adding = False
+                yield row
+    finally:
+        cursor.close()
+
+
+def stream_rows(manager, partition_keys, filters=None, fields=None,
+                using=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """ Yield the rows matching filters (a dict of lookups or a Q object) in
+    the partitions of manager's model for each of partition_keys, a
+    partition at a time in the order given, and in primary key order within
+    each partition. Partitions whose tables don't exist are skipped.
+
+    Rows are model instances, or tuples of the values of fields if given.
+    They're fetched chunk_size at a time through a named (server side)
+    cursor on PostgreSQL, and with a query per chunk elsewhere, and aren't
+    cached, so memory use doesn't depend on the size of the partitions.
+    """
+    if fields is not None:
+        fields = tuple(fields)
+    recheck = set()
+    for partition_key in partition_keys:
+        model = manager.get_partition(partition_key)
+        alias = using or router.db_for_read(model)
+        if not ddl.catalog.has_table(alias, model._meta.db_table, recheck):
+            continue
+        queryset = _filtered(model._default_manager.using(alias), filters)
+        if connections[alias].vendor == 'postgresql':
+            rows = _stream_named_cursor(queryset, fields, chunk_size)
+        else:
+            rows = _stream_keyset(queryset, fields, chunk_size)
+        for row in rows:
+            yield row
+
+
+def _archive_path(directory, model):
+    return os.path.join(directory, '{}.csv.gz'.format(model._meta.db_table))
+
+
+def archive_partition(model, partition_key, directory, using=None,
+                      chunk_size=DEFAULT_CHUNK_SIZE):
+    """ Stream the partition of the partitioned model model for
+    partition_key, along with its PartitionForeignKey children, into a
+    gzipped CSV file per table in directory. Tables which don't exist are
+    skipped. Returns a TransferResult for each table written.
+    """
+    family = model._partition_manager._partition_family(partition_key)
+    using = using or router.db_for_read(family[0])
+    tables = ddl.catalog.refresh(using)
+    results = []
+    for partition in family:
+        if partition._meta.db_table not in tables:
+            continue
+        path = _archive_path(directory, partition)
+        with closing(gzip.open(path, 'wb')) as fileobj:
+            result = dump_table(partition, using, fileobj, chunk_size)
+        logger.info('Archived {} rows of {} to {} in {:.2f}s'.format(
+            result.rows, result.table, path, result.seconds))
+        results.append(result)
+    return results
+
+
+def restore_partition(model, partition_key, directory, using=None,
+                      chunk_size=DEFAULT_CHUNK_SIZE):
+    """ Load a partition archived by archive_partition() from directory,
+    creating its tables first if necessary. Parents are loaded before their
+    children, and each table is committed once it's loaded unless a
+    transaction is being managed. Returns a TransferResult for each table
+    loaded.
+    """
+    family = model._partition_manager._partition_family(partition_key)
+    archived = [
+        partition for partition in family
+        if os.path.exists(_archive_path(directory, partition))]
+    if not archived:
+        return []
+    using = using or router.db_for_write(family[0])
+    ddl.create_tables(family, using)
+    results = []
+    for partition in archived:
+        path = _archive_path(directory, partition)
+        with closing(gzip.open(path, 'rb')) as fileobj:
+            result = load_table(partition, using, fileobj, chunk_size)
+        invalidate_aggregates(partition, using)
+        logger.info('Restored {} rows of {} from {} in {:.2f}s'.format(
+            result.rows, result.table, path, result.seconds))
+        results.append(result)
+    return results
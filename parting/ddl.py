@@ -0,0 +1,409 @@
+import datetime
+import logging
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from decimal import Decimal
+from django.core.management.color import no_style
+from django.db import connections, transaction
+from django.db.models import AutoField, BigIntegerField, IntegerField
+from . import metrics
+
+logger = logging.getLogger(__file__)
+
+
+class TableCatalog(object):
+    """ A cache of the tables which exist in each database, so that checking
+    for a partition's table doesn't cost a query. Each database is introspected
+    the first time it's asked about, and then only when refresh() is called.
+    """
+
+    def __init__(self):
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def tables(self, using):
+        tables = self._tables.get(using)
+        if tables is None:
+            tables = self.refresh(using)
+        return tables
+
+    def refresh(self, using):
+        tables = set(connections[using].introspection.table_names())
+        with self._lock:
+            self._tables[using] = tables
+        return tables
+
+    def has_table(self, using, table_name, recheck=None):
+        """ Return True if table_name exists in the using database. A miss
+        is trusted unless recheck is given, a set of the aliases already
+        introspected again by the current operation: then the first miss on
+        each database introspects it again, in case another process has
+        created the table since we last looked.
+        """
+        if table_name in self.tables(using):
+            return True
+        if recheck is None or using in recheck:
+            return False
+        recheck.add(using)
+        return table_name in self.refresh(using)
+
+    def add(self, using, *table_names):
+        with self._lock:
+            self._tables.setdefault(using, set()).update(table_names)
+
+    def discard(self, using, *table_names):
+        with self._lock:
+            self._tables.get(using, set()).difference_update(table_names)
+
+    def clear(self):
+        with self._lock:
+            self._tables = {}
+
+catalog = TableCatalog()
+
+
+@contextmanager
+def advisory_lock(using, name):
+    """ Take a database-wide lock called name, so that only one process at a
+    time can run the block. On PostgreSQL this is a transaction-level advisory
+    lock, which is released when the current transaction ends. On other
+    backends this does nothing.
+    """
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        # Advisory locks are identified by an integer, so derive a stable
+        # one from the name.
+        key = zlib.crc32(name.encode('utf-8'))
+        cursor = connection.cursor()
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', [key])
+    yield
+
+
+def with_auto_created(models):
+    """ Return models, each followed by the automatically created through
+    models of its many-to-many fields, whose tables must be created (and
+    expired) along with its own.
+    """
+    result = []
+    for model in models:
+        result.append(model)
+        for field in model._meta.local_many_to_many:
+            through = field.rel.through
+            if through._meta.auto_created and through not in result:
+                result.append(through)
+    return result
+
+
+def sql_create_models(models, using, known_models=()):
+    """ Return a list of the SQL statements needed to create tables and
+    indexes for models. known_models are models whose tables already exist,
+    which the new tables may reference.
+    """
+    creation = connections[using].creation
+    style = no_style()
+    known_models = set(known_models)
+    pending_references = {}
+    statements = []
+    for model in models:
+        sql, references = creation.sql_create_model(model, style, known_models)
+        statements.extend(sql)
+        for refto, refs in references.items():
+            pending_references.setdefault(refto, []).extend(refs)
+            if refto in known_models:
+                statements.extend(creation.sql_for_pending_references(
+                    refto, style, pending_references))
+        statements.extend(creation.sql_for_pending_references(
+            model, style, pending_references))
+        known_models.add(model)
+    for model in models:
+        statements.extend(creation.sql_indexes_for_model(model, style))
+    if connections[using].vendor == 'sqlite':
+        # SQLite only lets us choose where ids start for AUTOINCREMENT keys
+        qn = connections[using].ops.quote_name
+        for model in filter(uses_global_ids, models):
+            column = qn(model._meta.pk.column)
+            statements = [
+                statement.replace(
+                    '{} integer NOT NULL PRIMARY KEY'.format(column),
+                    '{} integer NOT NULL PRIMARY KEY AUTOINCREMENT'.format(
+                        column))
+                if statement.startswith('CREATE TABLE {} '.format(
+                    qn(model._meta.db_table)))
+                else statement
+                for statement in statements]
+    return statements
+
+
+def sql_create_parent(model, using):
+    """ Return the SQL to create the natively partitioned parent table for
+    the partition model model, if it doesn't already exist. The parent table
+    has the same columns as the partition, but no constraints.
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    manager = model._partition_manager
+    columns = []
+    for field in model._meta.local_fields:
+        if isinstance(field, AutoField):
+            # The parent doesn't generate ids - each partition has its own
+            # sequence.
+            if uses_global_ids(model):
+                db_type = BigIntegerField().db_type(connection=connection)
+            else:
+                db_type = IntegerField().db_type(connection=connection)
+        else:
+            db_type = field.db_type(connection=connection)
+        if db_type is None:
+            continue
+        columns.append('{} {}{}'.format(
+            qn(field.column),
+            db_type,
+            '' if field.null else ' NOT NULL'))
+    column = model._meta.get_field(manager.get_partition_column()).column
+    return 'CREATE TABLE IF NOT EXISTS {} ({}) PARTITION BY {} ({});'.format(
+        qn(manager.model._meta.db_table),
+        ', '.join(columns),
+        manager.partition_method.upper(),
+        qn(column))
+
+
+def sql_attach_partition(model, using):
+    """ Return the SQL to attach the table for the partition model model to
+    its natively partitioned parent table, with bounds derived from its
+    partition key.
+    """
+    from .models import get_partition_key
+    qn = connections[using].ops.quote_name
+    manager = model._partition_manager
+    method = manager.partition_method.lower()
+    bounds = manager.partition_bounds(get_partition_key(model))
+    if bounds is None:
+        return 'ALTER TABLE {} ATTACH PARTITION {} DEFAULT;'.format(
+            qn(manager.model._meta.db_table),
+            qn(model._meta.db_table))
+    if method == 'range':
+        lower, upper = bounds
+        values = 'FROM ({}) TO ({})'.format(_literal(lower), _literal(upper))
+    elif method == 'list':
+        values = 'IN ({})'.format(', '.join(_literal(v) for v in bounds))
+    elif method == 'hash':
+        modulus, remainder = bounds
+        values = 'WITH (MODULUS {}, REMAINDER {})'.format(
+            int(modulus), int(remainder))
+    else:
+        raise ValueError(
+            'Unknown partition method {}'.format(manager.partition_method))
+    return 'ALTER TABLE {} ATTACH PARTITION {} FOR VALUES {};'.format(
+        qn(manager.model._meta.db_table),
+        qn(model._meta.db_table),
+        values)
+
+
+def uses_global_ids(model):
+    """ Return True if model is a partition whose manager allocates global
+    ids (see PartitionManager.global_ids).
+    """
+    from .models import get_partition_key
+    manager = getattr(model, '_partition_manager', None)
+    return (
+        manager is not None and
+        manager.global_ids and
+        get_partition_key(model, None) is not None and
+        isinstance(model._meta.pk, AutoField))
+
+
+def sql_global_ids(models, using):
+    """ Return the SQL to start the ids of any of models whose managers use
+    global ids at the start of their partition's range. On PostgreSQL,
+    these primary keys and any foreign keys to them are made 64 bit, and
+    sequences are limited to the range. Global ids are supported on
+    PostgreSQL and SQLite.
+    """
+    from .models import get_partition_key
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    statements = []
+    for model in filter(uses_global_ids, models):
+        table = model._meta.db_table
+        column = model._meta.pk.column
+        first, last = model._partition_manager.global_id_range(
+            get_partition_key(model))
+        if connection.vendor == 'postgresql':
+            statements.append(
+                'ALTER TABLE {} ALTER COLUMN {} TYPE bigint;'.format(
+                    qn(table), qn(column)))
+            statements.append(
+                'ALTER SEQUENCE {} AS bigint MINVALUE {} MAXVALUE {} '
+                'RESTART WITH {};'.format(
+                    qn('{}_{}_seq'.format(table, column)),
+                    first, last, first))
+        elif connection.vendor == 'sqlite':
+            statements.append(
+                'INSERT INTO sqlite_sequence (name, seq) '
+                'VALUES ({}, {});'.format(_literal(table), first - 1))
+        else:
+            raise NotImplementedError(
+                'Global ids are not supported on {}'.format(
+                    connection.vendor))
+    if connection.vendor == 'postgresql':
+        for model in models:
+            for field in model._meta.local_fields:
+                if field.rel is not None and uses_global_ids(field.rel.to):
+                    statements.append(
+                        'ALTER TABLE {} ALTER COLUMN {} TYPE bigint;'.format(
+                            qn(model._meta.db_table), qn(field.column)))
+    return statements
+
+
+def sql_native_partitioning(models, using):
+    """ Return the SQL to attach any of models whose managers use native
+    partitioning to their parent tables, creating the parents if necessary.
+    Native partitioning is only supported on PostgreSQL, and is ignored
+    elsewhere.
+    """
+    if connections[using].vendor != 'postgresql':
+        return []
+    statements = []
+    for model in models:
+        manager = getattr(model, '_partition_manager', None)
+        if manager is None or manager.partition_method is None:
+            continue
+        statement = sql_create_parent(model, using)
+        if statement not in statements:
+            statements.append(statement)
+        statements.append(sql_attach_partition(model, using))
+    return statements
+
+
+def sql_expire_models(models, using, mode='drop'):
+    """ Return the SQL to expire the tables for models, which should be
+    ordered so that models come after any models they reference. mode is one
+    of:
+
+    drop     - drop the tables
+    truncate - delete all rows from the tables, but keep them
+    detach   - detach the tables from their natively partitioned parents (if
+               any) and rename them with an 'expired_' prefix, so that they
+               are no longer treated as partitions
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    tables = [model._meta.db_table for model in reversed(models)]
+    if mode == 'drop':
+        return ['DROP TABLE {};'.format(qn(table)) for table in tables]
+    elif mode == 'truncate':
+        return connection.ops.sql_flush(no_style(), tables, ())
+    elif mode == 'detach':
+        statements = []
+        for model in reversed(models):
+            manager = getattr(model, '_partition_manager', None)
+            if (manager is not None and
+                    manager.partition_method is not None and
+                    connection.vendor == 'postgresql'):
+                statements.append(
+                    'ALTER TABLE {} DETACH PARTITION {};'.format(
+                        qn(manager.model._meta.db_table),
+                        qn(model._meta.db_table)))
+            statements.append('ALTER TABLE {} RENAME TO {};'.format(
+                qn(model._meta.db_table),
+                qn('expired_' + model._meta.db_table)))
+        return statements
+    raise ValueError('Unknown expiry mode {}'.format(mode))
+
+
+def table_size(using, table_name):
+    """ Return the total size on disk of table_name in bytes, including
+    indexes, or None if the backend can't tell us.
+    """
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return None
+    cursor = connection.cursor()
+    cursor.execute(
+        'SELECT pg_total_relation_size(%s)',
+        [connection.ops.quote_name(table_name)])
+    return cursor.fetchone()[0]
+
+
+def _literal(value):
+    # Render a partition bound as an SQL literal. Bounds can't be passed as
+    # query parameters, as the DDL may be printed rather than run.
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, (int, long, float, Decimal)):
+        return str(value)
+    if isinstance(value, (datetime.date, datetime.time)):
+        value = value.isoformat()
+    return "'{}'".format(unicode(value).replace("'", "''"))
+
+
+def create_tables(models, using, refresh=True):
+    """ Create tables for any of models which don't already have them, taking
+    an advisory lock so that concurrent processes don't race to do the same.
+    The tables of many-to-many through models are created too. Returns the
+    models whose tables were created.
+
+    Pass refresh=False to trust the catalog rather than introspecting the
+    database again. That's only safe if this transaction already holds the
+    lock, from an earlier call.
+    """
+    connection = connections[using]
+    models = with_auto_created(models)
+    with advisory_lock(using, 'parting.create_tables'):
+        # Another process may have created the tables while we waited
+        if refresh:
+            tables = catalog.refresh(using)
+        else:
+            tables = catalog.tables(using)
+        missing = [m for m in models if m._meta.db_table not in tables]
+        existing = [m for m in models if m._meta.db_table in tables]
+        if missing:
+            start = time.time()
+            cursor = connection.cursor()
+            statements = sql_create_models(missing, using, existing)
+            statements.extend(sql_global_ids(missing, using))
+            statements.extend(sql_native_partitioning(missing, using))
+            for statement in statements:
+                cursor.execute(statement)
+            if metrics.collector.enabled:
+                metrics.collector.timing(
+                    'parting.ddl.create_tables',
+                    time.time() - start,
+                    database=using)
+        transaction.commit_unless_managed(using=using)
+    catalog.add(using, *[m._meta.db_table for m in missing])
+    for model in missing:
+        logger.debug('Created table {} on {}'.format(
+            model._meta.db_table, using))
+    return missing
+
+
+def expire_tables(models, using, mode='drop'):
+    """ Expire the tables for any of models which exist, as described by
+    sql_expire_models(), taking the same advisory lock as create_tables() so
+    that tables aren't created and expired at the same time. The tables of
+    many-to-many through models go too. Returns the models whose tables were
+    expired.
+    """
+    connection = connections[using]
+    models = with_auto_created(models)
+    with advisory_lock(using, 'parting.create_tables'):
+        tables = catalog.refresh(using)
+        existing = [m for m in models if m._meta.db_table in tables]
+        if existing:
+            cursor = connection.cursor()
+            for statement in sql_expire_models(existing, using, mode):
+                cursor.execute(statement)
+        transaction.commit_unless_managed(using=using)
+    if mode != 'truncate':
+        catalog.discard(using, *[m._meta.db_table for m in existing])
+    if mode == 'detach':
+        catalog.add(using, *['expired_' + m._meta.db_table for m in existing])
+    for model in existing:
+        logger.debug('Expired table {} on {} ({})'.format(
+            model._meta.db_table, using, mode))
+    return existing
@@ -0,0 +1,66 @@
+import importlib
+import sys
+from contextlib import contextmanager
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+
+@contextmanager
+def commit_on_success_all(aliases):
+    """ Run the block in a transaction on each of aliases, committing them
+    all if it succeeds, and rolling them all back if it doesn't.
+    """
+    if not aliases:
+        yield
+        return
+    with transaction.commit_on_success(using=aliases[0]):
+        with commit_on_success_all(aliases[1:]):
+            yield
+
+
+class PartitionCommand(BaseCommand):
+    """ Base class for commands which take a partitioned model as their first
+    argument.
+    """
+
+    def get_model(self):
+        try:
+            model = self.args[0]
+        except IndexError:
+            raise CommandError(u'Please supply at least one partitioned model')
+
+        try:
+            module_name, model_name = model.rsplit('.', 1)
+        except ValueError:
+            raise CommandError('Bad model name {}'.format(model))
+
+        # So - we can't use get_model, because this will be an abstract model.
+        # Try to grab the model directly from the module.
+        module = importlib.import_module(module_name)
+        try:
+            m = getattr(module, model_name)
+        except AttributeError:
+            raise CommandError('Unknown model {}'.format(model))
+        return m
+
+    def _write(self, message, level=1):
+        # Write message to stdout if our verbosity is at least level
+        if int(self.options.get('verbosity', 1)) >= level:
+            stdout = getattr(self, 'stdout', None) or sys.stdout
+            stdout.write(message + '\n')
+
+    def _write_transfers(self, verb, results, seconds):
+        # Report the rows and bytes moved for each table, and the overall
+        # throughput
+        for result in results:
+            self._write('{} {} rows ({} bytes) of {} in {:.2f}s'.format(
+                verb, result.rows, result.bytes, result.table,
+                result.seconds), level=2)
+        rows = sum(result.rows for result in results)
+        size = sum(result.bytes for result in results)
+        seconds = max(seconds, 1e-6)
+        self._write(
+            '{} {} rows ({} bytes) from {} tables in {:.2f}s '
+            '({:.0f} rows/s, {:.0f} bytes/s)'.format(
+                verb, rows, size, len(results), seconds,
+                rows / seconds, size / seconds))
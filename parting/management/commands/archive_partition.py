@@ -0,0 +1,50 @@
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import router, transaction
+from parting import bulk, ddl
+from parting.management.base import PartitionCommand
+
+
+class Command(PartitionCommand):
+
+    args = '<model> <partition key>'
+    option_list = BaseCommand.option_list + (
+        make_option('-d', '--database', dest='database'),
+        make_option('--dir', dest='directory', default='.',
+                    help='Write archive files to this directory'),
+        make_option('--drop', dest='drop', action='store_true',
+                    help='Drop the partition tables once archived'),
+    )
+
+    def handle(self, *args, **options):
+        self.args = args
+        self.options = options
+        model = self.get_model()
+        database = self.options.get('database')
+        try:
+            partition_key = args[1]
+        except IndexError:
+            raise CommandError(u'Please supply a partition key')
+
+        start = time.time()
+        results = bulk.archive_partition(
+            model,
+            partition_key,
+            self.options.get('directory') or '.',
+            using=database)
+        if not results:
+            raise CommandError(
+                u'No tables found for partition {}'.format(partition_key))
+        self._write_transfers('Archived', results, time.time() - start)
+
+        if self.options.get('drop'):
+            manager = model._partition_manager
+            family = manager._partition_family(partition_key)
+            database = database or router.db_for_write(family[0])
+            with transaction.commit_on_success(using=database):
+                ddl.expire_tables(family, database, 'drop')
+            for partition in reversed(family):
+                partition._partition_manager._forget_partition(partition_key)
+            self._write('Dropped {}'.format(
+                ', '.join(r.table for r in results)))
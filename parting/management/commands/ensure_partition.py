@@ -1,16 +1,16 @@
-import importlib
 import logging
-from cStringIO import StringIO
-from django.core.management.commands import sqlall, syncdb
-from django.db import models
+import time
+from collections import OrderedDict
 from optparse import make_option
 from django.core.management.base import BaseCommand, CommandError
-from django.db import DEFAULT_DB_ALIAS
+from django.db import DEFAULT_DB_ALIAS, router, transaction
+from parting import ddl, metrics
+from parting.management.base import PartitionCommand
 
 logger = logging.getLogger(__file__)
 
 
-class Command(BaseCommand):
+class Command(PartitionCommand):
 
     option_list = BaseCommand.option_list + (
         make_option('-d', '--database', dest='database'),
@@ -18,7 +18,13 @@ class Command(BaseCommand):
                     action='store_true'),
         make_option('-n', '--next-only', dest='next_only',
                     action='store_true'),
-        make_option('--sqlall', dest='sqlall', action='store_true')
+        make_option('--sqlall', dest='sqlall', action='store_true'),
+        make_option('--from', dest='first',
+                    help='Ensure partitions from this key, inclusive'),
+        make_option('--to', dest='last',
+                    help='Ensure partitions up to this key, inclusive'),
+        make_option('--ahead', dest='ahead', type='int',
+                    help='Ensure the current partition and this many more'),
     )
 
     def handle(self, *args, **options):
@@ -26,40 +32,81 @@ class Command(BaseCommand):
         self.options = options
         model = self.get_model()
         database = self.options.get('database')
-        database = database if database else DEFAULT_DB_ALIAS
         only_sqlall = self.options.get('sqlall')
+        manager = model._partition_manager
 
-        # First, make sure all the partition models have been generated
+        start = time.time()
+
+        # First, make sure all the partition models have been generated, and
+        # work out which database each partition (and its children) lives on
+        families = OrderedDict()
         for partition_name in self.get_partition_names(model):
-            model._partition_manager.get_partition(partition_name)
+            family = manager._partition_family(partition_name)
+            alias = (
+                database or
+                manager.database_for_partition(partition_name) or
+                router.db_for_write(family[0]) or
+                DEFAULT_DB_ALIAS)
+            families.setdefault(alias, []).append((partition_name, family))
 
         if only_sqlall:
-            # We've been asked just to dump the SQL
-            sqlall_command = sqlall.Command()
-            self._setup_command(sqlall_command)
-            app = models.get_app(model._meta.app_label)
-            print(sqlall_command.handle_app(
-                app,
-                database=database
-            ))
+            # We've been asked just to dump the SQL for these partitions
+            for alias, alias_families in families.items():
+                if len(families) > 1:
+                    print('-- {}'.format(alias))
+                models = ddl.with_auto_created(
+                    [p for _, family in alias_families for p in family])
+                statements = ddl.sql_create_models(models, alias)
+                statements.extend(ddl.sql_global_ids(models, alias))
+                statements.extend(
+                    ddl.sql_native_partitioning(models, alias))
+                print('\n'.join(statements))
         else:
-            # Invoke syncdb directly. We don't use call_command, as South
-            # provides its own implementation which we don't want to use.
-            syncdb_command = syncdb.Command()
-            self._setup_command(syncdb_command)
-            syncdb_command.handle_noargs(
-                database=database,
-                interactive=False,
-                load_initial_data=False,
-                show_traceback=True,
-                verbosity=0,
-            )
+            # Only create the tables which are missing, rather than running
+            # a full syncdb over every model in the project. Each partition's
+            # DDL is run (and timed) separately, but in one transaction per
+            # database, so the catalog only needs refreshing once.
+            created = []
+            present = 0
+            for alias, alias_families in families.items():
+                with transaction.commit_on_success(using=alias):
+                    for i, (partition_name, family) in enumerate(
+                            alias_families):
+                        family_start = time.time()
+                        created_models = ddl.create_tables(
+                            family, alias, refresh=i == 0)
+                        seconds = time.time() - family_start
+                        if metrics.collector.enabled:
+                            metrics.collector.timing(
+                                'parting.ddl.partition',
+                                seconds,
+                                model=manager._label,
+                                partition=partition_name,
+                                database=alias)
+                        if created_models:
+                            created.append((family, seconds))
+                        else:
+                            present += 1
+
+            self._write(
+                'Created {} partitions, {} already present, in {:.2f}s'.format(
+                    len(created),
+                    present,
+                    time.time() - start))
+            for family, seconds in created:
+                self._write('Created {} in {:.2f}s'.format(
+                    ', '.join(p._meta.db_table for p in family),
+                    seconds), level=2)
 
     def get_partition_names(self, model):
-        current = model._partition_manager.current_partition_key
-        next = model._partition_manager.next_partition_key
+        manager = model._partition_manager
+        current = manager.current_partition_key
+        next = manager.next_partition_key
         current_only = self.options.get('current_only')
         next_only = self.options.get('next_only')
+        first = self.options.get('first')
+        last = self.options.get('last')
+        ahead = self.options.get('ahead')
 
         if current_only and next_only:
             raise CommandError(
@@ -70,7 +117,25 @@ class Command(BaseCommand):
         except IndexError:
             partition_names = None
 
-        if current_only:
+        ranged = first or last or ahead is not None
+        if ranged and (current_only or next_only or partition_names):
+            raise CommandError(
+                u'You cannot specify a range of partitions together with '
+                u'a single partition')
+        if bool(first) != bool(last):
+            raise CommandError(u'You must specify both --from and --to')
+        if first and ahead is not None:
+            raise CommandError(
+                u'You cannot specify --ahead together with --from and --to')
+
+        if first:
+            partition_names = manager.keys_between(first, last)
+        elif ahead is not None:
+            first = last = current()
+            for _ in range(ahead):
+                last = manager.key_after(last)
+            partition_names = manager.keys_between(first, last)
+        elif current_only:
             partition_names = [current()]
         elif next_only:
             partition_names = [next()]
@@ -79,28 +144,3 @@ class Command(BaseCommand):
             partition_names = [current(), next()]
 
         return partition_names
-
-    def get_model(self):
-        try:
-            model = self.args[0]
-        except IndexError:
-            raise CommandError(u'Please supply at least one partitioned model')
-
-        try:
-            module_name, model_name = model.rsplit('.', 1)
-        except ValueError:
-            raise CommandError('Bad model name {}'.format(model))
-
-        # So - we can't use get_model, because this will be an abstract model.
-        # Try to grab the model directly from the module.
-        module = importlib.import_module(module_name)
-        try:
-            m = getattr(module, model_name)
-        except AttributeError:
-            raise CommandError('Unknown model {}'.format(model))
-        return m
-
-    def _setup_command(self, c):
-        # Plumb some attributes normally set up by a base class directly onto
-        # the command
-        c.stdout = StringIO()
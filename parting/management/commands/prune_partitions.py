@@ -0,0 +1,58 @@
+import logging
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from parting.management.base import PartitionCommand, commit_on_success_all
+
+logger = logging.getLogger(__file__)
+
+
+class Command(PartitionCommand):
+
+    option_list = BaseCommand.option_list + (
+        make_option('-d', '--database', dest='database'),
+        make_option('--keep', dest='keep', type='int',
+                    help='Keep only this many of the newest partitions'),
+        make_option('--older-than', dest='older_than',
+                    help='Expire partitions with keys before this one'),
+        make_option('--mode', dest='mode', default='drop',
+                    type='choice', choices=['drop', 'truncate', 'detach'],
+                    help='drop, truncate or detach expired tables'),
+        make_option('--dry-run', dest='dry_run', action='store_true',
+                    help='List the tables which would be expired'),
+    )
+
+    def handle(self, *args, **options):
+        self.args = args
+        self.options = options
+        model = self.get_model()
+        manager = model._partition_manager
+        # Without --database, expire() looks at every database the placement
+        # policy uses
+        database = self.options.get('database')
+        keep = self.options.get('keep')
+        older_than = self.options.get('older_than')
+        dry_run = self.options.get('dry_run')
+
+        if keep is None and not older_than:
+            raise CommandError(u'You must specify --keep or --older-than')
+        if keep is not None and keep < 0:
+            raise CommandError(u'--keep cannot be negative')
+
+        with commit_on_success_all(
+                manager._databases(database, write=True)):
+            expired = manager.expire(
+                keep=keep,
+                older_than=older_than,
+                using=database,
+                mode=self.options.get('mode') or 'drop',
+                dry_run=dry_run)
+
+        # Always list the tables for a dry run, as that's the point of it
+        for table in expired:
+            size = '' if table.size is None else ' ({} bytes)'.format(
+                table.size)
+            self._write(
+                '{}{}'.format(table.table, size),
+                level=1 if dry_run else 2)
+        self._write('{} {} tables'.format(
+            'Would expire' if dry_run else 'Expired', len(expired)))
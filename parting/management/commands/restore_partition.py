@@ -0,0 +1,42 @@
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import router, transaction
+from parting import bulk
+from parting.management.base import PartitionCommand
+
+
+class Command(PartitionCommand):
+
+    args = '<model> <partition key>'
+    option_list = BaseCommand.option_list + (
+        make_option('-d', '--database', dest='database'),
+        make_option('--dir', dest='directory', default='.',
+                    help='Read archive files from this directory'),
+    )
+
+    def handle(self, *args, **options):
+        self.args = args
+        self.options = options
+        model = self.get_model()
+        database = self.options.get('database')
+        try:
+            partition_key = args[1]
+        except IndexError:
+            raise CommandError(u'Please supply a partition key')
+        # Without --database, restore the partition wherever its placement
+        # (or the database routers) put it
+        family = model._partition_manager._partition_family(partition_key)
+        database = database or router.db_for_write(family[0])
+
+        start = time.time()
+        with transaction.commit_on_success(using=database):
+            results = bulk.restore_partition(
+                model,
+                partition_key,
+                self.options.get('directory') or '.',
+                using=database)
+        if not results:
+            raise CommandError(
+                u'No archive found for partition {}'.format(partition_key))
+        self._write_transfers('Restored', results, time.time() - start)
@@ -0,0 +1,117 @@
+import importlib
+import threading
+from collections import defaultdict
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+# django-parting reports what it's doing to a metrics collector: an object
+# with increment(name, value=1, **tags) and timing(name, seconds, **tags)
+# methods, and an enabled attribute. Measurements are only taken if the
+# collector is enabled, so the default NullMetrics costs next to nothing.
+#
+# These metrics are reported, tagged with the partitioned model:
+#
+# parting.partition.hit       get_partition() found a cached partition
+# parting.partition.miss      get_partition() had to look further
+# parting.partition.lock_wait seconds spent waiting for a partition's lock
+# parting.partition.generate  seconds spent generating a partition
+# parting.partition.children  PartitionForeignKey children generated, tagged
+#                             with the parent model
+#
+# and, tagged with the database:
+#
+# parting.ddl.create_tables   seconds spent creating missing tables
+# parting.ddl.partition       seconds spent by ensure_partition on each
+#                             partition's DDL, also tagged with the key
+
+
+class NullMetrics(object):
+    """ Discards all measurements. """
+
+    enabled = False
+
+    def increment(self, name, value=1, **tags):
+        pass
+
+    def timing(self, name, seconds, **tags):
+        pass
+
+
+class MemoryMetrics(object):
+    """ Keeps all measurements in memory. Useful for tests. """
+
+    enabled = True
+
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.timings = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1, **tags):
+        with self._lock:
+            self.counters[name, _freeze(tags)] += value
+
+    def timing(self, name, seconds, **tags):
+        with self._lock:
+            self.timings[name, _freeze(tags)].append(seconds)
+
+    def count(self, name, **tags):
+        """ Return the total of the counter name, for measurements with (at
+        least) the given tags.
+        """
+        return sum(
+            value for (n, t), value in self.counters.items()
+            if n == name and _matches(t, tags))
+
+    def times(self, name, **tags):
+        """ Return the timings recorded for name, for measurements with (at
+        least) the given tags.
+        """
+        return [
+            seconds for (n, t), values in self.timings.items()
+            if n == name and _matches(t, tags)
+            for seconds in values]
+
+
+def _freeze(tags):
+    return tuple(sorted(tags.items()))
+
+
+def _matches(frozen, tags):
+    frozen = dict(frozen)
+    return all(frozen.get(k) == v for k, v in tags.items())
+
+
+collector = NullMetrics()
+_configured = False
+
+
+def configure():
+    """ Install the collector named by the PARTING_METRICS setting, if any.
+    This is called whenever a PartitionManager is declared, and only does
+    anything the first time.
+    """
+    global _configured
+    if _configured:
+        return
+    _configured = True
+    path = getattr(settings, 'PARTING_METRICS', None)
+    if path is None:
+        return
+    try:
+        module_name, class_name = path.rsplit('.', 1)
+        collector_class = getattr(
+            importlib.import_module(module_name), class_name)
+    except (ImportError, AttributeError, ValueError) as e:
+        raise ImproperlyConfigured(
+            'Error loading metrics collector {}: {}'.format(path, e))
+    set_collector(collector_class())
+
+
+def set_collector(new_collector):
+    """ Use new_collector for all measurements, and return the previous
+    collector.
+    """
+    global collector
+    previous, collector = collector, new_collector
+    return previous
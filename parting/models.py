@@ -1,9 +1,19 @@
-import imp
 import logging
 import sys
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, router
 from django.db.models import Manager, get_model
+from django.db.models.signals import pre_save
 from django.db.models.fields.related import ManyToOneRel
+from django.db.models.options import Options
 from dfk import DeferredForeignKey, point
+from . import bulk, ddl, metrics
+from .query import CrossPartitionQuerySet, paginate
+from .routers import install_router
 
 PARTITION_KEY = '_partition_key'
 
@@ -25,15 +35,172 @@ class PartitionRegistry(object):
         # in child_models_for polluting the structure. This keeps a mapping
         # of parent model -> list of partitioned foreign keys
         self.partitioned_targets = {}
+        # All the partition managers and foreign keys we know about, in
+        # registration order
+        self.managers = []
+        self.foreign_keys = []
+        # The dependency graph, and the families and lineages of models in
+        # it, are worked out when first needed, and again after anything new
+        # is registered.
+        self._lock = threading.RLock()
+        self._invalidate()
+
+    def __deepcopy__(self, memo):
+        # Fields referencing the registry get copied when partitions are
+        # generated, but the registry itself must be shared.
+        return self
 
     def register_foreign_key(self, fk):
-        self.partitioned_targets.setdefault(fk.to, []).append(fk)
+        with self._lock:
+            self.partitioned_targets.setdefault(fk.to, []).append(fk)
+            self.foreign_keys.append(fk)
+            self._invalidate()
+
+    def register_manager(self, manager):
+        with self._lock:
+            self.managers.append(manager)
+            self._invalidate()
 
     def foreign_keys_referencing(self, model):
         return self.partitioned_targets.get(model, [])
 
+    def dependency_graph(self):
+        """ Return an OrderedDict mapping each partitioned model to the
+        models with PartitionForeignKeys to it. Models are sorted so that
+        each comes before the models which depend on it. Raises
+        ImproperlyConfigured if the PartitionForeignKeys form a cycle.
+        """
+        with self._lock:
+            if self._graph is None:
+                self._graph = self._sorted_graph()
+            return self._graph
+
+    def dependents(self, model):
+        """ Return model, followed by every model which depends on it through
+        PartitionForeignKeys, directly or indirectly, in dependency order.
+        """
+        graph = self.dependency_graph()
+        with self._lock:
+            family = self._families.get(model)
+            if family is None:
+                found = set([model])
+                pending = [model]
+                while pending:
+                    for child in graph.get(pending.pop(), []):
+                        if child not in found:
+                            found.add(child)
+                            pending.append(child)
+                family = [m for m in graph if m in found] or [model]
+                self._families[model] = family
+            return family
+
+    def ancestors(self, model):
+        """ Return the models which model depends on through
+        PartitionForeignKeys, from the top-most down, followed by model.
+        """
+        graph = self.dependency_graph()
+        with self._lock:
+            lineage = self._lineages.get(model)
+            if lineage is None:
+                found = set([model])
+                parent = self._parents.get(model)
+                while parent is not None:
+                    found.add(parent)
+                    parent = self._parents.get(parent)
+                lineage = [m for m in graph if m in found] or [model]
+                self._lineages[model] = lineage
+            return lineage
+
+    def _invalidate(self):
+        self._graph = None
+        self._parents = {}
+        self._families = {}
+        self._lineages = {}
+
+    def _sorted_graph(self):
+        # Sort the models topologically (with Kahn's algorithm), keeping
+        # registration order where there's a choice
+        children = OrderedDict()
+        for manager in self.managers:
+            children.setdefault(manager.model, [])
+        for fk in self.foreign_keys:
+            children.setdefault(fk.to, [])
+            children.setdefault(fk.cls, [])
+            if fk.cls not in children[fk.to]:
+                children[fk.to].append(fk.cls)
+            self._parents[fk.cls] = fk.to
+
+        incoming = dict((model, 0) for model in children)
+        for model in children:
+            for child in children[model]:
+                incoming[child] += 1
+        ready = [model for model in children if not incoming[model]]
+        ordered = []
+        while ready:
+            model = ready.pop(0)
+            ordered.append(model)
+            for child in children[model]:
+                incoming[child] -= 1
+                if not incoming[child]:
+                    ready.append(child)
+
+        if len(ordered) < len(children):
+            raise ImproperlyConfigured(
+                'PartitionForeignKeys form a cycle between {}'.format(
+                    ', '.join(
+                        '{}.{}'.format(m.__module__, m.__name__)
+                        for m in children if incoming[m])))
+        return OrderedDict((model, children[model]) for model in ordered)
+
 _registry = PartitionRegistry()
 
+# Django's app cache isn't safe to update from several threads at once, so
+# generating partitions (which registers models and repoints foreign keys) is
+# serialised with this lock. Unlike the import lock, it doesn't block
+# unrelated imports.
+_app_cache_lock = threading.RLock()
+
+
+def dependency_graph(partition_registry=_registry):
+    """ Return the dependency graph of partitioned models, as an OrderedDict
+    mapping each model to the models with PartitionForeignKeys to it, in
+    the order their partitions are generated.
+    """
+    return partition_registry.dependency_graph()
+
+
+WarmResult = namedtuple('WarmResult', ['partitions', 'seconds'])
+
+# A partition table removed (or to be removed) by PartitionManager.expire().
+# size is in bytes, or None if the database can't tell us.
+ExpiredTable = namedtuple(
+    'ExpiredTable',
+    ['partition_key', 'table', 'size', 'database'])
+
+
+def warm_partitions(using=None, partition_registry=_registry):
+    """ Generate partition models for every partition table that already
+    exists, for all partitioned models. This runs a single catalog query per
+    database. Call it at startup (eg. from your wsgi.py) so that requests
+    don't pay the cost of generating partitions for existing data.
+
+    Returns a WarmResult of the generated partition models and the time
+    taken.
+    """
+    start = time.time()
+    table_names = {}
+    partitions = []
+    for manager in partition_registry.managers:
+        partitions.extend(manager.warm(
+            using=using,
+            table_names=table_names).partitions)
+    # Children may be found both through their parent and their own tables
+    partitions = list(OrderedDict.fromkeys(partitions))
+    result = WarmResult(partitions, time.time() - start)
+    logger.info('Warmed {} partitions in {:.3f}s'.format(
+        len(result.partitions), result.seconds))
+    return result
+
 
 class PartitionManager(object):
     """
@@ -41,8 +208,61 @@ class PartitionManager(object):
     a real manager, it just aims to 'feel' like one.
     """
 
-    def __init__(self, partition_registry=_registry):
+    # The name of the field whose value determines which partition a row
+    # belongs in. Needed for automatic routing, eg. by bulk_create().
+    key_field = None
+
+    # If True, tables for a partition (and its PartitionForeignKey children)
+    # are created the first time a row is written to it, if necessary.
+    auto_create_tables = False
+
+    # Set to 'range', 'list' or 'hash' to use PostgreSQL's native declarative
+    # partitioning: a parent table partitioned by partition_column (which
+    # defaults to key_field) is created, and each partition's table is
+    # attached to it with the bounds given by partition_bounds().
+    partition_method = None
+    partition_column = None
+
+    # A placement policy from parting.placement, deciding which database each
+    # partition lives on (see database_for_partition()).
+    placement = None
+
+    # How long, in seconds, to cache aggregates over closed partitions (see
+    # is_closed()). None uses the cache's default timeout.
+    aggregate_cache_timeout = None
+
+    # The most generated partition models to keep. When there are more, the
+    # least recently used are evicted from the app cache (along with their
+    # PartitionForeignKey children), and generated again if needed. None
+    # keeps them all.
+    max_partitions = None
+
+    # If True, each partition's primary keys are allocated from its own range
+    # of 64 bit ids, starting at partition_index() << global_id_bits, so that
+    # an id identifies its partition as well as its row (see
+    # get_by_global_id()). The range is set up when tables are created, on
+    # PostgreSQL or SQLite.
+    global_ids = False
+    global_id_bits = 32
+
+    def __init__(self, partition_registry=_registry, key_field=None,
+                 max_partitions=None):
         self.registry = partition_registry
+        if key_field is not None:
+            self.key_field = key_field
+        if max_partitions is not None:
+            self.max_partitions = max_partitions
+
+        # Generated partitions are cached by key, so that fetching an
+        # existing partition is just a dict lookup. Partitions are generated
+        # under a lock per key, so that concurrent requests for the same new
+        # partition wait for a single generation, while other keys proceed.
+        # The cache is kept in least recently used order if max_partitions
+        # is set.
+        self._partitions = OrderedDict()
+        self._partitions_lock = threading.Lock()
+        self._partition_locks = {}
+        self._partition_locks_lock = threading.Lock()
 
     def current_partition_key(self):
         """ Return the partition key for 'now'. No need to implement this if
@@ -56,6 +276,127 @@ class PartitionManager(object):
         """
         raise NotImplementedError()
 
+    def key_after(self, partition_key):
+        """ Return the partition key following partition_key. Needed to
+        work with ranges of partitions.
+        """
+        raise NotImplementedError()
+
+    def key_before(self, partition_key):
+        """ Return the partition key preceding partition_key. """
+        raise NotImplementedError()
+
+    def keys_between(self, first, last):
+        """ Return a list of the partition keys from first to last,
+        inclusive.
+        """
+        partition_keys = []
+        partition_key = first
+        while partition_key <= last:
+            partition_keys.append(partition_key)
+            partition_key = self.key_after(partition_key)
+        return partition_keys
+
+    def key_for_value(self, value):
+        """ Return the partition key for a value of key_field. Implement this
+        if you want django-parting to route rows to partitions for you.
+        """
+        raise NotImplementedError()
+
+    def keys_for_values(self, values):
+        """ Return a list of the partition keys for each of values. Override
+        this if keys can be computed for a batch of values more cheaply than
+        one at a time.
+        """
+        return [self.key_for_value(value) for value in values]
+
+    def partition_bounds(self, partition_key):
+        """ Return the bounds of values held by the partition for
+        partition_key, when partition_method is set. This should be a tuple of
+        (lower, upper) for 'range' partitioning, where lower is inclusive and
+        upper exclusive; an iterable of values for 'list' partitioning; or a
+        tuple of (modulus, remainder) for 'hash' partitioning. Return None
+        for the default partition, which holds rows no other partition does.
+        """
+        raise NotImplementedError()
+
+    def is_closed(self, partition_key):
+        """ Return True if no more rows will be written to the partition
+        for partition_key, so that aggregates over it can be cached. By
+        default, no partitions are closed.
+        """
+        return False
+
+    def database_for_partition(self, partition_key):
+        """ Return the alias of the database which the partition for
+        partition_key lives on, or None to leave it to the database routers.
+        PartitionForeignKey children always live with their parents, so this
+        is answered by the top-most partitioned model's manager, using its
+        placement policy.
+        """
+        root = self._root_manager()
+        if root is not self:
+            return root.database_for_partition(partition_key)
+        if self.placement is None:
+            return None
+        return self.placement.database_for(partition_key)
+
+    def partition_index(self, partition_key):
+        """ Return a non-negative integer identifying the partition for
+        partition_key, below 2 ** (63 - global_id_bits), for global ids. This
+        must never change. PartitionForeignKey children use their top-most
+        parent's indexes.
+        """
+        raise NotImplementedError()
+
+    def key_for_index(self, index):
+        """ Return the partition key for an index from partition_index() """
+        raise NotImplementedError()
+
+    def global_id_range(self, partition_key):
+        """ Return the first and last global ids of the partition for
+        partition_key.
+        """
+        start = (
+            self._root_manager().partition_index(partition_key) <<
+            self.global_id_bits)
+        return start + 1, start + (1 << self.global_id_bits) - 1
+
+    def partition_key_for_id(self, global_id):
+        """ Return the key of the partition holding global_id """
+        return self._root_manager().key_for_index(
+            global_id >> self.global_id_bits)
+
+    def get_by_global_id(self, global_id, using=None):
+        """ Fetch the row with primary key global_id, with a single query of
+        the partition it belongs to. Raises the partition's DoesNotExist if
+        there's no such row.
+        """
+        self._check_global_ids()
+        return self._global_id_queryset(
+            self.partition_key_for_id(global_id), using).get(pk=global_id)
+
+    def in_bulk(self, global_ids, using=None):
+        """ Return a dict of global id -> row for each of global_ids that
+        exists, with one query per partition they belong to.
+        """
+        self._check_global_ids()
+        grouped = OrderedDict()
+        for global_id in global_ids:
+            grouped.setdefault(
+                self.partition_key_for_id(global_id), []).append(global_id)
+        rows = {}
+        for partition_key, ids in grouped.items():
+            rows.update(self._global_id_queryset(
+                partition_key, using).in_bulk(ids))
+        return rows
+
+    def get_partition_column(self):
+        """ Return the name of the field the native parent table is
+        partitioned by.
+        """
+        return self.partition_column or self.key_field
+
     def get_managers(self, partition):
         """ Return an iterable of tuples of name, manager pairs, which will be
         added to all partitions in the given order. Order is important, as
@@ -72,20 +413,310 @@ class PartitionManager(object):
         """ Get the partition for this model for partition_key. By default,
         this will create the partition. Pass create=False to prevent this.
         """
-        app_label = self.model._meta.app_label
-        model_name = self._model_name_for_partition(partition_key)
-        model = get_model(app_label, model_name)
-        if model is None and create:
-            return self._ensure_partition(partition_key)
-        else:
+        model = self._partitions.get(partition_key)
+        if model is not None:
+            if self.max_partitions is not None:
+                self._touch_partition(partition_key)
+            if metrics.collector.enabled:
+                metrics.collector.increment(
+                    'parting.partition.hit', model=self._label)
             return model
 
+        collector = metrics.collector
+        if collector.enabled:
+            collector.increment('parting.partition.miss', model=self._label)
+            start = time.time()
+        with self._locked_lineage(partition_key):
+            if collector.enabled:
+                collector.timing(
+                    'parting.partition.lock_wait',
+                    time.time() - start,
+                    model=self._label)
+            # Another thread may have generated the partition while we were
+            # waiting for the lock. Models only appear in our cache once
+            # they're completely generated, but the app cache has them as
+            # soon as their class is created, so only look there while
+            # holding the lock.
+            model = self._find_partition(partition_key)
+            if model is None and create:
+                model = self._ensure_partition(partition_key)
+
+        # Evicting takes other partitions' locks, so mustn't be done while
+        # holding this one.
+        if self.max_partitions is not None:
+            self._evict_cold_partitions()
+        return model
+
+    def get_partition_for_value(self, value, create=True):
+        """ Get the partition that a row whose key_field has the given value
+        belongs in.
+        """
+        return self.get_partition(self.key_for_value(value), create=create)
+
+    def create(self, **kwargs):
+        """ Create and save a row in the appropriate partition, as
+        determined by key_field.
+        """
+        model = self.get_partition_for_value(self._key_value(kwargs))
+        return model._default_manager.create(**kwargs)
+
+    def bulk_create(self, objs, batch_size=None):
+        """ Insert objs, which may be model instances or dicts of field
+        values, into the appropriate partitions as determined by key_field.
+
+        Rows are grouped by partition key in a single pass, so each partition
+        is only looked up once and receives a single bulk_create() call.
+        Returns the list of created instances, grouped by partition.
+        """
+        objs = list(objs)
+        partition_keys = self.keys_for_values(
+            [self._key_value(obj) for obj in objs])
+        rows_by_key = OrderedDict()
+        for partition_key, obj in zip(partition_keys, objs):
+            rows_by_key.setdefault(partition_key, []).append(obj)
+
+        created = []
+        for partition_key, rows in rows_by_key.items():
+            model = self.get_partition(partition_key)
+            if self.auto_create_tables:
+                self.ensure_tables(
+                    partition_key,
+                    using=router.db_for_write(model))
+            instances = [self._instance_for(model, row) for row in rows]
+            model._default_manager.bulk_create(
+                instances,
+                batch_size=batch_size)
+            created.extend(instances)
+        return created
+
+    def bulk_load(self, rows, columns=None, using=None,
+                  buffer_size=bulk.DEFAULT_CHUNK_SIZE):
+        """ Load a large number of rows into the appropriate partitions, as
+        determined by key_field, without creating model instances. rows may
+        be an iterable of dicts, an iterable of sequences of values for
+        columns, or a file of CSV. Partitions and their tables are created as
+        necessary.
+
+        Rows are written with COPY on PostgreSQL, and multi-row INSERTs
+        elsewhere, buffer_size rows per partition at a time, so memory use
+        stays flat however many rows are loaded. Returns a dict of partition
+        key -> number of rows loaded.
+        """
+        return bulk.load_rows(
+            self,
+            rows,
+            columns=columns,
+            using=using,
+            buffer_size=buffer_size)
+
+    def update(self, partition_keys, filters=None, using=None,
+               batch_size=bulk.DEFAULT_BATCH_SIZE, parallel=False,
+               max_workers=None, **values):
+        """ Set values on the rows matching filters, a dict of lookups or a
+        Q object, in the partitions for each of partition_keys.
+
+        Each partition is updated batch_size rows at a time, committing after
+        each batch, so that no statement holds locks for long. Pass
+        parallel=True to update partitions in parallel, as across() does.
+        Returns a dict of partition key -> number of rows updated.
+        """
+        return bulk.update_rows(
+            self,
+            partition_keys,
+            filters,
+            values,
+            using=using,
+            batch_size=batch_size,
+            parallel=parallel,
+            max_workers=max_workers)
+
+    def delete(self, partition_keys, filters=None, using=None,
+               batch_size=bulk.DEFAULT_BATCH_SIZE, parallel=False,
+               max_workers=None):
+        """ Delete the rows matching filters, a dict of lookups or a Q
+        object, from the partitions for each of partition_keys, along with
+        the rows of PartitionForeignKey children referring to them.
+
+        Rows are deleted batch_size at a time, children first, committing
+        after each batch. Pass parallel=True to delete from partitions in
+        parallel. Returns a dict of partition key -> number of rows deleted
+        (not counting children).
+        """
+        return bulk.delete_rows(
+            self,
+            partition_keys,
+            filters,
+            using=using,
+            batch_size=batch_size,
+            parallel=parallel,
+            max_workers=max_workers)
+
+    def stream(self, partition_keys, filters=None, fields=None, using=None,
+               chunk_size=bulk.DEFAULT_CHUNK_SIZE):
+        """ Iterate over the rows matching filters, a dict of lookups or a Q
+        object, in the partitions for each of partition_keys, one partition
+        after another, in primary key order within each. Yields model
+        instances, or tuples of the values of fields if given.
+
+        Rows are fetched chunk_size at a time (with a server side cursor on
+        PostgreSQL) and never cached, so memory use stays flat however big
+        the partitions are.
+        """
+        return bulk.stream_rows(
+            self,
+            partition_keys,
+            filters=filters,
+            fields=fields,
+            using=using,
+            chunk_size=chunk_size)
+
+    def ensure_tables(self, partition_key, using=None):
+        """ Make sure that the tables for the partition_key partition, and
+        its PartitionForeignKey children and parents, exist in the using
+        database. Existing tables are tracked in a cached catalog, so this
+        doesn't query the database unless a table is missing.
+
+        Returns the partition models whose tables were created.
+        """
+        root = self._root_manager()
+        family = root._partition_family(partition_key)
+        using = (
+            using or
+            root.database_for_partition(partition_key) or
+            router.db_for_write(family[0]))
+        for model in ddl.with_auto_created(family):
+            if not ddl.catalog.has_table(using, model._meta.db_table):
+                break
+        else:
+            return []
+        return ddl.create_tables(family, using)
+
+    def warm(self, using=None, table_names=None):
+        """ Generate partition models, including any PartitionForeignKey
+        children, for every partition table of this model that exists in the
+        database (or every database its placement policy uses, if using isn't
+        given). Returns a WarmResult of the generated partition models and
+        the time taken.
+
+        Partition keys are recovered from table names, which are lower case,
+        so this is only useful if your partition keys are too.
+
+        table_names is a cache of database alias -> table names, which can be
+        shared between calls so that each database is only introspected once.
+        """
+        start = time.time()
+        if table_names is None:
+            table_names = {}
+        partitions = []
+        for alias in self._databases(using):
+            if alias not in table_names:
+                # Share what we find with the table catalog, so that it
+                # needn't introspect the database again
+                table_names[alias] = ddl.catalog.refresh(alias)
+            for partition_key in self._keys_for_tables(table_names[alias]):
+                for model in self._partition_family(partition_key):
+                    if model not in partitions:
+                        partitions.append(model)
+
+        result = WarmResult(partitions, time.time() - start)
+        logger.debug('Warmed {} partitions of {} in {:.3f}s'.format(
+            len(result.partitions), self.model, result.seconds))
+        return result
+
+    def expire(self, keep=None, older_than=None, using=None, mode='drop',
+               dry_run=False):
+        """ Expire old partitions of this model, along with those of any
+        PartitionForeignKey children, whole tables at a time. Pass keep to
+        keep only the newest keep partitions, and/or older_than to expire
+        partitions whose keys sort before it. Partition keys must sort in
+        age order (as eg. '2013_03' does).
+
+        mode is 'drop' to drop the tables, 'truncate' to empty them, or
+        'detach' to detach them from any native parent table and rename them
+        with an 'expired_' prefix. Dropped and detached partitions are
+        removed from their models module and the app cache. Pass dry_run=True
+        to see what would be expired without changing anything.
+
+        Returns a list of ExpiredTable, children (and the through tables of
+        many-to-many fields) first.
+        """
+        if keep is None and older_than is None:
+            raise ValueError('expire() needs keep or older_than')
+        if mode not in ('drop', 'truncate', 'detach'):
+            raise ValueError('Unknown expiry mode {}'.format(mode))
+        placed = {}
+        for alias in self._databases(using, write=True):
+            tables = ddl.catalog.refresh(alias)
+            for partition_key in self._keys_for_tables(tables):
+                placed.setdefault(partition_key, []).append(alias)
+        partition_keys = sorted(placed)
+        if keep is not None:
+            count = max(len(partition_keys) - keep, 0)
+            partition_keys = partition_keys[:count]
+        if older_than is not None:
+            partition_keys = [k for k in partition_keys if k < older_than]
+
+        expired = []
+        for partition_key in partition_keys:
+            family = self._partition_family(partition_key)
+            for alias in placed[partition_key]:
+                for model in reversed(ddl.with_auto_created(family)):
+                    table = model._meta.db_table
+                    if ddl.catalog.has_table(alias, table):
+                        expired.append(ExpiredTable(
+                            partition_key, table,
+                            ddl.table_size(alias, table), alias))
+                if not dry_run:
+                    ddl.expire_tables(family, alias, mode)
+            if dry_run:
+                continue
+            if mode != 'truncate':
+                for model in reversed(family):
+                    model._partition_manager._forget_partition(partition_key)
+            logger.info('Expired partition {} of {} ({})'.format(
+                partition_key, self.model, mode))
+        return expired
+
+    def across(self, partition_keys, using=None):
+        """ Return a lazy, QuerySet-like object spanning the partitions for
+        each of partition_keys. Supports filter(), exclude(), order_by() and
+        slicing; ordered results are merged from each partition as a stream.
+        """
+        return CrossPartitionQuerySet(self, partition_keys, using=using)
+
+    def aggregate(self, partition_keys, *args, **kwargs):
+        """ Aggregate over the partitions for each of partition_keys,
+        caching the results for closed partitions. A shortcut for
+        across(partition_keys).aggregate(*args, **kwargs).
+        """
+        return self.across(partition_keys).aggregate(*args, **kwargs)
+
+    def paginate(self, partition_keys, token=None, filters=None, per_page=20,
+                 order_field=None, using=None):
+        """ Return a Page of rows from the partitions for partition_keys,
+        newest first: ordered by order_field (key_field by default) and
+        primary key, both descending, from the last partition back to the
+        first. Pass the page's next_token to get the next page, which is
+        fetched from where this one finished, so deep pages cost the same as
+        the first.
+        """
+        return paginate(
+            self,
+            partition_keys,
+            token=token,
+            filters=filters,
+            per_page=per_page,
+            order_field=order_field,
+            using=using)
+
     def _ensure_partition(self, partition_key):
-        # Actually do the legwork for generating a partition
+        # Actually do the legwork for generating a partition. Callers must
+        # hold the locks for partition_key of ourself and our parents (see
+        # _locked_lineage()).
         logger.debug('Partition not found, generating')
+        start = time.time()
         model_name = self._model_name_for_partition(partition_key)
-        imp.acquire_lock()
-        try:
+        with _app_cache_lock:
             model = create_model(
                 model_name,
                 bases=(self.model,),
@@ -105,37 +736,77 @@ class PartitionManager(object):
                 raise AttributeError('{} already exists in {}'.format(
                     model_name, module))
 
-            logger.debug(
-                '{} generated, processing PartitionForeignKeys'.format(
-                    model))
-
-            # Find any PartitionForeignKeys that point to our parent model,
-            # and generate partitions of those source models
-            pfks_to_remove = set()
-            for pfk in self.registry.foreign_keys_referencing(self.model):
-                if not hasattr(pfk.cls, '_partition_manager'):
-                    raise AttributeError(
-                        'Source model {} does not have a partition '
-                        'manager'.format(pfk.cls))
-                child = pfk.cls._partition_manager.get_partition(partition_key)
-
-                # Replace the placeholder with a real foreign key, and
-                # make sure internal caches are populated correctly
-                point(child, pfk.name, model, **pfk.kwargs)
-                pfks_to_remove.add(pfk)
-                self._fill_fields_cache(child._meta)
-
-            # Make sure that there are no pfks hanging around
-            for pkf in pfks_to_remove:
-                for lst in (child._meta.fields, child._meta.local_fields):
-                    for field in lst:
-                        if field.name == pkf.name and isinstance(
-                                field,
-                                PartitionForeignKey):
-                            lst.remove(field)
-                            break
-        finally:
-            imp.release_lock()
+        # Point our PartitionForeignKeys at the parent partition, generating
+        # it if necessary. Callers hold the parent's lock as well as ours,
+        # so it can't be evicted while we do so.
+        pfks = self._partition_foreign_keys()
+        if pfks:
+            parent_manager = pfks[0].to._partition_manager
+            parent = parent_manager.get_partition(partition_key)
+            logger.debug('{} generated, pointing PartitionForeignKeys '
+                         'at {}'.format(model, parent))
+            with _app_cache_lock:
+                # Replace the placeholders with real foreign keys, and make
+                # sure internal caches are populated correctly
+                for pfk in pfks:
+                    point(
+                        model, pfk.name, parent, clean_caches=False,
+                        **pfk.kwargs)
+                self._fill_fields_cache(model._meta)
+                # Rather than rebuilding the related object caches of both
+                # models now, which means scanning every model in the app
+                # cache, discard them so that Django rebuilds them if
+                # they're ever needed.
+                _clear_related_caches(model._meta)
+                _clear_related_caches(parent._meta)
+
+                # Make sure that there are no pfks hanging around
+                for lst in (model._meta.fields, model._meta.local_fields):
+                    lst[:] = [
+                        f for f in lst
+                        if not isinstance(f, PartitionForeignKey)]
+            if metrics.collector.enabled:
+                metrics.collector.increment(
+                    'parting.partition.children', model=parent_manager._label)
+
+        # Partitions of models with PartitionForeignKeys to us are only
+        # generated when they're first needed. Until then, stand in for
+        # their reverse relations, so that touching one generates the child.
+        child_managers = []
+        for pfk in self.registry.foreign_keys_referencing(self.model):
+            if not hasattr(pfk.cls, '_partition_manager'):
+                raise AttributeError(
+                    'Source model {} does not have a partition '
+                    'manager'.format(pfk.cls))
+            child_manager = pfk.cls._partition_manager
+            if child_manager not in child_managers:
+                child_managers.append(child_manager)
+            name = child_manager._related_accessor_name(pfk, partition_key)
+            if name is not None:
+                setattr(model, name, _LazyRelatedDescriptor(
+                    child_manager, partition_key, name))
+
+        # Django only cascades deletes to, and follows reverse lookups into,
+        # models in the app cache. So when it first needs our related
+        # objects, generate the children which may have rows.
+        if child_managers:
+            model._meta._fill_related_objects_cache = _ChildrenFirst(
+                self, partition_key, child_managers, model._meta)
+
+        if self.auto_create_tables:
+            pre_save.connect(
+                self._ensure_tables_for_save,
+                sender=model,
+                weak=False)
+
+        self._remember_partition(partition_key, model)
+        collector = metrics.collector
+        if collector.enabled:
+            # Note that this includes the time taken to generate the parent
+            collector.timing(
+                'parting.partition.generate',
+                time.time() - start,
+                model=self._label)
 
         return model
 
@@ -146,12 +817,19 @@ class PartitionManager(object):
                 u'Partitioned model {} must be abstract.'.format(model._meta))
 
         self.model = model
+        self._label = '{}.{}'.format(
+            model._meta.app_label, model._meta.object_name)
         setattr(model, name, self)
 
         # We also have to keep a reference to ourself in a standard attribute
         # name, so that ensure_partition can find us when processing partition
         # foriengn keys
         model._partition_manager = self
+        self.registry.register_manager(self)
+
+        # Route each partition to the database its placement policy chooses
+        install_router()
+        metrics.configure()
 
     # Private stuff
     def _model_name_for_partition(self, partition_key):
@@ -159,6 +837,267 @@ class PartitionManager(object):
             self.model._meta.object_name,
             partition_key)
 
+    def _table_for_partition(self, partition_key):
+        # The name of the partition's table, without generating it
+        return '{}_{}'.format(
+            self.model._meta.app_label,
+            self._model_name_for_partition(partition_key).lower())
+
+    def _generate_children(self, partition_key, child_managers):
+        # Generate the partitions for partition_key of child_managers' models
+        # whose tables exist. This runs whenever Django builds a partition's
+        # related objects, including for ordinary lookups, so it trusts the
+        # table catalog rather than querying the database.
+        using = (
+            self.database_for_partition(partition_key) or
+            router.db_for_write(self.model))
+        for child_manager in child_managers:
+            table = child_manager._table_for_partition(partition_key)
+            if ddl.catalog.has_table(using, table):
+                child_manager.get_partition(partition_key)
+
+    def _ensure_tables_for_save(self, sender, using, **kwargs):
+        # pre_save receiver for partitions, when auto_create_tables is on.
+        # Signals identify senders by id(), so this may also be called for
+        # a partition generated since auto_create_tables was turned off.
+        if self.auto_create_tables:
+            self.ensure_tables(get_partition_key(sender), using=using)
+
+    def _forget_partition(self, partition_key):
+        # Remove a generated partition from our cache, its models module and
+        # the app cache, once its table has gone.
+        from django.db.models.loading import cache
+        with self._locked(partition_key), _app_cache_lock:
+            with self._partitions_lock:
+                model = self._partitions.pop(partition_key, None)
+            if model is None:
+                model = get_model(
+                    self.model._meta.app_label,
+                    self._model_name_for_partition(partition_key))
+            if model is None:
+                return
+            pre_save.disconnect(self._ensure_tables_for_save, sender=model)
+            module = sys.modules[model.__module__]
+            if getattr(module, model.__name__, None) is model:
+                delattr(module, model.__name__)
+            # The through models of its many-to-many fields go too
+            for generated in ddl.with_auto_created([model]):
+                cache.app_models.get(generated._meta.app_label, {}).pop(
+                    generated._meta.object_name.lower(), None)
+            cache._get_models_cache.clear()
+
+            # Partitions we point to may have cached us as a related object
+            for field in model._meta.local_fields:
+                if field.rel is None or not hasattr(field.rel.to, '_meta'):
+                    continue
+                _clear_related_caches(field.rel.to._meta)
+
+    def _evict_partition(self, partition_key):
+        # Forget the partitions for partition_key of our model and the models
+        # which depend on it, taking their locks in dependency order, as when
+        # generating partitions.
+        managers = self._family_managers()
+        with _locked_all(managers, partition_key):
+            for manager in reversed(managers):
+                manager._forget_partition(partition_key)
+            # Don't keep a lock around for every partition we've ever seen.
+            # Anyone already waiting for it will notice it's gone, and use
+            # the new one.
+            for manager in managers:
+                with manager._partition_locks_lock:
+                    manager._partition_locks.pop(partition_key, None)
+
+    def _evict_cold_partitions(self):
+        # Evict the least recently used partitions until we're within
+        # max_partitions.
+        while True:
+            with self._partitions_lock:
+                if len(self._partitions) <= self.max_partitions:
+                    return
+                partition_key = next(iter(self._partitions))
+            logger.debug('Evicting partition {} of {}'.format(
+                partition_key, self.model))
+            self._evict_partition(partition_key)
+
+    def _remember_partition(self, partition_key, model):
+        with self._partitions_lock:
+            self._partitions[partition_key] = model
+
+    def _touch_partition(self, partition_key):
+        # Mark partition_key as the most recently used partition
+        with self._partitions_lock:
+            model = self._partitions.pop(partition_key, None)
+            if model is not None:
+                self._partitions[partition_key] = model
+
+    def _partition_foreign_keys(self):
+        # The PartitionForeignKeys declared on our model. These are the same
+        # for every partition, so only look for them once.
+        pfks = self.__dict__.get('_pfks')
+        if pfks is None:
+            pfks = self._pfks = [
+                f for f in self.model._meta.local_fields
+                if isinstance(f, PartitionForeignKey)]
+        return pfks
+
+    def _lineage(self):
+        # Our ancestors' partition managers, from the top-most down, and
+        # then ourself
+        return [
+            model._partition_manager
+            for model in self.registry.ancestors(self.model)]
+
+    def _family_managers(self):
+        # Our partition manager, followed by those of the models which depend
+        # on ours, in dependency order
+        managers = []
+        for model in self.registry.dependents(self.model):
+            if not hasattr(model, '_partition_manager'):
+                raise AttributeError(
+                    'Source model {} does not have a partition '
+                    'manager'.format(model))
+            managers.append(model._partition_manager)
+        return managers
+
+    def _related_accessor_name(self, pfk, partition_key):
+        # The name of the reverse relation which pfk will add to the parent
+        # partition, once our partition for partition_key is generated, or
+        # None if it won't have one
+        related_name = pfk.kwargs.get('related_name')
+        model_name = self._model_name_for_partition(partition_key)
+        if related_name is None:
+            return '{}_set'.format(model_name.lower())
+        if related_name.endswith('+'):
+            return None
+        return related_name % {
+            'class': model_name.lower(),
+            'app_label': self.model._meta.app_label.lower(),
+        }
+
+    def _root_manager(self):
+        # The partition manager of the top-most partitioned model we depend on
+        return self._lineage()[0]
+
+    def _partition_family(self, partition_key):
+        """ Return the partition for partition_key, followed by the
+        partitions of all models with PartitionForeignKeys pointing to it,
+        directly or indirectly. They're generated in dependency order, so
+        each partition's parent is already there when it's generated.
+        """
+        return [
+            manager.get_partition(partition_key)
+            for manager in self._family_managers()]
+
+    def _databases(self, using=None, write=False):
+        # The databases which partitions of our model may live on: using if
+        # given, otherwise every database our placement policy uses, plus
+        # the routers' choice for the model itself.
+        if using:
+            return [using]
+        if write:
+            aliases = [router.db_for_write(self.model)]
+        else:
+            aliases = [router.db_for_read(self.model)]
+        placement = self._root_manager().placement
+        if placement is not None:
+            aliases = placement.databases() + aliases
+        return list(OrderedDict.fromkeys(aliases))
+
+    def _table_prefix(self):
+        # Partition tables are named after the partition model, which is
+        # named after our model plus the partition key.
+        return '{}_{}_'.format(
+            self.model._meta.app_label,
+            self.model._meta.object_name.lower())
+
+    def _keys_for_tables(self, table_names):
+        # The partition keys of our partition tables among table_names. The
+        # tables of automatically created many-to-many through models are
+        # named after their partition's table plus the field name, so they
+        # share our prefix, and are left out.
+        prefix = self._table_prefix()
+        keys = [t[len(prefix):] for t in table_names if t.startswith(prefix)]
+        found = set(keys)
+        suffixes = [
+            '_' + field.name for field in self.model._meta.many_to_many
+            if field.rel.through is None]
+        return [
+            key for key in keys
+            if not any(
+                key.endswith(suffix) and key[:-len(suffix)] in found
+                for suffix in suffixes)]
+
+    def _find_partition(self, partition_key):
+        # Look for an already-generated partition in the app cache, and cache
+        # it if found.
+        model = get_model(
+            self.model._meta.app_label,
+            self._model_name_for_partition(partition_key))
+        if model is not None:
+            self._remember_partition(partition_key, model)
+        return model
+
+    @contextmanager
+    def _locked(self, partition_key):
+        # Hold the lock for partition_key. Locks are discarded when their
+        # partitions are evicted, so check that we got the current one.
+        while True:
+            lock = self._lock_for(partition_key)
+            lock.acquire()
+            if self._partition_locks.get(partition_key) is lock:
+                break
+            lock.release()
+        try:
+            yield
+        finally:
+            lock.release()
+
+    def _locked_lineage(self, partition_key):
+        # Hold the locks for partition_key of our ancestors and ourself,
+        # taken in dependency order, which is the order _evict_partition()
+        # takes them in too.
+        return _locked_all(self._lineage(), partition_key)
+
+    def _lock_for(self, partition_key):
+        with self._partition_locks_lock:
+            lock = self._partition_locks.get(partition_key)
+            if lock is None:
+                lock = self._partition_locks[partition_key] = threading.RLock()
+            return lock
+
+    def _check_global_ids(self):
+        if not self.global_ids:
+            raise ImproperlyConfigured(
+                '{} does not use global ids'.format(self.__class__.__name__))
+
+    def _global_id_queryset(self, partition_key, using):
+        queryset = self.get_partition(partition_key)._default_manager.all()
+        if using:
+            queryset = queryset.using(using)
+        return queryset
+
+    def _key_value(self, obj):
+        # Pull the value of key_field from a model instance or a dict
+        if self.key_field is None:
+            raise ImproperlyConfigured(
+                '{} must declare a key_field to route rows to '
+                'partitions'.format(self.__class__.__name__))
+        if isinstance(obj, dict):
+            return obj[self.key_field]
+        return getattr(obj, self.key_field)
+
+    def _instance_for(self, model, obj):
+        # Turn obj, which may be a dict of field values or an instance of some
+        # other model, into an instance of the partition model.
+        if isinstance(obj, model):
+            return obj
+        if isinstance(obj, dict):
+            return model(**obj)
+        return model(**dict(
+            (f.attname, getattr(obj, f.attname))
+            for f in model._meta.fields
+            if hasattr(obj, f.attname)))
+
     def _fill_fields_cache(self, model_meta):
         """ Populate the field cache attributes on model_meta using our own
         rules, skipping partition foreign keys.
@@ -230,11 +1169,71 @@ class PartitionForeignKey(DeferredForeignKey):
 
         self.cls = cls
         self.name = self.attname = name
-        self.registry.register_foreign_key(self)
+        if cls._meta.abstract:
+            # Only the declaration needs registering, not the copies made
+            # when partitions are generated.
+            self.registry.register_foreign_key(self)
         cls._meta.add_field(self)
         setattr(cls, name, self)
 
 
+def _clear_related_caches(opts):
+    # Discard the caches Django builds (on demand) of the relations to a
+    # model, after they've changed
+    for name in ('_related_objects_cache',
+                 '_related_objects_proxy_cache',
+                 '_related_many_to_many_cache',
+                 '_name_map'):
+        opts.__dict__.pop(name, None)
+
+
+@contextmanager
+def _locked_all(managers, partition_key):
+    # Hold the locks for partition_key of each of managers, in order
+    if not managers:
+        yield
+        return
+    with managers[0]._locked(partition_key):
+        with _locked_all(managers[1:], partition_key):
+            yield
+
+
+class _LazyRelatedDescriptor(object):
+    """ Stands in for the reverse relation from a parent partition to a child
+    partition which hasn't been generated yet. Touching it generates the
+    child, whose foreign key replaces us with the real descriptor.
+    """
+
+    def __init__(self, manager, partition_key, name):
+        self.manager = manager
+        self.partition_key = partition_key
+        self.name = name
+
+    def __get__(self, instance, owner):
+        self.manager.get_partition(self.partition_key)
+        if owner.__dict__.get(self.name) is self:
+            raise AttributeError(self.name)
+        return getattr(owner if instance is None else instance, self.name)
+
+
+class _ChildrenFirst(object):
+    """ Stands in for the method of a parent partition's Options which
+    builds its cache of related objects, generating the child partitions
+    which may have rows before the cache is built.
+    """
+
+    def __init__(self, manager, partition_key, child_managers, opts):
+        self.manager = manager
+        self.partition_key = partition_key
+        self.child_managers = child_managers
+        self.opts = opts
+
+    def __call__(self):
+        self.manager._generate_children(
+            self.partition_key, self.child_managers)
+        Options._fill_related_objects_cache(self.opts)
+
+
 def create_model(name, bases=None, attrs={}, module_path='', meta_attrs={}):
     """ Create a new model class.
     name       - name of the new class to create
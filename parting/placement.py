@@ -0,0 +1,73 @@
+import bisect
+import zlib
+
+# Placement policies decide which database each partition lives on. Each has
+# a database_for(partition_key) method returning a database alias (or None to
+# leave it to the database routers), and a databases() method listing every
+# alias it may return.
+
+
+class ExplicitPlacement(object):
+    """ Place partitions on databases according to a dict of partition key ->
+    database alias. Partitions which aren't in the dict are placed on
+    default.
+    """
+
+    def __init__(self, mapping, default=None):
+        self.mapping = dict(mapping)
+        self.default = default
+
+    def database_for(self, partition_key):
+        return self.mapping.get(partition_key, self.default)
+
+    def databases(self):
+        return _unique(self.mapping.values() + [self.default])
+
+
+class RangePlacement(object):
+    """ Place partitions on databases by ranges of partition keys. ranges is
+    a list of (first key, database alias) pairs: each partition is placed on
+    the database for the last range whose first key is no greater than its
+    own key. Partitions before the first range are placed on default.
+    """
+
+    def __init__(self, ranges, default=None):
+        ranges = sorted(ranges)
+        self.keys = [first for first, _ in ranges]
+        self.aliases = [alias for _, alias in ranges]
+        self.default = default
+
+    def database_for(self, partition_key):
+        index = bisect.bisect_right(self.keys, partition_key)
+        if index == 0:
+            return self.default
+        return self.aliases[index - 1]
+
+    def databases(self):
+        return _unique(self.aliases + [self.default])
+
+
+class HashPlacement(object):
+    """ Spread partitions evenly across aliases, by a stable hash of their
+    partition keys.
+    """
+
+    def __init__(self, aliases):
+        self.aliases = list(aliases)
+
+    def database_for(self, partition_key):
+        # crc32 is stable across processes, unlike hash()
+        digest = zlib.crc32(unicode(partition_key).encode('utf-8'))
+        return self.aliases[(digest & 0xffffffff) % len(self.aliases)]
+
+    def databases(self):
+        return _unique(self.aliases)
+
+
+def _unique(aliases):
+    # The distinct, non-None aliases in aliases, in order
+    unique = []
+    for alias in aliases:
+        if alias is not None and alias not in unique:
+            unique.append(alias)
+    return unique
@@ -0,0 +1,661 @@
+import datetime
+import decimal
+import hashlib
+import heapq
+import itertools
+import sys
+import threading
+import uuid
+from collections import namedtuple
+from Queue import Empty, Queue
+from django.conf import settings
+from django.core import signing
+from django.core.cache import get_cache
+from django.db import connections, router
+from django.db.models import Count, Q
+from django.db.models.sql.datastructures import EmptyResultSet
+from . import ddl
+
+# The default upper limit on the number of partition queries that may run in
+# parallel across the whole process. Override with the
+# PARTING_MAX_PARALLEL_QUERIES setting.
+DEFAULT_MAX_PARALLEL_QUERIES = 8
+
+_slots = None
+_slots_lock = threading.Lock()
+
+
+def _get_slots():
+    # The process-wide cap on parallel queries, created on first use so that
+    # settings are only read when needed.
+    global _slots
+    if _slots is None:
+        with _slots_lock:
+            if _slots is None:
+                _slots = threading.BoundedSemaphore(getattr(
+                    settings,
+                    'PARTING_MAX_PARALLEL_QUERIES',
+                    DEFAULT_MAX_PARALLEL_QUERIES))
+    return _slots
+
+
+def _supports_threads(alias):
+    # An in-memory SQLite database (as used by the test runner) exists only
+    # on the connection that created it, so other threads can't see it.
+    connection = connections[alias]
+    return not (connection.vendor == 'sqlite' and
+                connection.settings_dict['NAME'] in ('', ':memory:'))
+
+
+def fan_out(func, items, max_workers=None, databases=()):
+    """ Call func with each of items on a bounded pool of threads, and return
+    the results in the same order as items.
+
+    Each thread uses its own database connections, which are closed when the
+    thread is finished. No more than max_workers threads are used for this
+    call, and no more than PARTING_MAX_PARALLEL_QUERIES calls to func run at
+    once across the whole process. If any of databases can't be shared
+    between threads, func is simply called serially.
+    """
+    items = list(items)
+    max_workers = min(max_workers or len(items), len(items))
+    if max_workers <= 1 or not all(_supports_threads(db) for db in databases):
+        return [func(item) for item in items]
+
+    slots = _get_slots()
+    queue = Queue()
+    for index, item in enumerate(items):
+        queue.put((index, item))
+    results = [None] * len(items)
+    errors = []
+
+    def worker():
+        try:
+            while not errors:
+                try:
+                    index, item = queue.get_nowait()
+                except Empty:
+                    break
+                with slots:
+                    try:
+                        results[index] = func(item)
+                    except Exception:
+                        errors.append(sys.exc_info())
+        finally:
+            for connection in connections.all():
+                connection.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(max_workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        exc_info = errors[0]
+        raise exc_info[0], exc_info[1], exc_info[2]
+    return results
+
+
+def _filtered(queryset, filters):
+    # Apply filters, a dict of lookups or a Q object, to queryset
+    if filters is None:
+        return queryset
+    if isinstance(filters, dict):
+        return queryset.filter(**filters)
+    return queryset.filter(filters)
+
+
+def _get_cache():
+    # The cache for aggregates over closed partitions. Override with the
+    # PARTING_AGGREGATE_CACHE setting, naming one of your CACHES.
+    return get_cache(getattr(settings, 'PARTING_AGGREGATE_CACHE', 'default'))
+
+
+def _aggregate_version_key(using, table):
+    return 'parting:aggregate:version:{}:{}'.format(using, table)
+
+
+def _aggregate_versions(cache, querysets, timeout):
+    """ Return the current version of the cached aggregates over each of
+    querysets' tables. A table's version is a random token, replaced when
+    its rows change (see invalidate_aggregates()), so that results cached
+    before then are never found again.
+    """
+    keys = [
+        _aggregate_version_key(qs.db, qs.model._meta.db_table)
+        for qs in querysets]
+    versions = cache.get_many(keys)
+    new = {}
+    for key in keys:
+        if key not in versions:
+            new[key] = versions[key] = uuid.uuid4().hex
+    if new:
+        cache.set_many(new, timeout)
+    return [versions[key] for key in keys]
+
+
+def invalidate_aggregates(model, using):
+    """ Forget the cached aggregates over model's table in the using
+    database. Call this after changing the rows of a closed partition.
+    """
+    _get_cache().delete(_aggregate_version_key(using, model._meta.db_table))
+
+
+def _aggregate_cache_key(queryset, partition_aggregates, version):
+    """ Return the cache key for the results of running
+    partition_aggregates over queryset. Keys are derived from the SQL of the
+    query, so they change with its filters, partition and database, and from
+    the version of the cached aggregates over its table. Raises
+    EmptyResultSet if the query can't match any rows.
+    """
+    sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    aggregates = sorted(
+        (alias, aggregate.name, aggregate.lookup,
+         sorted(aggregate.extra.items()))
+        for alias, aggregate in partition_aggregates.items())
+    digest = hashlib.md5(
+        repr((queryset.db, sql, params, aggregates, version))).hexdigest()
+    return 'parting:aggregate:{}'.format(digest)
+
+
+def _split_aggregates(args, kwargs):
+    """ Turn the arguments to aggregate() into the aggregates to run against
+    each partition, and a list of (alias, name, partial aliases) describing
+    how to combine the per-partition results.
+    """
+    aggregates = dict(kwargs)
+    for arg in args:
+        aggregates[arg.default_alias] = arg
+
+    partition_aggregates = {}
+    combiners = []
+    for alias, aggregate in aggregates.items():
+        if aggregate.name not in ('Avg', 'Count', 'Max', 'Min', 'Sum'):
+            raise ValueError(
+                '{} cannot be combined across partitions'.format(
+                    aggregate.name))
+        if aggregate.extra.get('distinct'):
+            raise ValueError(
+                'Distinct counts cannot be combined across partitions')
+        partition_aggregates[alias] = aggregate
+        if aggregate.name == 'Avg':
+            # Averages must be weighted by the number of rows averaged in
+            # each partition.
+            count_alias = 'parting_count_{}'.format(alias)
+            partition_aggregates[count_alias] = Count(aggregate.lookup)
+            combiners.append((alias, aggregate.name, count_alias))
+        else:
+            combiners.append((alias, aggregate.name, None))
+    return partition_aggregates, combiners
+
+
+def _combine_aggregates(combiners, results):
+    """ Combine a list of per-partition aggregate results """
+    combined = {}
+    for alias, name, count_alias in combiners:
+        values = [r[alias] for r in results if r[alias] is not None]
+        if name == 'Count':
+            combined[alias] = sum(values)
+        elif not values:
+            combined[alias] = None
+        elif name == 'Sum':
+            combined[alias] = sum(values)
+        elif name == 'Max':
+            combined[alias] = max(values)
+        elif name == 'Min':
+            combined[alias] = min(values)
+        else:
+            total = sum(r[count_alias] for r in results)
+            combined[alias] = sum(
+                r[alias] * r[count_alias]
+                for r in results
+                if r[alias] is not None) / float(total)
+    return combined
+
+
+# A page of rows from PartitionManager.paginate(), and the token for the next
+# page, or None if this is the last.
+Page = namedtuple('Page', ['rows', 'next_token'])
+
+_PAGE_TOKEN_SALT = 'parting.page'
+
+
+def _encode_page_value(value):
+    # Turn a field value into something JSON can represent exactly
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    return value
+
+
+def paginate(manager, partition_keys, token=None, filters=None, per_page=20,
+             order_field=None, using=None):
+    """ Return a Page of the rows matching filters (a dict of lookups or a
+    Q object) in the partitions for partition_keys, newest first: ordered by
+    order_field (which defaults to the manager's key_field) and then primary
+    key, both descending, starting with the partition for the last of
+    partition_keys. Partitions whose tables don't exist are skipped.
+
+    Pass the page's next_token back in to get the next page. The token is a
+    signed string holding the partition key, order_field value and primary
+    key of the last row of the page, so each page is fetched with keyset
+    queries starting from that row, rather than an OFFSET, and costs the
+    same however deep it is.
+    """
+    keys = list(reversed(partition_keys))
+    order_field = order_field or manager.key_field or 'pk'
+    start = 0
+    after = None
+    if token is not None:
+        try:
+            partition_key, value, pk = signing.loads(
+                token, salt=_PAGE_TOKEN_SALT)
+            start = keys.index(partition_key)
+        except (signing.BadSignature, TypeError, ValueError):
+            raise ValueError('Invalid page token')
+        after = value, pk
+
+    rows = []
+    row_keys = []
+    recheck = set()
+    for partition_key in keys[start:]:
+        # Only the token's own partition starts part way through
+        position, after = after, None
+        model = manager.get_partition(partition_key)
+        alias = using or router.db_for_read(model)
+        if not ddl.catalog.has_table(alias, model._meta.db_table, recheck):
+            continue
+        queryset = _filtered(model._default_manager.using(alias), filters)
+        if order_field == 'pk':
+            queryset = queryset.order_by('-pk')
+        else:
+            queryset = queryset.order_by('-' + order_field, '-pk')
+        if position is not None:
+            value, pk = position
+            pk = model._meta.pk.to_python(pk)
+            if order_field == 'pk':
+                queryset = queryset.filter(pk__lt=pk)
+            else:
+                value = model._meta.get_field(order_field).to_python(value)
+                queryset = queryset.filter(
+                    Q(**{order_field + '__lt': value}) |
+                    Q(**{order_field: value, 'pk__lt': pk}))
+        # Fetch one row more than we need, to find out if there's another
+        # page
+        fetched = list(queryset[:per_page + 1 - len(rows)])
+        rows.extend(fetched)
+        row_keys.extend([partition_key] * len(fetched))
+        if len(rows) > per_page:
+            break
+
+    if len(rows) <= per_page:
+        return Page(rows, None)
+    last = rows[per_page - 1]
+    next_token = signing.dumps([
+        row_keys[per_page - 1],
+        _encode_page_value(getattr(last, order_field)),
+        _encode_page_value(last.pk),
+    ], salt=_PAGE_TOKEN_SALT)
+    return Page(rows[:per_page], next_token)
+
+
+class _Descending(object):
+    """ Wraps a value so that it sorts in reverse order. Used to build merge
+    keys for descending orderings.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+class CrossPartitionQuerySet(object):
+    """ A lazy, QuerySet-like object spanning several partitions of a
+    partitioned model.
+
+    Filters and ordering are applied to each partition's own query. The
+    per-partition results, which are already sorted by the database, are then
+    merged as a stream, so a slice only pulls as many rows from each
+    partition as it could possibly need.
+
+    Unlike a real QuerySet, results are not cached - each iteration runs
+    the partition queries again.
+    """
+
+    def __init__(self, manager, partition_keys, using=None):
+        self.manager = manager
+        self.partition_keys = list(partition_keys)
+        self._db = using
+        self._filters = []
+        self._ordering = None
+        self._low_mark = 0
+        self._high_mark = None
+        self._fields = None
+        self._flat = False
+        self._parallel = False
+        self._max_workers = None
+
+    # QuerySet API
+    def all(self):
+        return self._clone()
+
+    def filter(self, *args, **kwargs):
+        return self._filter_or_exclude('filter', args, kwargs)
+
+    def exclude(self, *args, **kwargs):
+        return self._filter_or_exclude('exclude', args, kwargs)
+
+    def order_by(self, *field_names):
+        assert not self._is_sliced(), \
+            'Cannot reorder a query once a slice has been taken.'
+        clone = self._clone()
+        clone._ordering = field_names
+        return clone
+
+    def using(self, alias):
+        clone = self._clone()
+        clone._db = alias
+        return clone
+
+    def values_list(self, *fields, **kwargs):
+        flat = kwargs.pop('flat', False)
+        if kwargs:
+            raise TypeError(
+                'Unexpected keyword arguments to values_list: {}'.format(
+                    list(kwargs)))
+        if flat and len(fields) != 1:
+            raise TypeError(
+                "'flat' is only valid when values_list is called with one "
+                "field.")
+        clone = self._clone()
+        clone._fields = fields
+        clone._flat = flat
+        return clone
+
+    def parallel(self, max_workers=None):
+        """ Run the partition queries in parallel on a pool of threads, each
+        with its own database connection. At most max_workers threads are
+        used, defaulting to one per partition (subject to the global
+        PARTING_MAX_PARALLEL_QUERIES cap).
+
+        Note that ordered results from a parallel query are fetched in full
+        from each partition before being merged, so slice the query if you
+        only need the first few rows.
+        """
+        clone = self._clone()
+        clone._parallel = True
+        clone._max_workers = max_workers
+        return clone
+
+    def aggregate(self, *args, **kwargs):
+        """ Aggregate over all partitions. Counts, sums, maxima and minima
+        are combined as you'd expect; averages are weighted by the number of
+        rows in each partition.
+
+        The results for partitions which the manager says are closed are
+        cached, so repeating the aggregate only queries open partitions.
+        They're forgotten when a partition's rows are changed with update(),
+        delete(), bulk_load() or restore_partition(); call
+        invalidate_aggregates() after changing them any other way.
+        """
+        assert not self._is_sliced(), \
+            'Cannot aggregate a query once a slice has been taken.'
+        partition_aggregates, combiners = _split_aggregates(args, kwargs)
+        querysets = self._partition_querysets()
+        timeout = self.manager.aggregate_cache_timeout
+
+        cache = _get_cache()
+        closed = [
+            index for index, partition_key in enumerate(self.partition_keys)
+            if self.manager.is_closed(partition_key)]
+        versions = _aggregate_versions(
+            cache, [querysets[index] for index in closed], timeout)
+        cache_keys = {}
+        for index, version in zip(closed, versions):
+            try:
+                cache_keys[index] = _aggregate_cache_key(
+                    querysets[index],
+                    partition_aggregates,
+                    version)
+            except EmptyResultSet:
+                pass
+
+        results = [None] * len(querysets)
+        if cache_keys:
+            cached = cache.get_many(cache_keys.values())
+            for index, cache_key in cache_keys.items():
+                results[index] = cached.get(cache_key)
+
+        missing = [i for i, result in enumerate(results) if result is None]
+        fresh = self._run(
+            lambda qs: qs.aggregate(**partition_aggregates),
+            [querysets[i] for i in missing])
+        to_cache = {}
+        for index, result in zip(missing, fresh):
+            results[index] = result
+            if index in cache_keys:
+                to_cache[cache_keys[index]] = result
+        if to_cache:
+            cache.set_many(to_cache, timeout)
+        return _combine_aggregates(combiners, results)
+
+    def count(self):
+        total = sum(self._run(
+            lambda qs: qs.count(),
+            self._partition_querysets()))
+        total = max(total - self._low_mark, 0)
+        if self._high_mark is not None:
+            total = min(total, self._high_mark - self._low_mark)
+        return total
+
+    def exists(self):
+        if self._is_sliced():
+            return bool(list(self[:1]))
+        return any(qs.exists() for qs in self._partition_querysets())
+
+    def iterator(self):
+        querysets = self._partition_querysets()
+        if self._parallel:
+            partitions = self._run(list, querysets)
+        else:
+            partitions = [qs.iterator() for qs in querysets]
+
+        ordering = self._get_ordering()
+        if ordering:
+            key_funcs = [
+                self._key_func(qs.model, ordering) for qs in querysets]
+            results = self._merge(zip(partitions, key_funcs))
+        else:
+            results = itertools.chain.from_iterable(partitions)
+        results = itertools.islice(results, self._low_mark, self._high_mark)
+
+        if self._fields is not None:
+            # Strip any columns that were only added for merging
+            width = len(self._fields)
+            if self._flat:
+                results = (row[0] for row in results)
+            elif self._ordering_columns():
+                results = (row[:width] for row in results)
+        return results
+
+    def __iter__(self):
+        return self.iterator()
+
+    def __getitem__(self, k):
+        if not isinstance(k, (slice, int, long)):
+            raise TypeError
+        assert ((not isinstance(k, slice) and (k >= 0))
+                or (isinstance(k, slice) and (k.start is None or k.start >= 0)
+                    and (k.stop is None or k.stop >= 0))), \
+            'Negative indexing is not supported.'
+
+        if isinstance(k, slice):
+            clone = self._clone()
+            clone._set_limits(k.start, k.stop)
+            return k.step and list(clone)[::k.step] or clone
+
+        clone = self._clone()
+        clone._set_limits(k, k + 1)
+        try:
+            return list(clone)[0]
+        except IndexError:
+            raise IndexError('Index out of range')
+
+    # Private stuff
+    def _clone(self):
+        clone = self.__class__(
+            self.manager,
+            self.partition_keys,
+            using=self._db)
+        clone._filters = self._filters[:]
+        clone._ordering = self._ordering
+        clone._low_mark = self._low_mark
+        clone._high_mark = self._high_mark
+        clone._fields = self._fields
+        clone._flat = self._flat
+        clone._parallel = self._parallel
+        clone._max_workers = self._max_workers
+        return clone
+
+    def _run(self, func, querysets):
+        # Call func on each partition's queryset, in parallel if requested
+        if not self._parallel:
+            return [func(qs) for qs in querysets]
+        return fan_out(
+            func,
+            querysets,
+            max_workers=self._max_workers,
+            databases=set(qs.db for qs in querysets))
+
+    def _filter_or_exclude(self, method, args, kwargs):
+        assert not self._is_sliced(), \
+            'Cannot filter a query once a slice has been taken.'
+        clone = self._clone()
+        clone._filters.append((method, args, kwargs))
+        return clone
+
+    def _is_sliced(self):
+        return self._low_mark or self._high_mark is not None
+
+    def _set_limits(self, low=None, high=None):
+        # Mirrors django.db.models.sql.Query.set_limits, so slicing a slice
+        # behaves as it does for a normal QuerySet.
+        if high is not None:
+            if self._high_mark is not None:
+                self._high_mark = min(
+                    self._high_mark,
+                    self._low_mark + int(high))
+            else:
+                self._high_mark = self._low_mark + int(high)
+        if low is not None:
+            if self._high_mark is not None:
+                self._low_mark = min(
+                    self._high_mark,
+                    self._low_mark + int(low))
+            else:
+                self._low_mark = self._low_mark + int(low)
+
+    def _get_ordering(self):
+        if self._ordering is not None:
+            return self._ordering
+        # Fall back to the model's default ordering, as Django would
+        return self.manager.model._meta.ordering
+
+    def _partition_querysets(self):
+        querysets = []
+        for partition_key in self.partition_keys:
+            model = self.manager.get_partition(partition_key)
+            qs = model._default_manager.all()
+            if self._db is not None:
+                qs = qs.using(self._db)
+            for method, args, kwargs in self._filters:
+                qs = getattr(qs, method)(*args, **kwargs)
+            if self._ordering is not None:
+                qs = qs.order_by(*self._ordering)
+            if self._fields is not None:
+                qs = qs.values_list(
+                    *(self._fields + self._ordering_columns()))
+            if self._high_mark is not None:
+                # No partition can contribute more rows than the upper
+                # bound of the slice.
+                qs = qs[:self._high_mark]
+            querysets.append(qs)
+        return querysets
+
+    def _ordering_columns(self):
+        # The extra columns that a values_list() query needs to fetch so that
+        # the results from each partition can be merged.
+        return tuple(
+            name for name in
+            (field_name.lstrip('-') for field_name in self._get_ordering())
+            if name not in self._fields)
+
+    def _merge(self, partitions):
+        """ k-way merge the already-sorted results of each partition,
+        consuming each only as far as needed. partitions is a list of
+        (results, key function) pairs.
+        """
+        heap = []
+        for index, (results, key_func) in enumerate(partitions):
+            iterator = iter(results)
+            for obj in iterator:
+                heap.append((key_func(obj), index, obj, iterator, key_func))
+                break
+        heapq.heapify(heap)
+
+        while heap:
+            _, index, obj, iterator, key_func = heap[0]
+            yield obj
+            for obj in iterator:
+                heapq.heapreplace(
+                    heap,
+                    (key_func(obj), index, obj, iterator, key_func))
+                break
+            else:
+                heapq.heappop(heap)
+
+    def _key_func(self, model, ordering):
+        """ Return a function which builds a merge key for results from
+        model, given a Django-style ordering.
+        """
+        opts = model._meta
+        getters = []
+        for field_name in ordering:
+            descending = field_name.startswith('-')
+            name = field_name.lstrip('-')
+            if name == '?' or '__' in name:
+                raise ValueError(
+                    'Cannot merge partitions ordered by {}'.format(
+                        field_name))
+            if self._fields is not None:
+                # Rows are tuples; find the column we're ordering by
+                columns = self._fields + self._ordering_columns()
+                getters.append((columns.index(name), descending))
+            elif name == 'pk':
+                getters.append((opts.pk.attname, descending))
+            else:
+                getters.append((opts.get_field(name).attname, descending))
+
+        if self._fields is not None:
+            def key_func(row):
+                return tuple(
+                    _Descending(row[index]) if descending else row[index]
+                    for index, descending in getters)
+        else:
+            def key_func(obj):
+                return tuple(
+                    _Descending(getattr(obj, attname)) if descending
+                    else getattr(obj, attname)
+                    for attname, descending in getters)
+        return key_func
@@ -0,0 +1,41 @@
+class PartitionRouter(object):
+    """ A database router which sends reads and writes for each generated
+    partition to the database its partition manager places it on (see
+    PartitionManager.database_for_partition()). Other models are left to the
+    other routers.
+
+    Routers named in DATABASE_ROUTERS are imported along with django.db,
+    before parting's models can be, so this router is installed with
+    install_router() instead.
+    """
+
+    def _database_for(self, model):
+        from .models import get_partition_key
+        manager = getattr(model, '_partition_manager', None)
+        partition_key = get_partition_key(model, None)
+        if manager is None or partition_key is None:
+            return None
+        return manager.database_for_partition(partition_key)
+
+    def db_for_read(self, model, **hints):
+        return self._database_for(model)
+
+    def db_for_write(self, model, **hints):
+        return self._database_for(model)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        db1 = self._database_for(obj1.__class__)
+        db2 = self._database_for(obj2.__class__)
+        if db1 is not None and db2 is not None:
+            return db1 == db2
+        return None
+
+
+def install_router():
+    """ Put a PartitionRouter in front of the routers from DATABASE_ROUTERS,
+    unless there's one already. This is called whenever a PartitionManager is
+    declared.
+    """
+    from django.db import router
+    if not any(isinstance(r, PartitionRouter) for r in router.routers):
+        router.routers.insert(0, PartitionRouter())
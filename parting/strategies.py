@@ -0,0 +1,329 @@
+import bisect
+import datetime
+import zlib
+from dateutil.relativedelta import relativedelta
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import DateTimeField
+from django.utils import timezone
+from .models import PartitionManager
+
+# Stock partition managers for common partitioning schemes. Keys are lower
+# case strings which sort in the same order as the partitions they name, so
+# they work with warm(), expire() and ranges of partitions.
+
+
+def _key(start, width):
+    # Format a non-negative partition number so that keys sort numerically
+    return '{:0{}d}'.format(start, width)
+
+
+class TimeRangePartitionManager(PartitionManager):
+    """ Partitions rows by the day, week, month or year of a date or datetime
+    key_field. Keys look like 2013_03_14, 2013_w11, 2013_03 and 2013
+    respectively; weeks are ISO weeks, starting on Monday.
+
+    Aware datetimes are partitioned by their date in time_zone (UTC by
+    default).
+    """
+
+    interval = 'month'
+    time_zone = timezone.utc
+
+    INTERVALS = {
+        'day': ('%Y_%m_%d', relativedelta(days=+1)),
+        'week': (None, relativedelta(weeks=+1)),
+        'month': ('%Y_%m', relativedelta(months=+1)),
+        'year': ('%Y', relativedelta(years=+1)),
+    }
+
+    def __init__(self, interval=None, time_zone=None, **kwargs):
+        super(TimeRangePartitionManager, self).__init__(**kwargs)
+        if interval is not None:
+            self.interval = interval
+        if time_zone is not None:
+            self.time_zone = time_zone
+        if self.interval not in self.INTERVALS:
+            raise ImproperlyConfigured(
+                'Unknown partition interval {}'.format(self.interval))
+
+    def current_partition_key(self):
+        return self.key_for_value(timezone.now())
+
+    def next_partition_key(self):
+        return self.key_after(self.current_partition_key())
+
+    def key_for_value(self, value):
+        if isinstance(value, datetime.datetime):
+            if timezone.is_aware(value):
+                value = timezone.localtime(value, self.time_zone)
+            value = value.date()
+        return self._format(self._start_of(value))
+
+    def keys_for_values(self, values):
+        """ Return the partition keys for values. Rather than formatting a key
+        for each value, this finds the partitions spanned by the batch, and
+        looks each value up in their boundaries.
+        """
+        values = list(values)
+        if not values:
+            return []
+        partition_keys = self.keys_between(
+            self.key_for_value(min(values)),
+            self.key_for_value(max(values)))
+        if len(partition_keys) == 1:
+            return partition_keys * len(values)
+        boundaries = [
+            self._boundary(self._parse(k), values[0])
+            for k in partition_keys[1:]]
+        return [
+            partition_keys[bisect.bisect_right(boundaries, value)]
+            for value in values]
+
+    def key_after(self, partition_key):
+        return self._format(self._parse(partition_key) + self._step())
+
+    def key_before(self, partition_key):
+        return self._format(self._parse(partition_key) - self._step())
+
+    def partition_index(self, partition_key):
+        start = self._parse(partition_key)
+        if self.interval == 'day':
+            return start.toordinal()
+        elif self.interval == 'week':
+            # Day 1 was a Monday
+            return (start.toordinal() - 1) // 7
+        elif self.interval == 'month':
+            return start.year * 12 + start.month - 1
+        return start.year
+
+    def key_for_index(self, index):
+        if self.interval == 'day':
+            start = datetime.date.fromordinal(index)
+        elif self.interval == 'week':
+            start = datetime.date.fromordinal(index * 7 + 1)
+        elif self.interval == 'month':
+            start = datetime.date(index // 12, index % 12 + 1, 1)
+        else:
+            start = datetime.date(index, 1, 1)
+        return self._format(start)
+
+    def partition_bounds(self, partition_key):
+        start = self._parse(partition_key)
+        end = start + self._step()
+        field = self.model._meta.get_field(self.get_partition_column())
+        if not isinstance(field, DateTimeField):
+            return start, end
+        return self._datetime(start), self._datetime(end)
+
+    def _step(self):
+        return self.INTERVALS[self.interval][1]
+
+    def _start_of(self, date):
+        # The first day of the partition holding date
+        if self.interval == 'day':
+            return date
+        elif self.interval == 'week':
+            return date - datetime.timedelta(days=date.weekday())
+        elif self.interval == 'month':
+            return date.replace(day=1)
+        return date.replace(month=1, day=1)
+
+    def _format(self, start):
+        if self.interval == 'week':
+            year, week, _ = start.isocalendar()
+            return '{}_w{:02d}'.format(year, week)
+        return start.strftime(self.INTERVALS[self.interval][0])
+
+    def _parse(self, partition_key):
+        # The first day of the partition for partition_key
+        if self.interval == 'week':
+            year, week = partition_key.split('_w')
+            jan4 = datetime.date(int(year), 1, 4)
+            return (
+                jan4 - datetime.timedelta(days=jan4.weekday()) +
+                datetime.timedelta(weeks=int(week) - 1))
+        return datetime.datetime.strptime(
+            partition_key,
+            self.INTERVALS[self.interval][0]).date()
+
+    def _datetime(self, date):
+        # Midnight at the start of date, aware if time zones are in use
+        value = datetime.datetime.combine(date, datetime.time())
+        if settings.USE_TZ:
+            value = timezone.make_aware(value, self.time_zone)
+        return value
+
+    def _boundary(self, date, like):
+        # The start of date, comparable with the value like
+        if not isinstance(like, datetime.datetime):
+            return date
+        value = datetime.datetime.combine(date, datetime.time())
+        if timezone.is_aware(like):
+            value = timezone.make_aware(value, self.time_zone)
+        return value
+
+
+class IntegerRangePartitionManager(PartitionManager):
+    """ Partitions rows by ranges of size values of a non-negative integer
+    key_field. Each key is the first value in its range, zero-padded to
+    key_width digits: with size = 1000000, 2500000 is in partition
+    0002000000.
+    """
+
+    size = None
+    key_width = 10
+
+    def __init__(self, size=None, **kwargs):
+        super(IntegerRangePartitionManager, self).__init__(**kwargs)
+        if size is not None:
+            self.size = size
+        if not self.size or self.size < 1:
+            raise ImproperlyConfigured(
+                '{} needs a positive size'.format(self.__class__.__name__))
+
+    def key_for_value(self, value):
+        if value < 0:
+            raise ValueError(
+                'Cannot partition negative value {}'.format(value))
+        return _key(value // self.size * self.size, self.key_width)
+
+    def keys_for_values(self, values):
+        # Only format each distinct partition's key once
+        partition_keys = {}
+        result = []
+        for value in values:
+            start = value // self.size * self.size
+            partition_key = partition_keys.get(start)
+            if partition_key is None:
+                partition_key = partition_keys[start] = self.key_for_value(
+                    value)
+            result.append(partition_key)
+        return result
+
+    def key_after(self, partition_key):
+        return _key(int(partition_key) + self.size, self.key_width)
+
+    def key_before(self, partition_key):
+        return self.key_for_value(int(partition_key) - self.size)
+
+    def partition_index(self, partition_key):
+        return int(partition_key) // self.size
+
+    def key_for_index(self, index):
+        return _key(index * self.size, self.key_width)
+
+    def partition_bounds(self, partition_key):
+        start = int(partition_key)
+        return start, start + self.size
+
+
+class HashPartitionManager(PartitionManager):
+    """ Spreads rows over modulus partitions, by the remainder of a hash of
+    key_field. Integers are their own hash; other values are hashed with
+    crc32, which is stable across processes.
+
+    Note that this isn't the same hash as PostgreSQL's, so don't combine
+    this with partition_method = 'hash': native hash partitions would reject
+    rows which we route to them.
+    """
+
+    modulus = None
+
+    def __init__(self, modulus=None, **kwargs):
+        super(HashPartitionManager, self).__init__(**kwargs)
+        if modulus is not None:
+            self.modulus = modulus
+        if not self.modulus or self.modulus < 1:
+            raise ImproperlyConfigured(
+                '{} needs a positive modulus'.format(self.__class__.__name__))
+        self.key_width = len(str(self.modulus - 1))
+
+    def all_keys(self):
+        """ Return the keys of every partition """
+        return [_key(r, self.key_width) for r in range(self.modulus)]
+
+    def key_for_value(self, value):
+        if not isinstance(value, (int, long)):
+            value = zlib.crc32(unicode(value).encode('utf-8')) & 0xffffffff
+        return _key(value % self.modulus, self.key_width)
+
+    def keys_between(self, first, last):
+        return [k for k in self.all_keys() if first <= k <= last]
+
+    def key_after(self, partition_key):
+        remainder = int(partition_key) + 1
+        if remainder >= self.modulus:
+            raise ValueError('No partition after {}'.format(partition_key))
+        return _key(remainder, self.key_width)
+
+    def key_before(self, partition_key):
+        remainder = int(partition_key) - 1
+        if remainder < 0:
+            raise ValueError('No partition before {}'.format(partition_key))
+        return _key(remainder, self.key_width)
+
+    def partition_index(self, partition_key):
+        return int(partition_key)
+
+    def key_for_index(self, index):
+        return _key(index, self.key_width)
+
+    def partition_bounds(self, partition_key):
+        return self.modulus, int(partition_key)
+
+
+class ListPartitionManager(PartitionManager):
+    """ Partitions rows by explicit lists of values of key_field. lists is a
+    dict of partition key -> list of values. Values which aren't listed go in
+    the default_key partition, if there is one, and are otherwise an error.
+    The default partition sorts among the others by its key, and its bounds
+    are None.
+    """
+
+    lists = None
+    default_key = None
+
+    def __init__(self, lists=None, default_key=None, **kwargs):
+        super(ListPartitionManager, self).__init__(**kwargs)
+        if lists is not None:
+            self.lists = lists
+        if default_key is not None:
+            self.default_key = default_key
+        if not self.lists:
+            raise ImproperlyConfigured(
+                '{} needs lists of values'.format(self.__class__.__name__))
+        self._keys_by_value = {}
+        for partition_key, values in self.lists.items():
+            for value in values:
+                self._keys_by_value[value] = partition_key
+        partition_keys = set(self.lists)
+        if self.default_key is not None:
+            partition_keys.add(self.default_key)
+        self._sorted_keys = sorted(partition_keys)
+
+    def key_for_value(self, value):
+        partition_key = self._keys_by_value.get(value, self.default_key)
+        if partition_key is None:
+            raise ValueError('No partition for value {!r}'.format(value))
+        return partition_key
+
+    def keys_between(self, first, last):
+        return [k for k in self._sorted_keys if first <= k <= last]
+
+    def key_after(self, partition_key):
+        index = bisect.bisect_right(self._sorted_keys, partition_key)
+        if index == len(self._sorted_keys):
+            raise ValueError('No partition after {}'.format(partition_key))
+        return self._sorted_keys[index]
+
+    def key_before(self, partition_key):
+        index = bisect.bisect_left(self._sorted_keys, partition_key)
+        if index == 0:
+            raise ValueError('No partition before {}'.format(partition_key))
+        return self._sorted_keys[index - 1]
+
+    def partition_bounds(self, partition_key):
+        if partition_key == self.default_key:
+            return None
+        return list(self.lists[partition_key])
@@ -1,7 +1,9 @@
+import contextlib
 import functools
 import imp
 import mock
 import sys
+from cStringIO import StringIO
 from django.core.management.base import CommandError
 from django.db import models
 from django.test import TestCase, TransactionTestCase
@@ -16,6 +18,7 @@ def _cleanup(*models):
     the models module in which they're defined.
     """
     from django.db.models.loading import cache
+    from parting.models import get_partition_key
     deleted = []
 
     # Note that we want to use the import lock here - the app loading is
@@ -31,11 +34,20 @@ def _cleanup(*models):
                 name = '{}.{}'.format(klass.__module__, klass.__name__)
 
                 if name in models:
+                    # Automatically created through models aren't added to
+                    # their module
                     module = sys.modules[klass.__module__]
-                    delattr(module, klass.__name__)
+                    if hasattr(module, klass.__name__):
+                        delattr(module, klass.__name__)
                     del model_dict[django_name]
                     deleted.append(name)
 
+                    # Also drop the model from its partition manager's cache
+                    manager = getattr(klass, '_partition_manager', None)
+                    if manager is not None:
+                        manager._partitions.pop(
+                            get_partition_key(klass, None), None)
+
         if sorted(deleted) != sorted(models):
             expected = ', '.join(models)
             expected = expected if expected else '(none)'
@@ -94,6 +106,22 @@ def cleanup_models(*models):
     return outer
 
 
+@contextlib.contextmanager
+def capture_queries(connection):
+    """ Context manager which records the queries run on connection while
+    it is active.
+    """
+    queries = []
+    use_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    start = len(connection.queries)
+    try:
+        yield queries
+    finally:
+        queries.extend(connection.queries[start:])
+        connection.use_debug_cursor = use_debug_cursor
+
+
 class PartitionedModelTests(TestCase):
 
     def test_base_model_require_abstract(self):
@@ -129,10 +157,11 @@ class PartitionForeignKeyTests(TestCase):
         'parting.tests.PartitionModel_foo',
         'parting.tests.ChildPartitionModel_foo')
     def test_child_partions_generated(self):
-        """ When a parent partition is generated, child partitions (as
-        determined) by PartitionForeignKey relationships) should also be
-        generated.
+        """ Child partitions (as determined by PartitionForeignKey
+        relationships) are generated when they're first needed, pointing at
+        the parent partition with the same key.
         """
+        from django.db.models import get_model
         from parting import PartitionManager, PartitionForeignKey
 
         class PartitionModel(models.Model):
@@ -148,11 +177,20 @@ class PartitionForeignKeyTests(TestCase):
             class Meta:
                 abstract = True
 
-        # Generating the parent partition should cause a child partition
-        # to also be created, with the same key.
-        PartitionModel.objects.get_partition('foo')
+        # Generating the parent partition doesn't generate the child
+        parent_partition = PartitionModel.objects.get_partition('foo')
+        self.assertEqual(
+            None, get_model('parting', 'ChildPartitionModel_foo'))
+
+        # Touching the reverse relation does
+        self.assertTrue(parent_partition.childpartitionmodel_foo_set)
         child_partition = ChildPartitionModel.objects.get_partition('foo')
         self.assertTrue(child_partition is not None)
+        self.assertEqual(
+            child_partition, get_model('parting', 'ChildPartitionModel_foo'))
+        self.assertEqual(
+            parent_partition,
+            child_partition._meta.get_field('parent').rel.to)
 
     def test_multiple_fks_bad(self):
         """ If there are multiple PartitionForeignKeys, they must all point
@@ -222,6 +260,84 @@ class PartitionForeignKeyTests(TestCase):
             self.failIf(isinstance(field, PartitionForeignKey))
 
 
+    @cleanup_models(
+        'parting.tests.Level1Model_foo',
+        'parting.tests.Level2Model_foo',
+        'parting.tests.Level3Model_foo')
+    def test_dependency_graph(self):
+        """ Chains of PartitionForeignKeys are generated in dependency order,
+        and the graph can be inspected.
+        """
+        from parting import (
+            PartitionManager, PartitionForeignKey, dependency_graph)
+
+        class Level1Model(models.Model):
+            objects = PartitionManager()
+
+            class Meta:
+                abstract = True
+
+        class Level2Model(models.Model):
+            parent = PartitionForeignKey(Level1Model)
+            objects = PartitionManager()
+
+            class Meta:
+                abstract = True
+
+        class Level3Model(models.Model):
+            parent = PartitionForeignKey(Level2Model)
+            objects = PartitionManager()
+
+            class Meta:
+                abstract = True
+
+        graph = dependency_graph()
+        self.assertEqual([Level2Model], graph[Level1Model])
+        self.assertEqual([Level3Model], graph[Level2Model])
+        self.assertEqual([], graph[Level3Model])
+        order = list(graph)
+        self.assertTrue(
+            order.index(Level1Model) <
+            order.index(Level2Model) <
+            order.index(Level3Model))
+
+        # Asking for the bottom of the chain generates the whole lineage
+        level3 = Level3Model.objects.get_partition('foo')
+        level2 = level3._meta.get_field('parent').rel.to
+        self.assertEqual(Level2Model.objects.get_partition('foo'), level2)
+        self.assertEqual(
+            Level1Model.objects.get_partition('foo'),
+            level2._meta.get_field('parent').rel.to)
+        self.assertEqual(
+            [Level1Model.objects.get_partition('foo'), level2, level3],
+            Level1Model.objects._partition_family('foo'))
+
+    def test_dependency_cycle(self):
+        """ PartitionForeignKeys which form a cycle are reported """
+        from django.core.exceptions import ImproperlyConfigured
+        from parting.models import PartitionRegistry
+        registry = PartitionRegistry()
+
+        class A(object):
+            pass
+
+        class B(object):
+            pass
+
+        def fk(to, cls):
+            fk = mock.Mock(to=to)
+            fk.cls = cls
+            return fk
+
+        registry.register_foreign_key(fk(A, B))
+        self.assertEqual([A, B], list(registry.dependency_graph()))
+        self.assertEqual([A, B], registry.ancestors(B))
+        self.assertEqual([A, B], registry.dependents(A))
+        registry.register_foreign_key(fk(B, A))
+        with self.assertRaises(ImproperlyConfigured):
+            registry.dependency_graph()
+
+
 class PartitionTests(TestCase):
 
     @cleanup_models('testapp.models.Tweet_foo', 'testapp.models.Star_foo')
@@ -244,6 +360,187 @@ class PartitionTests(TestCase):
         # We should also find that our custom manager is in place
         self.assertTrue(hasattr(partition.objects, 'my_custom_method'))
 
+    @cleanup_models('testapp.models.Tweet_foo', 'testapp.models.Star_foo')
+    def test_related_lookups(self):
+        """ Relations between partitions can be queried in both directions,
+        even though their related object caches are only rebuilt when
+        needed.
+        """
+        from testapp.models import Star, Tweet
+        tweet = Tweet.partitions.get_partition('foo')
+        self.assertEqual([], tweet._meta.get_all_related_objects())
+        star = Star.partitions.get_partition('foo')
+        self.assertTrue('testapp_star_foo' in str(
+            tweet.objects.filter(star_foo__user='x').query))
+        self.assertTrue('testapp_tweet_foo' in str(
+            star.objects.filter(tweet__json='x').query))
+        self.assertEqual(
+            [star],
+            [r.model for r in tweet._meta.get_all_related_objects()])
+
+    @cleanup_models('testapp.models.Tweet_foo')
+    def test_cached_partition(self):
+        """ Once a partition has been generated, fetching it again doesn't
+        need to consult the app cache.
+        """
+        from testapp.models import Tweet
+        partition = Tweet.partitions.get_partition('foo')
+        with mock.patch('parting.models.get_model') as get_model:
+            self.assertEqual(partition, Tweet.partitions.get_partition('foo'))
+            self.failIf(get_model.called)
+
+    @cleanup_models(*[
+        'testapp.models.{}_stress_{}'.format(model, i)
+        for model in ('Tweet', 'Star')
+        for i in range(8)
+    ])
+    def test_concurrent_generation(self):
+        """ Many threads asking for the same new partitions at once share
+        a single generation of each partition.
+        """
+        import random
+        import threading
+        from parting import models as parting_models
+        from testapp.models import Star, Tweet
+        keys = ['stress_{}'.format(i) for i in range(8)]
+        results = []
+        errors = []
+        start = threading.Event()
+
+        def fetch(key, star_first):
+            # Fetch a child partition before or after its parent
+            if star_first:
+                star = Star.partitions.get_partition(key)
+                return Tweet.partitions.get_partition(key), star
+            tweet = Tweet.partitions.get_partition(key)
+            return tweet, Star.partitions.get_partition(key)
+
+        def hammer():
+            start.wait()
+            try:
+                shuffled = keys[:]
+                random.shuffle(shuffled)
+                results.append(dict(
+                    (key, fetch(key, random.random() < 0.5))
+                    for key in shuffled))
+            except Exception as e:
+                errors.append(e)
+
+        with mock.patch(
+                'parting.models.create_model',
+                wraps=parting_models.create_model) as create_model:
+            threads = [threading.Thread(target=hammer) for _ in range(16)]
+            for thread in threads:
+                thread.start()
+            start.set()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual([], errors)
+        self.assertEqual(16, len(results))
+        for key in keys:
+            self.assertEqual(1, len(set(r[key] for r in results)))
+            tweet, star = results[0][key]
+            self.assertEqual(tweet, star._meta.get_field('tweet').rel.to)
+        # One Tweet and one Star partition per key
+        self.assertEqual(16, create_model.call_count)
+
+    @cleanup_models(
+        'testapp.models.Tweet_lru_a',
+        'testapp.models.Tweet_lru_b', 'testapp.models.Star_lru_b')
+    def test_max_partitions(self):
+        """ With max_partitions, the least recently used partitions are
+        evicted, along with their children, and regenerated when needed.
+        """
+        from django.db.models import get_model
+        from testapp import models
+        with mock.patch.object(models.Tweet.partitions, 'max_partitions', 2):
+            first = models.Tweet.partitions.get_partition('lru_a')
+            models.Star.partitions.get_partition('lru_b')
+            models.Tweet.partitions.get_partition('lru_a')
+            models.Tweet.partitions.get_partition('lru_c')
+            self.assertEqual(
+                ['lru_a', 'lru_c'], list(models.Tweet.partitions._partitions))
+            self.assertFalse(hasattr(models, 'Tweet_lru_b'))
+            self.assertFalse(hasattr(models, 'Star_lru_b'))
+            self.assertEqual(None, get_model('testapp', 'Tweet_lru_b'))
+            self.assertEqual(None, get_model('testapp', 'Star_lru_b'))
+            self.assertEqual(
+                first, models.Tweet.partitions.get_partition('lru_a'))
+
+            # Evicted partitions are generated again when needed
+            again = models.Tweet.partitions.get_partition('lru_b')
+            star = models.Star.partitions.get_partition('lru_b')
+            self.assertEqual(again, star._meta.get_field('tweet').rel.to)
+            self.assertEqual(
+                ['lru_a', 'lru_b'], list(models.Tweet.partitions._partitions))
+            self.assertFalse(hasattr(models, 'Tweet_lru_c'))
+
+    @cleanup_models('testapp.models.Tweet_foo', 'testapp.models.Star_foo')
+    def test_metrics(self):
+        """ Partition lookups and generation are reported to the metrics
+        collector.
+        """
+        from parting import metrics
+        from testapp.models import Star, Tweet
+        collector = metrics.MemoryMetrics()
+        previous = metrics.set_collector(collector)
+        try:
+            Tweet.partitions.get_partition('foo')
+            Tweet.partitions.get_partition('foo')
+            Star.partitions.get_partition('foo')
+        finally:
+            metrics.set_collector(previous)
+        # Generating the Star partition looks up its parent
+        self.assertEqual(
+            2, collector.count('parting.partition.hit', model='testapp.Tweet'))
+        self.assertEqual(
+            1,
+            collector.count('parting.partition.miss', model='testapp.Tweet'))
+        self.assertEqual(
+            1, collector.count('parting.partition.miss', model='testapp.Star'))
+        self.assertEqual(1, collector.count(
+            'parting.partition.children', model='testapp.Tweet'))
+        self.assertEqual(0, collector.count(
+            'parting.partition.children', model='testapp.Star'))
+        self.assertEqual(
+            2, len(collector.times('parting.partition.generate')))
+        self.assertEqual(
+            2, len(collector.times('parting.partition.lock_wait')))
+
+    @cleanup_models(
+        'testapp.models.Tweet_2013_03', 'testapp.models.Star_2013_03')
+    @mock.patch('testapp.models.Tweet.partitions.partition_method', 'range')
+    def test_native_partitioning_sql(self):
+        """ With partition_method set, partitions are attached to a
+        natively partitioned parent table.
+        """
+        from parting import ddl
+        from testapp.models import Star, Tweet
+        partition = Tweet.partitions.get_partition('2013_03')
+        self.assertEqual(
+            'CREATE TABLE IF NOT EXISTS "testapp_tweet" ('
+            '"id" integer NOT NULL, "json" text NOT NULL, '
+            '"created" datetime NOT NULL) PARTITION BY RANGE ("created");',
+            ddl.sql_create_parent(partition, 'default'))
+        self.assertEqual(
+            'ALTER TABLE "testapp_tweet" ATTACH PARTITION '
+            '"testapp_tweet_2013_03" FOR VALUES FROM '
+            '(\'2013-03-01T00:00:00+00:00\') TO '
+            '(\'2013-04-01T00:00:00+00:00\');',
+            ddl.sql_attach_partition(partition, 'default'))
+        with mock.patch.object(
+                Tweet.partitions, 'partition_bounds', lambda key: None):
+            self.assertEqual(
+                'ALTER TABLE "testapp_tweet" ATTACH PARTITION '
+                '"testapp_tweet_2013_03" DEFAULT;',
+                ddl.sql_attach_partition(partition, 'default'))
+
+        # Only supported on PostgreSQL
+        self.assertEqual([], ddl.sql_native_partitioning(
+            [partition, Star.partitions.get_partition('2013_03')],
+            'default'))
+
     def test_get_missing_partition(self):
         """ Attempting to fetch a missing partition will just return None
         (mirroring the behaviour of Django's get_model), as long as we don't
@@ -294,6 +591,142 @@ class PartitionTests(TestCase):
         self.assertEqual('foo', get_partition_key(star_partition))
 
 
+class StrategyTests(TestCase):
+
+    def test_time_ranges(self):
+        """ Time range managers compute keys for each interval, singly and
+        in batches.
+        """
+        import datetime
+        from django.utils.timezone import utc
+        from parting.strategies import TimeRangePartitionManager
+        value = datetime.datetime(2013, 3, 14, 12, tzinfo=utc)
+        for interval, key, after, before in [
+                ('day', '2013_03_14', '2013_03_15', '2013_03_13'),
+                ('week', '2013_w11', '2013_w12', '2013_w10'),
+                ('month', '2013_03', '2013_04', '2013_02'),
+                ('year', '2013', '2014', '2012')]:
+            manager = TimeRangePartitionManager(interval=interval)
+            self.assertEqual(key, manager.key_for_value(value))
+            self.assertEqual(key, manager.key_for_value(value.date()))
+            self.assertEqual(after, manager.key_after(key))
+            self.assertEqual(before, manager.key_before(key))
+            self.assertEqual(
+                [before, key, after], manager.keys_between(before, after))
+
+        manager = TimeRangePartitionManager(interval='week')
+        self.assertEqual('2014_w01', manager.key_after('2013_w52'))
+        values = [
+            datetime.datetime(2013, 1, 1) + datetime.timedelta(hours=7 * n)
+            for n in range(500)]
+        for interval in ('day', 'week', 'month'):
+            manager = TimeRangePartitionManager(interval=interval)
+            for batch in (values, [v.replace(tzinfo=utc) for v in values]):
+                self.assertEqual(
+                    [manager.key_for_value(v) for v in batch],
+                    manager.keys_for_values(reversed(batch))[::-1])
+
+    def test_time_range_bounds(self):
+        """ Time range bounds are datetimes for datetime fields """
+        import datetime
+        from django.utils.timezone import utc
+        from testapp.models import Tweet
+        self.assertEqual(
+            (datetime.datetime(2013, 12, 1, tzinfo=utc),
+             datetime.datetime(2014, 1, 1, tzinfo=utc)),
+            Tweet.partitions.partition_bounds('2013_12'))
+
+    def test_integer_ranges(self):
+        """ Integer range keys are zero-padded range starts """
+        from parting.strategies import IntegerRangePartitionManager
+        manager = IntegerRangePartitionManager(size=1000)
+        self.assertEqual('0000002000', manager.key_for_value(2500))
+        self.assertEqual(
+            ['0000000000', '0000002000', '0000000000'],
+            manager.keys_for_values([0, 2999, 999]))
+        self.assertEqual('0000003000', manager.key_after('0000002000'))
+        self.assertEqual('0000001000', manager.key_before('0000002000'))
+        self.assertEqual((2000, 3000), manager.partition_bounds('0000002000'))
+        self.assertRaises(ValueError, manager.key_for_value, -1)
+
+    def test_hash(self):
+        """ Hash keys are remainders, and stable across string types """
+        from parting.strategies import HashPartitionManager
+        manager = HashPartitionManager(modulus=16)
+        self.assertEqual('03', manager.key_for_value(35))
+        self.assertEqual(
+            manager.key_for_value(u'jimmy'), manager.key_for_value('jimmy'))
+        self.assertEqual(16, len(manager.all_keys()))
+        self.assertEqual(manager.all_keys(), manager.keys_between('00', '15'))
+        self.assertEqual((16, 3), manager.partition_bounds('03'))
+        self.assertRaises(ValueError, manager.key_after, '15')
+
+        # Keys stay within the modulus when it isn't a power of ten
+        manager = HashPartitionManager(modulus=10)
+        self.assertEqual(manager.all_keys(), manager.keys_between('0', '9'))
+        self.assertEqual(['3', '4', '5'], manager.keys_between('3', '5'))
+        self.assertEqual('9', manager.key_after('8'))
+        self.assertRaises(ValueError, manager.key_after, '9')
+
+    def test_partition_indexes(self):
+        """ Partition keys map to integer indexes and back, for global ids
+        """
+        from parting.strategies import (
+            HashPartitionManager, IntegerRangePartitionManager,
+            TimeRangePartitionManager)
+        for interval, key, after in [
+                ('day', '2013_03_14', '2013_03_15'),
+                ('week', '2013_w11', '2013_w12'),
+                ('month', '2013_12', '2014_01'),
+                ('year', '2013', '2014')]:
+            manager = TimeRangePartitionManager(interval=interval)
+            index = manager.partition_index(key)
+            self.assertEqual(key, manager.key_for_index(index))
+            self.assertEqual(index + 1, manager.partition_index(after))
+        manager = IntegerRangePartitionManager(size=1000)
+        self.assertEqual(3, manager.partition_index('0000003000'))
+        self.assertEqual('0000003000', manager.key_for_index(3))
+        manager = HashPartitionManager(modulus=16)
+        self.assertEqual(3, manager.partition_index('03'))
+        self.assertEqual('03', manager.key_for_index(3))
+
+    def test_lists(self):
+        """ List keys are looked up from their values """
+        from parting.strategies import ListPartitionManager
+        manager = ListPartitionManager(
+            lists={'europe': ['uk', 'fr'], 'america': ['us']})
+        self.assertEqual(
+            ['europe', 'america'], manager.keys_for_values(['fr', 'us']))
+        self.assertEqual('europe', manager.key_after('america'))
+        self.assertEqual(
+            ['america', 'europe'], manager.keys_between('a', 'z'))
+        self.assertRaises(ValueError, manager.key_for_value, 'jp')
+        manager = ListPartitionManager(
+            lists={'europe': ['uk'], 'america': ['us']}, default_key='other')
+        self.assertEqual('other', manager.key_for_value('jp'))
+        self.assertEqual(
+            ['america', 'europe', 'other'], manager.keys_between('a', 'z'))
+        self.assertEqual('other', manager.key_after('europe'))
+        self.assertEqual('europe', manager.key_before('other'))
+        self.assertRaises(ValueError, manager.key_after, 'other')
+        self.assertEqual(['uk'], manager.partition_bounds('europe'))
+        self.assertEqual(None, manager.partition_bounds('other'))
+
+    def test_misconfigured(self):
+        """ Strategies check their configuration """
+        from django.core.exceptions import ImproperlyConfigured
+        from parting import strategies
+        self.assertRaises(
+            ImproperlyConfigured,
+            strategies.TimeRangePartitionManager, interval='fortnight')
+        self.assertRaises(
+            ImproperlyConfigured, strategies.IntegerRangePartitionManager)
+        self.assertRaises(
+            ImproperlyConfigured, strategies.HashPartitionManager)
+        self.assertRaises(
+            ImproperlyConfigured, strategies.ListPartitionManager)
+
+
 class CommandTests(TransactionTestCase):
 
     def setUp(self):
@@ -304,13 +737,17 @@ class CommandTests(TransactionTestCase):
     def _run(self, *args, **kwargs):
         from parting.management.commands import ensure_partition
         command = ensure_partition.Command()
+        command.stdout = StringIO()
+        kwargs.setdefault('verbosity', 0)
         command.handle(*args, **kwargs)
+        return command.stdout.getvalue()
 
     def check_tables(self, *names):
         """ Check the named tables exist in the database, and clean them
         up if they do
         """
         from django.db import connection
+        from parting.ddl import catalog
         names = set(names)
         tables = set(connection.introspection.table_names())
         missing_tables = names - tables
@@ -326,6 +763,7 @@ class CommandTests(TransactionTestCase):
                 'DROP TABLE {}'.format(
                     connection.ops.quote_name(name)
                 ))
+        catalog.clear()
 
     def test_missing_model(self):
         """ The command requires at least 1 argument, a model
@@ -385,7 +823,1321 @@ class CommandTests(TransactionTestCase):
             'testapp_star_foo',
         )
 
+    @cleanup_models(*[
+        'testapp.models.{}_2013_{:02d}'.format(model, month)
+        for model in ('Tweet', 'Star')
+        for month in (1, 2, 3)
+    ])
+    def test_range(self):
+        """ Check that we can create a range of partitions, and get a
+        summary of what was done.
+        """
+        self._run('testapp.models.Tweet', first='2013_02', last='2013_02')
+        output = self._run(
+            'testapp.models.Tweet',
+            first='2013_01',
+            last='2013_03',
+            verbosity=1)
+        self.assertTrue(
+            output.startswith('Created 2 partitions, 1 already present'))
+        self.check_tables(*[
+            'testapp_{}_2013_{:02d}'.format(model, month)
+            for model in ('tweet', 'star')
+            for month in (1, 2, 3)
+        ])
+
+    @cleanup_models(*[
+        'testapp.models.{}_{}'.format(model, key)
+        for model in ('Tweet', 'Star')
+        for key in ('2013_12', '2014_01', '2014_02')
+    ])
+    @mock.patch('testapp.models.TweetPartitionManager.current_partition_key')
+    def test_ahead(self, current_partition_key):
+        """ Check that we can create the current partition and a number of
+        partitions after it.
+        """
+        current_partition_key.return_value = '2013_12'
+        self._run('testapp.models.Tweet', ahead=2)
+        self.check_tables(*[
+            'testapp_{}_{}'.format(model, key)
+            for model in ('tweet', 'star')
+            for key in ('2013_12', '2014_01', '2014_02')
+        ])
+
+    def test_bad_range(self):
+        """ A range needs both ends, and can't be mixed with other ways of
+        choosing partitions.
+        """
+        with self.assertRaises(CommandError):
+            self._run('testapp.models.Tweet', first='2013_01')
+        with self.assertRaises(CommandError):
+            self._run('testapp.models.Tweet', 'foo', ahead=2)
+        with self.assertRaises(CommandError):
+            self._run(
+                'testapp.models.Tweet',
+                first='2013_01',
+                last='2013_02',
+                ahead=2)
+
+    @cleanup_models(
+        'testapp.models.Tweet_foo', 'testapp.models.Star_foo',
+        'testapp.models.Tweet_bar', 'testapp.models.Star_bar')
+    def test_only_missing_tables(self):
+        """ Only DDL for the missing partition tables is run """
+        from django.db import connection
+        self._run('testapp.models.Tweet', 'foo')
+        with capture_queries(connection) as queries:
+            self._run('testapp.models.Tweet', 'bar')
+        ddl = [q['sql'] for q in queries if q['sql'].startswith('CREATE')]
+        self.assertEqual(3, len(ddl))
+        for statement in ddl:
+            self.assertTrue('_bar' in statement)
+        self.check_tables(
+            'testapp_tweet_foo', 'testapp_star_foo',
+            'testapp_tweet_bar', 'testapp_star_bar')
+
+    @cleanup_models(
+        'testapp.models.Tweet_foo', 'testapp.models.Star_foo',
+        'testapp.models.Tweet_bar', 'testapp.models.Star_bar')
+    def test_ddl_metrics(self):
+        """ The time spent on each partition's DDL is reported to the
+        metrics collector.
+        """
+        from parting import metrics
+        collector = metrics.MemoryMetrics()
+        previous = metrics.set_collector(collector)
+        try:
+            self._run('testapp.models.Tweet', 'foo')
+            self._run('testapp.models.Tweet', 'foo')
+            self._run('testapp.models.Tweet', 'bar')
+        finally:
+            metrics.set_collector(previous)
+        self.assertEqual(2, len(collector.times(
+            'parting.ddl.partition', partition='foo', database='default')))
+        self.assertEqual(1, len(collector.times(
+            'parting.ddl.partition', partition='bar', model='testapp.Tweet')))
+        # Tables were only created twice
+        self.assertEqual(2, len(collector.times('parting.ddl.create_tables')))
+        self.check_tables(
+            'testapp_tweet_foo', 'testapp_star_foo',
+            'testapp_tweet_bar', 'testapp_star_bar')
+
+    @cleanup_models('testapp.models.Tweet_foo', 'testapp.models.Star_foo')
+    def test_sqlall(self):
+        """ --sqlall only prints the SQL for the requested partitions """
+        with mock.patch('sys.stdout', new_callable=StringIO) as stdout:
+            self._run('testapp.models.Tweet', 'foo', sqlall=True)
+        sql = stdout.getvalue()
+        self.assertEqual(2, sql.count('CREATE TABLE'))
+        self.assertTrue('CREATE TABLE "testapp_tweet_foo"' in sql)
+        self.assertTrue('CREATE TABLE "testapp_star_foo"' in sql)
+        self.assertTrue(
+            'REFERENCES "testapp_tweet_foo" ("id")' in sql)
+        self.assertTrue('CREATE INDEX' in sql)
+
     def test_bad_model(self):
         """ Check that a non-existant model causes a CommandError """
         with self.assertRaises(CommandError):
             self._run('doesnotexist')
+
+
+class PartitionTableTestCase(TransactionTestCase):
+    """ Base class for tests that need real tables for generated partitions.
+    Any tables created with create_tables are dropped again after the test.
+    """
+
+    def setUp(self):
+        self._created_tables = []
+
+    def tearDown(self):
+        from django.db import connection
+        from parting.ddl import catalog
+        cursor = connection.cursor()
+        for table in reversed(self._created_tables):
+            cursor.execute(
+                'DROP TABLE {}'.format(connection.ops.quote_name(table)))
+        catalog.clear()
+
+    def create_tables(self, *models):
+        from django.core.management.color import no_style
+        from django.db import connection
+        from parting.ddl import catalog
+        cursor = connection.cursor()
+        for model in models:
+            sql, _ = connection.creation.sql_create_model(
+                model, no_style(), set(models))
+            for statement in sql:
+                cursor.execute(statement)
+            self._created_tables.append(model._meta.db_table)
+            catalog.add(connection.alias, model._meta.db_table)
+
+    def create_tweets(self):
+        """ Create some tweets in the 2013_03 and 2013_04 partitions """
+        import datetime
+        from django.utils.timezone import utc
+        from testapp.models import Tweet
+        march = Tweet.partitions.get_partition('2013_03')
+        april = Tweet.partitions.get_partition('2013_04')
+        self.create_tables(march, april)
+        for day in (1, 10, 20):
+            march.objects.create(
+                json='march {}'.format(day),
+                created=datetime.datetime(2013, 3, day, tzinfo=utc))
+        for day in (5, 15):
+            april.objects.create(
+                json='april {}'.format(day),
+                created=datetime.datetime(2013, 4, day, tzinfo=utc))
+        return march, april
+
+
+class CrossPartitionQueryTests(PartitionTableTestCase):
+
+    @cleanup_models(
+        'testapp.models.Tweet_2013_03', 'testapp.models.Tweet_2013_04')
+    def test_ordered_merge(self):
+        """ Ordered results from several partitions are merged into a
+        single ordered stream.
+        """
+        from testapp.models import Tweet
+        self.create_tweets()
+        qs = Tweet.partitions.across(['2013_03', '2013_04'])
+        self.assertEqual(
+            ['april 15', 'april 5', 'march 20', 'march 10', 'march 1'],
+            [t.json for t in qs.order_by('-created')])
+        self.assertEqual(
+            ['march 10', 'march 20', 'april 5'],
+            [t.json for t in qs.order_by('created')[1:4]])
+        self.assertEqual('april 5', qs.order_by('-created')[1].json)
+
+    @cleanup_models(
+        'testapp.models.Tweet_2013_03', 'testapp.models.Tweet_2013_04')
+    def test_filter_exclude_count(self):
+        """ Filters are applied to every partition, and count() sums the
+        per-partition counts.
+        """
+        from testapp.models import Tweet
+        self.create_tweets()
+        qs = Tweet.partitions.across(['2013_03', '2013_04'])
+        self.assertEqual(5, qs.count())
+        self.assertEqual(3, qs.filter(json__startswith='march').count())
+        self.assertEqual(
+            ['march 1', 'march 10', 'april 5', 'april 15'],
+            [t.json for t in qs.exclude(json='march 20').order_by('created')])
+        self.assertEqual(2, qs.order_by('created')[3:].count())
+        self.assertFalse(qs.filter(json='nope').exists())
+
+    @cleanup_models(
+        'testapp.models.Tweet_2013_03', 'testapp.models.Tweet_2013_04')
+    def test_slice_limits_partition_queries(self):
+        """ A slice bounds the number of rows fetched from each partition.
+        """
+        from django.db import connection
+        from testapp.models import Tweet
+        self.create_tweets()
+        qs = Tweet.partitions.across(['2013_03', '2013_04'])
+        with capture_queries(connection) as queries:
+            self.assertEqual(
+                ['april 15', 'april 5'],
+                [t.json for t in qs.order_by('-created')[:2]])
+        self.assertEqual(2, len(queries))
+        for query in queries:
+            self.assertTrue('LIMIT 2' in query['sql'])
+
+    @cleanup_models(
+        'testapp.models.Tweet_2013_03', 'testapp.models.Tweet_2013_04')
+    def test_cached_aggregates(self):
+        """ Aggregates over closed partitions are cached, so only open
+        partitions are queried again.
+        """
+        from django.db import connection
+        from django.db.models import Count, Max
+        from parting.query import _get_cache, invalidate_aggregates
+        from testapp.models import Tweet
+        march, april = self.create_tweets()
+        _get_cache().clear()
+        self.addCleanup(_get_cache().clear)
+        keys = ['2013_03', '2013_04']
+        with mock.patch.object(
+                Tweet.partitions, 'is_closed', lambda key: key < '2013_04'):
+            result = Tweet.partitions.aggregate(keys, Count('id'))
+            self.assertEqual({'id__count': 5}, result)
+
+            march.objects.create(json='late', created=april.objects.get(
+                json='april 5').created.replace(month=3))
+            with capture_queries(connection) as queries:
+                result = Tweet.partitions.aggregate(keys, Count('id'))
+            self.assertEqual(1, len(queries))
+            self.assertEqual({'id__count': 5}, result)
+
+            # A different query isn't answered from the cache
+            result = Tweet.partitions.across(keys).filter(
+                json__startswith='march').aggregate(
+                    Count('id'), Max('id'))
+            self.assertEqual({'id__count': 3, 'id__max': 3}, result)
+
+            # Changing a closed partition's rows with delete() forgets its
+            # results. Otherwise, invalidate_aggregates() must be called.
+            Tweet.partitions.delete(
+                ['2013_03'], {'json__in': ['march 1', 'march 10']})
+            result = Tweet.partitions.aggregate(keys, Count('id'))
+            self.assertEqual({'id__count': 4}, result)
+            march.objects.filter(json='late').delete()
+            result = Tweet.partitions.aggregate(keys, Count('id'))
+            self.assertEqual({'id__count': 4}, result)
+            invalidate_aggregates(march, 'default')
+            result = Tweet.partitions.aggregate(keys, Count('id'))
+            self.assertEqual({'id__count': 3}, result)
+
+
+class RoutingTests(PartitionTableTestCase):
+
+    @cleanup_models(
+        'testapp.models.Tweet_2013_03', 'testapp.models.Tweet_2013_04')
+    def test_bulk_create(self):
+        """ bulk_create groups rows by partition key, and issues a single
+        bulk insert per partition.
+        """
+        import datetime
+        from django.db import connection
+        from django.utils.timezone import utc
+        from testapp.models import Tweet
+        march = Tweet.partitions.get_partition('2013_03')
+        april = Tweet.partitions.get_partition('2013_04')
+        self.create_tables(march, april)
+
+        rows = [
+            {'json': str(i),
+             'created': datetime.datetime(2013, 3 + i % 2, 1, tzinfo=utc)}
+            for i in range(50)
+        ]
+        rows.append(april(json='instance', created=rows[1]['created']))
+        with capture_queries(connection) as queries:
+            created = Tweet.partitions.bulk_create(rows)
+        self.assertEqual(51, len(created))
+        self.assertEqual(2, len(queries))
+        self.assertEqual(25, march.objects.count())
+        self.assertEqual(26, april.objects.count())
+        self.assertTrue(april.objects.filter(json='instance').exists())
+
+    @cleanup_models('testapp.models.Tweet_2013_03')
+    def test_create(self):
+        """ create() saves a single row in the right partition """
+        import datetime
+        from django.utils.timezone import utc
+        from testapp.models import Tweet
+        march = Tweet.partitions.get_partition('2013_03')
+        self.create_tables(march)
+        tweet = Tweet.partitions.create(
+            json='{}',
+            created=datetime.datetime(2013, 3, 14, tzinfo=utc))
+        self.assertTrue(isinstance(tweet, march))
+        self.assertEqual(1, march.objects.count())
+
+    def test_no_key_field(self):
+        """ Routing rows requires the manager to declare a key_field """
+        from django.core.exceptions import ImproperlyConfigured
+        from testapp.models import Star
+        with self.assertRaises(ImproperlyConfigured):
+            Star.partitions.bulk_create([{'user': 'jimmy'}])
+
+
+class BulkLoadTests(PartitionTableTestCase):
+
+    @cleanup_models(
+        'testapp.models.Tweet_2013_03', 'testapp.models.Star_2013_03',
+        'testapp.models.Tweet_2013_04', 'testapp.models.Star_2013_04')
+    def test_bulk_load(self):
+        """ bulk_load routes rows to partitions, creating their tables,
+        and writes each partition's rows buffer_size at a time.
+        """
+        import datetime
+        from django.utils.timezone import utc
+        from testapp.models import Tweet
+        self._created_tables.extend([
+            'testapp_tweet_2013_03', 'testapp_star_2013_03',
+            'testapp_tweet_2013_04', 'testapp_star_2013_04'])
+        rows = (
+            {'json': str(i),
+             'created': datetime.datetime(2013, 3 + i % 2, 1, tzinfo=utc)}
+            for i in range(50))
+        with mock.patch('parting.bulk.insert_rows') as insert_rows:
+            insert_rows.side_effect = lambda m, u, c, rows, s: len(rows)
+            loaded = Tweet.partitions.bulk_load(rows, buffer_size=10)
+        self.assertEqual({'2013_03': 25, '2013_04': 25}, loaded)
+        self.assertEqual(
+            [10, 10, 10, 10, 5, 5],
+            [len(call[0][3]) for call in insert_rows.call_args_list])
+
+        rows = [
+            ('tuple', datetime.datetime(2013, 3, 2, tzinfo=utc)),
+            ('tuple', datetime.datetime(2013, 4, 2, tzinfo=utc)),
+        ]
+        loaded = Tweet.partitions.bulk_load(rows, columns=['json', 'created'])
+        self.assertEqual({'2013_03': 1, '2013_04': 1}, loaded)
+        april = Tweet.partitions.get_partition('2013_04')
+        self.assertEqual(
+            datetime.datetime(2013, 4, 2, tzinfo=utc),
+            april.objects.get(json='tuple').created)
+
+    @cleanup_models('testapp.models.Tweet_2013_03')
+    def test_insert_rows(self):
+        """ Where the backend supports it, rows are inserted with
+        multi-row INSERT statements, chunk_size rows at a time.
+        """
+        import datetime
+        from django.db import connection
+        from django.utils.timezone import utc
+        from parting.bulk import insert_rows
+        from testapp.models import Tweet
+        march = Tweet.partitions.get_partition('2013_03')
+        self.create_tables(march)
+        rows = [
+            (str(i), datetime.datetime(2013, 3, 1, tzinfo=utc))
+            for i in range(5)]
+        with capture_queries(connection) as queries:
+            self.assertEqual(5, insert_rows(
+                march, 'default', ['json', 'created'], rows, chunk_size=3))
+        self.assertEqual(
+            2, len([q for q in queries if q['sql'].startswith('INSERT')]))
+        self.assertEqual(
+            [str(i) for i in range(5)],
+            list(march.objects.order_by('json').values_list(
+                'json', flat=True)))
+
+    @cleanup_models(
+        'testapp.models.Tweet_2013_03', 'testapp.models.Star_2013_03')
+    def test_bulk_load_commits(self):
+        """ Outside a managed transaction, loaded rows are committed, so
+        they survive the connection's transaction being discarded.
+        """
+        import datetime
+        from django.db import transaction
+        from django.utils.timezone import utc
+        from testapp.models import Tweet
+        self._created_tables.extend(
+            ['testapp_tweet_2013_03', 'testapp_star_2013_03'])
+        rows = [
+            {'json': str(i),
+             'created': datetime.datetime(2013, 3, 1, tzinfo=utc)}
+            for i in range(3)]
+        Tweet.partitions.bulk_load(rows, buffer_size=2)
+        # The in-memory test database doesn't survive closing the
+        # connection, so roll back whatever it hasn't committed instead
+        transaction.rollback()
+        march = Tweet.partitions.get_partition('2013_03')
+        self.assertEqual(3, march.objects.count())
+
+    @cleanup_models(
+        'testapp.models.Tweet_2013_03', 'testapp.models.Star_2013_03')
+    def test_bulk_load_csv(self):
+        """ bulk_load reads CSV files, using the first row for column names
+        """
+        import datetime
+        from django.utils.timezone import utc
+        from testapp.models import Tweet
+        self._created_tables.extend(
+            ['testapp_tweet_2013_03', 'testapp_star_2013_03'])
+        data = StringIO(
+            'created,json\n'
+            '2013-03-01 10:00:00+00:00,"{""a"": 1}"\n'
+            '2013-03-02 10:00:00+00:00,b\n')
+        self.assertEqual({'2013_03': 2}, Tweet.partitions.bulk_load(data))
+        march = Tweet.partitions.get_partition('2013_03')
+        self.assertEqual(
+            [(u'{"a": 1}', datetime.datetime(2013, 3, 1, 10, tzinfo=utc)),
+             (u'b', datetime.datetime(2013, 3, 2, 10, tzinfo=utc))],
+            list(march.objects.order_by('created').values_list(
+                'json', 'created')))
+
+    def test_bulk_load_no_key_field(self):
+        """ Loading rows requires the manager to declare a key_field """
+        from django.core.exceptions import ImproperlyConfigured
+        from testapp.models import Star
+        with self.assertRaises(ImproperlyConfigured):
+            Star.partitions.bulk_load([{'user': 'jimmy'}])
+
+
+class BulkUpdateTests(PartitionTableTestCase):
+
+    @cleanup_models(
+        'testapp.models.Tweet_2013_03', 'testapp.models.Tweet_2013_04',
+        'testapp.models.Tweet_2013_05')
+    def test_update(self):
+        """ update() changes matching rows in each partition batch_size at a
+        time, skipping partitions without tables.
+        """
+        from django.db import connection
+        from testapp.models import Tweet
+        march, april = self.create_tweets()
+        with capture_queries(connection) as queries:
+            updated = Tweet.partitions.update(
+                ['2013_03', '2013_04', '2013_05'],
+                {'json__startswith': 'march'},
+                batch_size=2,
+                json='fixed')
+        self.assertEqual({'2013_03': 3, '2013_04': 0}, updated)
+        self.assertEqual(
+            ['2013_03', '2013_04'], list(updated))
+        self.assertEqual(2, len([
+            q for q in queries if q['sql'].startswith('UPDATE')]))
+        self.assertEqual(3, march.objects.filter(json='fixed').count())
+        self.assertEqual(0, april.objects.filter(json='fixed').count())
+
+    @cleanup_models(
+        'testapp.models.Tweet_2013_03', 'testapp.models.Star_2013_03',
+        'testapp.models.Tweet_2013_04')
+    def test_delete(self):
+        """ delete() removes matching rows from each partition, deleting the
+        rows of children which refer to them first.
+        """
+        from django.db.models import Q, get_model
+        from testapp.models import Star, Tweet
+        march, april = self.create_tweets()
+        stars = Star.partitions.get_partition('2013_03')
+        self.create_tables(stars)
+        for day in (10, 10, 20):
+            stars.objects.create(
+                user='jimmy',
+                tweet=march.objects.get(json='march {}'.format(day)))
+
+        deleted = Tweet.partitions.delete(
+            ['2013_03', '2013_04'],
+            Q(json='march 10') | Q(json='march 1') | Q(json='april 5'),
+            batch_size=1,
+            parallel=True)
+        self.assertEqual({'2013_03': 2, '2013_04': 1}, deleted)
+        self.assertEqual(
+            ['march 20'], list(march.objects.values_list('json', flat=True)))
+        self.assertEqual(
+            ['march 20'],
+            [star.tweet.json for star in stars.objects.all()])
+
+        self.assertEqual(
+            {'2013_03': 1},
+            Star.partitions.delete(['2013_03'], {'user': 'jimmy'}))
+        self.assertEqual(1, march.objects.count())
+
+        # Children without tables aren't generated, so Django's own deletes
+        # don't cascade to them
+        self.assertEqual(None, get_model('testapp', 'Star_2013_04'))
+        april.objects.all().delete()
+
+    @cleanup_models(
+        'testapp.models.Tweet_2013_03', 'testapp.models.Star_2013_03',
+        'testapp.models.Tweet_2013_04', 'testapp.models.Star_2013_04')
+    def test_stale_catalog(self):
+        """ update() and delete() look for tables again before skipping a
+        partition, in case another process created them since the catalog
+        was loaded.
+        """
+        from django.db import connection
+        from parting.ddl import catalog
+        from testapp.models import Star, Tweet
+        march, april = self.create_tweets()
+        stars = Star.partitions.get_partition('2013_04')
+        self.create_tables(Star.partitions.get_partition('2013_03'), stars)
+        stars.objects.create(
+            user='jimmy', tweet=april.objects.get(json='april 5'))
+
+        catalog.discard(connection.alias, 'testapp_tweet_2013_04')
+        self.assertEqual(
+            {'2013_03': 0, '2013_04': 1},
+            Tweet.partitions.update(
+                ['2013_03', '2013_04'], {'json': 'april 15'}, json='fixed'))
+        self.assertEqual(1, april.objects.filter(json='fixed').count())
+
+        catalog.discard(connection.alias, 'testapp_star_2013_04')
+        self.assertEqual(
+            {'2013_03': 0, '2013_04': 1},
+            Tweet.partitions.delete(
+                ['2013_03', '2013_04'], {'json': 'april 5'}))
+        self.assertEqual(0, stars.objects.count())
+
+    @cleanup_models(
+        'testapp.models.Tweet_2013_03', 'testapp.models.Tweet_2013_04',
+        'testapp.models.Tweet_2013_05')
+    def test_stream(self):
+        """ stream() yields rows a partition at a time, fetching them
+        chunk_size rows at a time.
+        """
+        from django.db import connection
+        from parting.ddl import catalog
+        from testapp.models import Tweet
+        self.create_tweets()
+        keys = ['2013_03', '2013_04', '2013_05']
+        with capture_queries(connection) as queries:
+            rows = Tweet.partitions.stream(keys, chunk_size=2)
+            self.assertEqual(
+                ['march 1', 'march 10', 'march 20', 'april 5', 'april 15'],
+                [tweet.json for tweet in rows])
+        queries = [q for q in queries if 'testapp_tweet' in q['sql']]
+        self.assertEqual(4, len(queries))
+        self.assertTrue(all('LIMIT 2' in q['sql'] for q in queries))
+
+        self.assertEqual(
+            [(u'april 5', 1), (u'april 15', 2)],
+            list(Tweet.partitions.stream(
+                keys, {'json__startswith': 'april'}, fields=['json', 'id'],
+                chunk_size=1)))
+
+        # A partition created since the catalog was loaded isn't skipped
+        catalog.discard(connection.alias, 'testapp_tweet_2013_04')
+        self.assertEqual(
+            [(u'april 5',), (u'april 15',)],
+            list(Tweet.partitions.stream(
+                keys, {'json__startswith': 'april'}, fields=['json'])))
+
+
+class PaginationTests(PartitionTableTestCase):
+
+    @cleanup_models(
+        'testapp.models.Tweet_2013_03', 'testapp.models.Tweet_2013_04')
+    def test_paginate(self):
+        """ Pages run newest first across partitions, each picking up from
+        the row in the previous page's token.
+        """
+        from django.db import connection
+        from parting.query import Page
+        from testapp.models import Tweet
+        march, april = self.create_tweets()
+        tied = march.objects.get(json='march 10')
+        march.objects.create(json='march 10 again', created=tied.created)
+        keys = ['2013_03', '2013_04']
+
+        pages = []
+        token = None
+        while True:
+            with capture_queries(connection) as queries:
+                page = Tweet.partitions.paginate(keys, token, per_page=2)
+            pages.append([tweet.json for tweet in page.rows])
+            token = page.next_token
+            if token is None:
+                break
+        self.assertEqual([
+            ['april 15', 'april 5'],
+            ['march 20', 'march 10 again'],
+            ['march 10', 'march 1'],
+        ], pages)
+        # The last page only queries the partition it starts in
+        self.assertEqual(
+            1, len([q for q in queries if 'testapp_tweet' in q['sql']]))
+
+        page = Tweet.partitions.paginate(
+            keys, filters={'json__startswith': 'march'}, per_page=3)
+        self.assertEqual(
+            ['march 20', 'march 10 again', 'march 10'],
+            [tweet.json for tweet in page.rows])
+        self.assertEqual(
+            Page([march.objects.get(json='march 1')], None),
+            Tweet.partitions.paginate(keys, page.next_token, per_page=3))
+
+    @cleanup_models(
+        'testapp.models.Tweet_2013_03', 'testapp.models.Tweet_2013_04')
+    def test_new_partition(self):
+        """ A partition created since the table catalog was loaded, eg.
+        by another process at the start of the month, isn't skipped.
+        """
+        from django.db import connection
+        from parting.ddl import catalog
+        from testapp.models import Tweet
+        self.create_tweets()
+        catalog.discard(connection.alias, 'testapp_tweet_2013_04')
+        page = Tweet.partitions.paginate(['2013_03', '2013_04'], per_page=3)
+        self.assertEqual(
+            ['april 15', 'april 5', 'march 20'],
+            [tweet.json for tweet in page.rows])
+
+    def test_bad_token(self):
+        """ Page tokens which have been tampered with are rejected """
+        from testapp.models import Tweet
+        with self.assertRaises(ValueError):
+            Tweet.partitions.paginate(['2013_03'], 'not a token')
+
+
+class ParallelQueryTests(PartitionTableTestCase):
+
+    def test_fan_out(self):
+        """ fan_out runs each call on a bounded pool of threads, and returns
+        results in order.
+        """
+        import threading
+        import time
+        from parting.query import fan_out
+        lock = threading.Lock()
+        state = {'running': 0, 'max_running': 0, 'threads': set()}
+
+        def func(item):
+            with lock:
+                state['running'] += 1
+                state['max_running'] = max(
+                    state['max_running'], state['running'])
+                state['threads'].add(threading.current_thread().ident)
+            time.sleep(0.01)
+            with lock:
+                state['running'] -= 1
+            return item * 2
+
+        self.assertEqual(
+            [i * 2 for i in range(10)],
+            fan_out(func, range(10), max_workers=3))
+        self.assertTrue(state['max_running'] <= 3)
+        self.assertFalse(threading.current_thread().ident in state['threads'])
+
+    def test_fan_out_error(self):
+        """ Exceptions in worker threads are raised in the caller """
+        from parting.query import fan_out
+
+        def func(item):
+            if item == 3:
+                raise KeyError(item)
+            return item
+
+        with self.assertRaises(KeyError):
+            fan_out(func, range(5), max_workers=2)
+
+    @cleanup_models(
+        'testapp.models.Tweet_2013_03', 'testapp.models.Tweet_2013_04')
+    def test_parallel_reads(self):
+        """ Parallel cross-partition reads give the same results as serial
+        ones. (The in-memory test database can't be shared between threads,
+        so this runs serially.)
+        """
+        from django.db.models import Avg, Count, Max
+        from testapp.models import Tweet
+        self.create_tweets()
+        qs = Tweet.partitions.across(['2013_03', '2013_04']).parallel(2)
+        self.assertEqual(5, qs.count())
+        self.assertEqual(
+            ['april 15', 'april 5', 'march 20'],
+            list(qs.order_by('-created').values_list(
+                'json', flat=True)[:3]))
+        self.assertEqual(
+            [(2, 'march 10'), (3, 'march 20')],
+            list(qs.filter(json__startswith='march').order_by(
+                '-created').values_list('id', 'json')[:2])[::-1])
+        result = qs.aggregate(Count('id'), Max('created'), avg=Avg('id'))
+        self.assertEqual(5, result['id__count'])
+        self.assertEqual(15, result['created__max'].day)
+        self.assertAlmostEqual(1.8, result['avg'])
+
+    @cleanup_models(
+        'testapp.models.Tweet_2013_03', 'testapp.models.Tweet_2013_04')
+    def test_parallel_reads_threads(self):
+        """ On a database which can be shared between threads, like the
+        file-backed 'other' test database, partitions are read on worker
+        threads, each with its own connection.
+        """
+        import datetime
+        import threading
+        from django.db.backends.signals import connection_created
+        from django.db.models import Count
+        from django.utils.timezone import utc
+        from parting import ddl
+        from parting.query import _supports_threads
+        from testapp.models import Tweet
+        self.assertTrue(_supports_threads('other'))
+        partitions = [
+            Tweet.partitions.get_partition('2013_03'),
+            Tweet.partitions.get_partition('2013_04')]
+        ddl.create_tables(partitions, 'other')
+        self.addCleanup(ddl.expire_tables, partitions, 'other')
+        for partition, month in zip(partitions, (3, 4)):
+            for day in range(1, month + 1):
+                partition.objects.using('other').create(
+                    json='{} {}'.format(month, day),
+                    created=datetime.datetime(2013, month, day, tzinfo=utc))
+
+        opened = []
+
+        def record(sender, connection, **kwargs):
+            opened.append(
+                (threading.current_thread().ident, connection.alias))
+
+        connection_created.connect(record)
+        self.addCleanup(connection_created.disconnect, record)
+        qs = Tweet.partitions.across(
+            ['2013_03', '2013_04'], using='other').parallel()
+        self.assertEqual(7, qs.count())
+        self.assertEqual(
+            ['4 4', '4 3', '4 2'],
+            list(qs.order_by('-created').values_list('json', flat=True)[:3]))
+        self.assertEqual({'id__count': 7}, qs.aggregate(Count('id')))
+        # Each of the 3 queries opened connections on worker threads (one
+        # thread may take both partitions if it's quick)
+        threads = [ident for ident, alias in opened if alias == 'other']
+        self.assertTrue(3 <= len(threads) <= 6)
+        self.assertFalse(threading.current_thread().ident in threads)
+
+
+class RelatedPartitionTests(PartitionTableTestCase):
+
+    @cleanup_models(
+        'testapp.models.Tweet_2013_03', 'testapp.models.Star_2013_03',
+        'testapp.models.Tweet_2013_04')
+    def test_cascade_to_existing_child(self):
+        """ Children are generated when Django first needs a partition's
+        related objects, if their tables exist, so that deletes cascade to
+        them and reverse lookups work even if nothing has asked for them.
+        """
+        from django.db import connection
+        from django.db.models import get_model
+        from parting.ddl import catalog
+        from testapp.models import Star, Tweet
+        march, april = self.create_tweets()
+        stars = Star.partitions.get_partition('2013_03')
+        self.create_tables(stars)
+        stars.objects.create(
+            user='jimmy', tweet=march.objects.get(json='march 10'))
+
+        def restart():
+            # Start again, as a new process would
+            _cleanup(
+                'testapp.models.Tweet_2013_03', 'testapp.models.Star_2013_03')
+            catalog.clear()
+            # Generating the partition doesn't touch the database
+            with capture_queries(connection) as queries:
+                march = Tweet.partitions.get_partition('2013_03')
+            self.assertEqual([], queries)
+            return march
+
+        march = restart()
+        self.assertEqual(None, get_model('testapp', 'Star_2013_03'))
+        self.assertEqual(
+            ['march 10'],
+            [t.json for t in march.objects.filter(star_2013_03__user='jimmy')])
+
+        march = restart()
+        march.objects.get(json='march 10').delete()
+        self.assertEqual(
+            0, Star.partitions.get_partition('2013_03').objects.count())
+
+        # Children without tables are still left until they're needed
+        april.objects.get(json='april 5').delete()
+        self.assertEqual(None, get_model('testapp', 'Star_2013_04'))
+
+
+class WarmTests(PartitionTableTestCase):
+
+    @cleanup_models(
+        'testapp.models.Tweet_2013_03', 'testapp.models.Star_2013_03')
+    def test_warm(self):
+        """ Warming generates partitions for all existing partition tables,
+        including children, with a single catalog query.
+        """
+        from django.db import connection
+        from parting import warm_partitions
+        from parting.ddl import catalog
+        from testapp.models import Star, Tweet
+        self.create_tables(
+            Tweet.partitions.get_partition('2013_03'),
+            Star.partitions.get_partition('2013_03'))
+        _cleanup('testapp.models.Tweet_2013_03', 'testapp.models.Star_2013_03')
+        self.assertEqual(
+            None, Tweet.partitions.get_partition('2013_03', create=False))
+
+        # Start from nothing, as a new process would
+        catalog.clear()
+        with capture_queries(connection) as queries:
+            result = warm_partitions()
+        self.assertEqual(1, len(queries))
+        tweet_partition = Tweet.partitions.get_partition('2013_03', False)
+        star_partition = Star.partitions.get_partition('2013_03', False)
+        self.assertEqual(
+            [tweet_partition, star_partition],
+            result.partitions)
+        self.assertEqual(
+            tweet_partition,
+            star_partition._meta.get_field('tweet').rel.to)
+        self.assertTrue(result.seconds >= 0)
+
+
+class AutoCreateTablesTests(PartitionTableTestCase):
+
+    @cleanup_models(
+        'testapp.models.Tweet_2013_05', 'testapp.models.Star_2013_05')
+    @mock.patch('testapp.models.Tweet.partitions.auto_create_tables', True)
+    def test_create_on_save(self):
+        """ With auto_create_tables, the first save to a partition creates
+        its tables, and those of its children. Later saves don't need any
+        extra queries.
+        """
+        import datetime
+        from django.db import connection
+        from django.utils.timezone import utc
+        from testapp.models import Star, Tweet
+        self._created_tables.extend(
+            ['testapp_tweet_2013_05', 'testapp_star_2013_05'])
+        created = datetime.datetime(2013, 5, 1, tzinfo=utc)
+        tweet = Tweet.partitions.create(json='{}', created=created)
+        tables = set(connection.introspection.table_names())
+        self.assertTrue('testapp_tweet_2013_05' in tables)
+        self.assertTrue('testapp_star_2013_05' in tables)
+        Star.partitions.get_partition('2013_05').objects.create(
+            user='jimmy', tweet=tweet)
+
+        with capture_queries(connection) as queries:
+            Tweet.partitions.create(json='{}', created=created)
+        self.assertEqual(1, len(queries))
+
+    @cleanup_models(
+        'testapp.models.Tweet_2013_05', 'testapp.models.Star_2013_05')
+    @mock.patch('testapp.models.Tweet.partitions.auto_create_tables', True)
+    def test_create_on_bulk_create(self):
+        """ bulk_create() also creates missing tables """
+        import datetime
+        from django.utils.timezone import utc
+        from testapp.models import Tweet
+        self._created_tables.extend(
+            ['testapp_tweet_2013_05', 'testapp_star_2013_05'])
+        Tweet.partitions.bulk_create([{
+            'json': '{}',
+            'created': datetime.datetime(2013, 5, 1, tzinfo=utc),
+        }])
+        self.assertEqual(
+            1,
+            Tweet.partitions.get_partition('2013_05').objects.count())
+
+    @cleanup_models('testapp.models.Tweet_foo', 'testapp.models.Star_foo')
+    def test_ensure_tables_existing(self):
+        """ ensure_tables doesn't create tables which already exist """
+        from testapp.models import Star, Tweet
+        self.create_tables(
+            Tweet.partitions.get_partition('foo'),
+            Star.partitions.get_partition('foo'))
+        self.assertEqual([], Star.partitions.ensure_tables('foo'))
+
+    def test_many_to_many_tables(self):
+        """ The through tables of a partition's many-to-many fields are
+        created, and expired, along with its own.
+        """
+        from django.db import connection
+        from django.db.models import get_model
+        from parting import PartitionManager, ddl
+
+        class Tagged(models.Model):
+            related = models.ManyToManyField('self', symmetrical=False)
+            objects = PartitionManager()
+
+            class Meta:
+                abstract = True
+
+        partition = Tagged.objects.get_partition('foo')
+        self.assertTrue(any(
+            statement.startswith('CREATE TABLE "parting_tagged_foo_related"')
+            for statement in ddl.sql_create_models(
+                ddl.with_auto_created([partition]), 'default')))
+
+        self.assertEqual(2, len(Tagged.objects.ensure_tables('foo')))
+        a = partition.objects.create()
+        b = partition.objects.create()
+        a.related.add(b)
+        self.assertEqual([b], list(a.related.all()))
+
+        ddl.expire_tables([partition], 'default')
+        self.assertFalse(any(
+            table.startswith('parting_tagged')
+            for table in connection.introspection.table_names()))
+
+        # Forgetting the partition forgets its through model too
+        Tagged.objects._forget_partition('foo')
+        self.assertEqual(None, get_model('parting', 'Tagged_foo'))
+        self.assertEqual(None, get_model('parting', 'Tagged_foo_related'))
+
+
+class GlobalIdTests(PartitionTableTestCase):
+
+    @cleanup_models(
+        'testapp.models.Tweet_2013_03', 'testapp.models.Star_2013_03',
+        'testapp.models.Tweet_2013_04', 'testapp.models.Star_2013_04')
+    @mock.patch('testapp.models.Tweet.partitions.global_ids', True)
+    def test_global_ids(self):
+        """ With global_ids, each partition allocates ids from its own range,
+        so rows can be fetched by id with one query per partition.
+        """
+        import datetime
+        from django.db import connection
+        from django.utils.timezone import utc
+        from testapp.models import Star, Tweet
+        self._created_tables.extend([
+            'testapp_tweet_2013_03', 'testapp_star_2013_03',
+            'testapp_tweet_2013_04', 'testapp_star_2013_04'])
+        Tweet.partitions.ensure_tables('2013_03')
+        Tweet.partitions.ensure_tables('2013_04')
+        tweets = [
+            Tweet.partitions.create(
+                json=str(day),
+                created=datetime.datetime(2013, month, day, tzinfo=utc))
+            for month, day in [(3, 1), (3, 2), (4, 1)]]
+        march_ids = Tweet.partitions.global_id_range('2013_03')
+        self.assertEqual(march_ids[0], tweets[0].pk)
+        self.assertEqual(march_ids[0] + 1, tweets[1].pk)
+        self.assertEqual(
+            Tweet.partitions.global_id_range('2013_04')[0], tweets[2].pk)
+        self.assertEqual(
+            '2013_04', Tweet.partitions.partition_key_for_id(tweets[2].pk))
+
+        # Children can refer to the big ids
+        star = Star.partitions.get_partition('2013_04').objects.create(
+            user='jimmy', tweet=tweets[2])
+        self.assertEqual(tweets[2], star.__class__.objects.get().tweet)
+
+        with capture_queries(connection) as queries:
+            self.assertEqual(
+                tweets[2], Tweet.partitions.get_by_global_id(tweets[2].pk))
+        self.assertEqual(1, len(queries))
+        with capture_queries(connection) as queries:
+            found = Tweet.partitions.in_bulk(
+                [t.pk for t in tweets] + [march_ids[1]])
+        self.assertEqual(2, len(queries))
+        self.assertEqual(dict((t.pk, t) for t in tweets), found)
+
+        with self.assertRaises(tweets[0].DoesNotExist):
+            Tweet.partitions.get_by_global_id(march_ids[1])
+
+    def test_not_enabled(self):
+        """ Global id lookups need global_ids turned on """
+        from django.core.exceptions import ImproperlyConfigured
+        from testapp.models import Tweet
+        with self.assertRaises(ImproperlyConfigured):
+            Tweet.partitions.get_by_global_id(1)
+
+
+class ExpireTests(PartitionTableTestCase):
+
+    def create_partitions(self, *partition_keys):
+        from testapp.models import Star, Tweet
+        for partition_key in partition_keys:
+            self.create_tables(
+                Tweet.partitions.get_partition(partition_key),
+                Star.partitions.get_partition(partition_key))
+
+    @cleanup_models(
+        'testapp.models.Tweet_2013_03', 'testapp.models.Star_2013_03',
+        'testapp.models.Tweet_2013_04', 'testapp.models.Star_2013_04')
+    def test_dry_run(self):
+        """ A dry run lists the tables which would be expired, children
+        first, but leaves them alone.
+        """
+        from django.db import connection
+        from parting.models import ExpiredTable
+        from testapp.models import Tweet
+        self.create_partitions('2013_03', '2013_04')
+        self.assertEqual([
+            ExpiredTable('2013_03', 'testapp_star_2013_03', None, 'default'),
+            ExpiredTable('2013_03', 'testapp_tweet_2013_03', None, 'default'),
+        ], Tweet.partitions.expire(keep=1, dry_run=True))
+        tables = set(connection.introspection.table_names())
+        self.assertTrue('testapp_tweet_2013_03' in tables)
+        self.assertTrue('testapp_star_2013_03' in tables)
+
+    @cleanup_models(
+        'testapp.models.Tweet_2013_04', 'testapp.models.Star_2013_04')
+    def test_drop(self):
+        """ Dropping partitions removes their tables and their models """
+        from django.db import connection
+        from testapp import models
+        self.create_partitions('2013_03', '2013_04')
+        self._created_tables = self._created_tables[2:]
+        expired = models.Tweet.partitions.expire(older_than='2013_04')
+        self.assertEqual(
+            ['testapp_star_2013_03', 'testapp_tweet_2013_03'],
+            [e.table for e in expired])
+        tables = set(connection.introspection.table_names())
+        self.assertFalse('testapp_tweet_2013_03' in tables)
+        self.assertFalse('testapp_star_2013_03' in tables)
+        self.assertTrue('testapp_tweet_2013_04' in tables)
+        self.assertFalse(hasattr(models, 'Tweet_2013_03'))
+        self.assertFalse(hasattr(models, 'Star_2013_03'))
+        self.assertEqual(
+            None,
+            models.Tweet.partitions.get_partition('2013_03', create=False))
+        self.assertEqual(
+            None,
+            models.Star.partitions.get_partition('2013_03', create=False))
+
+    @cleanup_models(
+        'testapp.models.Tweet_2013_03', 'testapp.models.Star_2013_03',
+        'testapp.models.Tweet_2013_04')
+    def test_truncate(self):
+        """ Truncating partitions empties their tables, but keeps them """
+        from testapp.models import Tweet
+        march, april = self.create_tweets()
+        Tweet.partitions.expire(keep=1, mode='truncate')
+        self.assertEqual(0, march.objects.count())
+        self.assertEqual(2, april.objects.count())
+
+    @cleanup_models(
+        'testapp.models.Tweet_2013_03', 'testapp.models.Star_2013_03',
+        'testapp.models.Tweet_2013_04', 'testapp.models.Star_2013_04')
+    def test_prune_command(self):
+        """ prune_partitions --dry-run lists the tables it would expire """
+        from parting.management.commands import prune_partitions
+        self.create_partitions('2013_03', '2013_04')
+        command = prune_partitions.Command()
+        command.stdout = StringIO()
+        command.handle(
+            'testapp.models.Tweet', keep=0, dry_run=True, verbosity=1)
+        self.assertEqual(
+            'testapp_star_2013_03\ntestapp_tweet_2013_03\n'
+            'testapp_star_2013_04\ntestapp_tweet_2013_04\n'
+            'Would expire 4 tables\n',
+            command.stdout.getvalue())
+
+    def test_many_to_many(self):
+        """ The through tables of many-to-many fields share their model's
+        prefix, but are warmed and expired with their partitions rather than
+        as partitions of their own.
+        """
+        from django.db import connection
+        from parting import PartitionManager
+
+        class Tagged(models.Model):
+            related = models.ManyToManyField('self', symmetrical=False)
+            objects = PartitionManager()
+
+            class Meta:
+                abstract = True
+
+        for partition_key in ('2013_01', '2013_02', '2013_03'):
+            Tagged.objects.ensure_tables(partition_key)
+        self.assertEqual(
+            ['Tagged_2013_01', 'Tagged_2013_02', 'Tagged_2013_03'],
+            sorted(m.__name__ for m in Tagged.objects.warm().partitions))
+        self.assertEqual([
+            ('2013_01', 'parting_tagged_2013_01_related'),
+            ('2013_01', 'parting_tagged_2013_01'),
+        ], [
+            (e.partition_key, e.table)
+            for e in Tagged.objects.expire(keep=2, dry_run=True)])
+
+        self.assertEqual(6, len(Tagged.objects.expire(keep=0)))
+        self.assertFalse(any(
+            table.startswith('parting_tagged')
+            for table in connection.introspection.table_names()))
+
+    def test_prune_command_needs_limit(self):
+        """ prune_partitions needs --keep or --older-than """
+        from parting.management.commands import prune_partitions
+        command = prune_partitions.Command()
+        self.assertRaises(
+            CommandError, command.handle, 'testapp.models.Tweet')
+
+
+class ArchiveTests(PartitionTableTestCase):
+
+    def setUp(self):
+        import tempfile
+        super(ArchiveTests, self).setUp()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+        super(ArchiveTests, self).tearDown()
+
+    def _run(self, name, *args, **kwargs):
+        import importlib
+        command = importlib.import_module(
+            'parting.management.commands.{}'.format(name)).Command()
+        command.stdout = StringIO()
+        kwargs.setdefault('verbosity', 0)
+        command.handle(*args, **kwargs)
+        return command.stdout.getvalue()
+
+    @cleanup_models(
+        'testapp.models.Tweet_2013_03', 'testapp.models.Star_2013_03',
+        'testapp.models.Tweet_2013_04')
+    def test_archive_restore(self):
+        """ A partition and its children can be archived to files, dropped,
+        and restored again.
+        """
+        import os
+        from testapp.models import Star
+        march, april = self.create_tweets()
+        star_partition = Star.partitions.get_partition('2013_03')
+        self.create_tables(star_partition)
+        tweet = march.objects.get(json='march 10')
+        star_partition.objects.create(user=u'j\xfcrgen', tweet=tweet)
+        tweets = list(march.objects.order_by('id').values_list(
+            'id', 'json', 'created'))
+        self._created_tables = ['testapp_tweet_2013_04']
+
+        output = self._run(
+            'archive_partition', 'testapp.models.Tweet', '2013_03',
+            directory=self.directory, drop=True, verbosity=1)
+        self.assertTrue(output.startswith(
+            'Archived 4 rows (') and 'from 2 tables' in output)
+        self.assertEqual(
+            ['testapp_star_2013_03.csv.gz', 'testapp_tweet_2013_03.csv.gz'],
+            sorted(os.listdir(self.directory)))
+        self.assertEqual(
+            None, Star.partitions.get_partition('2013_03', create=False))
+
+        self._run(
+            'restore_partition', 'testapp.models.Tweet', '2013_03',
+            directory=self.directory)
+        self._created_tables.extend(
+            ['testapp_tweet_2013_03', 'testapp_star_2013_03'])
+        march = march._partition_manager.get_partition('2013_03')
+        star_partition = Star.partitions.get_partition('2013_03')
+        self.assertEqual(tweets, list(march.objects.order_by('id').values_list(
+            'id', 'json', 'created')))
+        star = star_partition.objects.get()
+        self.assertEqual(u'j\xfcrgen', star.user)
+        self.assertEqual(u'march 10', star.tweet.json)
+
+    @cleanup_models(
+        'testapp.models.Tweet_2013_03', 'testapp.models.Star_2013_03',
+        'testapp.models.Tweet_2013_04')
+    def test_restore_commits(self):
+        """ Restoring from Python outside a managed transaction commits the
+        loaded rows.
+        """
+        from django.db import transaction
+        from parting import bulk
+        from testapp.models import Tweet
+        march, april = self.create_tweets()
+        bulk.archive_partition(Tweet, '2013_03', self.directory)
+        Tweet.partitions.delete(['2013_03'])
+        bulk.restore_partition(Tweet, '2013_03', self.directory)
+        self._created_tables.append('testapp_star_2013_03')
+        # The in-memory test database doesn't survive closing the
+        # connection, so roll back whatever it hasn't committed instead
+        transaction.rollback()
+        self.assertEqual(3, march.objects.count())
+
+    @cleanup_models(
+        'testapp.models.Tweet_2013_03', 'testapp.models.Star_2013_03')
+    def test_restore_missing(self):
+        """ Restoring a partition with no archive files is an error """
+        self.assertRaises(
+            CommandError, self._run, 'restore_partition',
+            'testapp.models.Tweet', '2013_03', directory=self.directory)
+
+
+class PlacementTests(TransactionTestCase):
+
+    multi_db = True
+
+    def test_policies(self):
+        """ Placement policies map partition keys to databases """
+        from parting.placement import (
+            ExplicitPlacement, HashPlacement, RangePlacement)
+        explicit = ExplicitPlacement({'2013_03': 'other'}, default='default')
+        self.assertEqual('other', explicit.database_for('2013_03'))
+        self.assertEqual('default', explicit.database_for('2013_04'))
+        self.assertEqual(['other', 'default'], explicit.databases())
+
+        ranged = RangePlacement([('2013_01', 'a'), ('2014_01', 'b')])
+        self.assertEqual(None, ranged.database_for('2012_12'))
+        self.assertEqual('a', ranged.database_for('2013_01'))
+        self.assertEqual('a', ranged.database_for('2013_12'))
+        self.assertEqual('b', ranged.database_for('2014_06'))
+        self.assertEqual(['a', 'b'], ranged.databases())
+
+        hashed = HashPlacement(['a', 'b', 'c'])
+        keys = ['2013_{:02d}'.format(month) for month in range(1, 13)]
+        placed = [hashed.database_for(key) for key in keys]
+        self.assertEqual(placed, [hashed.database_for(key) for key in keys])
+        self.assertEqual(set(['a', 'b', 'c']), set(placed))
+
+    @cleanup_models(
+        'testapp.models.Tweet_2013_03', 'testapp.models.Star_2013_03',
+        'testapp.models.Tweet_2013_04')
+    def test_routing(self):
+        """ Partitions, and their children, are read and written on the
+        database their placement chooses.
+        """
+        from django.db import router
+        from parting.placement import ExplicitPlacement
+        from testapp.models import Star, Tweet
+        placement = ExplicitPlacement({'2013_03': 'other'})
+        with mock.patch.object(Tweet.partitions, 'placement', placement):
+            self.assertEqual(
+                'other',
+                router.db_for_write(Tweet.partitions.get_partition('2013_03')))
+            self.assertEqual(
+                'other',
+                router.db_for_read(Star.partitions.get_partition('2013_03')))
+            self.assertEqual(
+                'default',
+                router.db_for_read(Tweet.partitions.get_partition('2013_04')))
+
+    @cleanup_models(
+        'testapp.models.Tweet_2013_03', 'testapp.models.Star_2013_03',
+        'testapp.models.Tweet_2013_04', 'testapp.models.Star_2013_04')
+    def test_ensure_partition(self):
+        """ ensure_partition creates each partition on its own database """
+        from django.db import connections
+        from parting.ddl import catalog
+        from parting.management.commands import ensure_partition
+        from parting.placement import ExplicitPlacement
+        from testapp.models import Tweet
+        placement = ExplicitPlacement({'2013_03': 'other'})
+        command = ensure_partition.Command()
+        command.stdout = StringIO()
+        with mock.patch.object(Tweet.partitions, 'placement', placement):
+            command.handle(
+                'testapp.models.Tweet', first='2013_03', last='2013_04',
+                verbosity=0)
+        try:
+            self.assertEqual(
+                set(['testapp_tweet_2013_03', 'testapp_star_2013_03']),
+                set(connections['other'].introspection.table_names()))
+            self.assertEqual(
+                set(['testapp_tweet_2013_04', 'testapp_star_2013_04']),
+                set(connections['default'].introspection.table_names()))
+        finally:
+            for alias in ('default', 'other'):
+                cursor = connections[alias].cursor()
+                for table in connections[alias].introspection.table_names():
+                    cursor.execute('DROP TABLE {}'.format(
+                        connections[alias].ops.quote_name(table)))
+            catalog.clear()
+
+    def test_commands(self):
+        """ Without --database, the archive, restore and prune commands work
+        on the database each partition is placed on. (Pruning forgets the
+        partitions, so there are no models to clean up.)
+        """
+        import importlib
+        import shutil
+        import tempfile
+        from django.db import connections
+        from parting.ddl import catalog
+        from parting.placement import ExplicitPlacement
+        from testapp.models import Tweet
+        placement = ExplicitPlacement({'2013_03': 'other'})
+        directory = tempfile.mkdtemp()
+
+        def run(name, *args, **kwargs):
+            command = importlib.import_module(
+                'parting.management.commands.{}'.format(name)).Command()
+            command.stdout = StringIO()
+            kwargs.setdefault('verbosity', 0)
+            command.handle('testapp.models.Tweet', *args, **kwargs)
+
+        def tables(alias):
+            return set(connections[alias].introspection.table_names())
+
+        try:
+            with mock.patch.object(Tweet.partitions, 'placement', placement):
+                run('ensure_partition', first='2013_03', last='2013_04')
+                run('archive_partition', '2013_03', directory=directory,
+                    drop=True)
+                self.assertEqual(set(), tables('other'))
+                run('restore_partition', '2013_03', directory=directory)
+                self.assertEqual(
+                    set(['testapp_tweet_2013_03', 'testapp_star_2013_03']),
+                    tables('other'))
+                run('prune_partitions', keep=0)
+                self.assertEqual(set(), tables('other'))
+                self.assertEqual(set(), tables('default'))
+        finally:
+            shutil.rmtree(directory)
+            for alias in ('default', 'other'):
+                cursor = connections[alias].cursor()
+                for table in tables(alias):
+                    cursor.execute('DROP TABLE {}'.format(
+                        connections[alias].ops.quote_name(table)))
+            catalog.clear()
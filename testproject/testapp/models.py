@@ -1,11 +1,7 @@
 from django.db import models
 from django.utils import timezone
 from parting import PartitionForeignKey, PartitionManager
-from dateutil.relativedelta import relativedelta
-
-
-def _key_from_dt(dt):
-    return dt.strftime('%Y_%m')
+from parting.strategies import TimeRangePartitionManager
 
 
 class CustomManager(models.Manager):
@@ -13,13 +9,10 @@ class CustomManager(models.Manager):
         return u'hi!'
 
 
-class TweetPartitionManager(PartitionManager):
-
-    def current_partition_key(self):
-        return _key_from_dt(timezone.now())
+class TweetPartitionManager(TimeRangePartitionManager):
 
-    def next_partition_key(self):
-        return _key_from_dt(timezone.now() + relativedelta(months=+1))
+    key_field = 'created'
+    interval = 'month'
 
     def get_managers(self, partition):
         return [
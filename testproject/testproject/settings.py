@@ -13,6 +13,13 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': 'parting.db',
+    },
+    'other': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': 'parting-other.db',
+        # A file, rather than the default in-memory database, so that tests
+        # can share it between threads
+        'TEST_NAME': 'parting-other-test.db',
     }
 }
 